@@ -0,0 +1,68 @@
+""" A circuit breaker, to stop sending requests to an upstream service (WFWX) that keeps failing.
+"""
+import time
+import logging
+from collections import deque
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WFWXUnavailableException(Exception):
+    """ Exception raised when WFWX has been failing, and we've stopped sending it requests for a while. """
+
+
+class CircuitBreaker():
+    """ Stop sending requests to an upstream service when too many of them are failing.
+
+    The breaker keeps track of the outcome of the most recent calls. When the proportion of failures
+    gets too high, the breaker opens and calls fail fast for a while. After that, a single trial call
+    is let through (half open): if it succeeds the breaker closes, otherwise it opens again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window: int, min_calls: int, failure_ratio: float, reset_timeout: float):
+        """ Initialize object """
+        self.outcomes = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def before_call(self):
+        """ Raise an exception if the call should not be made. """
+        if self.state == CircuitBreaker.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise WFWXUnavailableException('WFWX circuit breaker is open')
+            LOGGER.info('WFWX circuit breaker half open')
+            self.state = CircuitBreaker.HALF_OPEN
+        if self.state == CircuitBreaker.HALF_OPEN:
+            if self.trial_in_flight:
+                raise WFWXUnavailableException('WFWX circuit breaker is half open')
+            self.trial_in_flight = True
+
+    def record_success(self):
+        """ Record a successful call. """
+        if self.state == CircuitBreaker.HALF_OPEN:
+            LOGGER.info('WFWX circuit breaker closed')
+            self.state = CircuitBreaker.CLOSED
+            self.outcomes.clear()
+        self.trial_in_flight = False
+        self.outcomes.append(True)
+
+    def record_failure(self):
+        """ Record a failed call, opening the breaker if there have been too many. """
+        self.trial_in_flight = False
+        self.outcomes.append(False)
+        failures = self.outcomes.count(False)
+        if (self.state == CircuitBreaker.HALF_OPEN or
+                (len(self.outcomes) >= self.min_calls and
+                 failures / len(self.outcomes) >= self.failure_ratio)):
+            if self.state != CircuitBreaker.OPEN:
+                LOGGER.error('WFWX circuit breaker open, %d of the last %d calls failed',
+                             failures, len(self.outcomes))
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.monotonic()
@@ -2,7 +2,7 @@
 """
 import logging
 import datetime
-from typing import List
+from typing import List, Set
 from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from app.db.models import (
@@ -156,6 +156,13 @@ def get_processed_file_record(session: Session, url: str) -> ProcessedModelRunUr
     return processed_file
 
 
+def get_processed_file_urls(session: Session, urls: List[str]) -> Set[str]:
+    """ Get the urls, out of those given, of files that have already been processed. """
+    query = session.query(ProcessedModelRunUrl.url).\
+        filter(ProcessedModelRunUrl.url.in_(urls))
+    return {url for url, in query}
+
+
 def get_prediction_model(session: Session, abbreviation: str, projection: str) -> PredictionModel:
     """ Get the prediction model corresponding to a particular abbreviation and projection. """
     return session.query(PredictionModel).\
@@ -173,3 +173,31 @@ class NoonForecasts(Base):
     danger_rating = Column(Integer, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False,
                         default=datetime.datetime.now(tz=timezone.utc))
+
+
+class HourlyActual(Base):
+    """ Class representing table structure of 'hourly_actuals' table in DB.
+    Hourly ACTUAL weather readings, as reported by WFWX. There is only ever one reading per station
+    per hour.
+    """
+    __tablename__ = 'hourly_actuals'
+    __table_args__ = (
+        # The unique constraint doubles as the index used to look up readings by station and date.
+        UniqueConstraint('station_code', 'weather_date'),
+        {'comment': 'The hourly actual weather readings for a weather station and weather date.'}
+    )
+    id = Column(Integer, Sequence('hourly_actuals_id_seq'),
+                primary_key=True, nullable=False, index=True)
+    weather_date = Column(TIMESTAMP(timezone=True), nullable=False)
+    station_code = Column(Integer, nullable=False)
+    temperature = Column(Float, nullable=True)
+    relative_humidity = Column(Float, nullable=True)
+    wind_speed = Column(Float, nullable=True)
+    wind_direction = Column(Float, nullable=True)
+    barometric_pressure = Column(Float, nullable=True)
+    precipitation = Column(Float, nullable=True)
+    ffmc = Column(Float, nullable=True)
+    isi = Column(Float, nullable=True)
+    fwi = Column(Float, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False,
+                        default=lambda: datetime.datetime.now(tz=timezone.utc))
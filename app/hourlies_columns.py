@@ -0,0 +1,58 @@
+""" Decode WFWX hourlies into columns (numpy arrays), rather than into a model per reading.
+"""
+from datetime import datetime, timezone
+from typing import List, Dict
+import numpy as np
+from .schemas import WeatherReading
+
+# Hourly reading fields, and the WFWX hourly attributes they're read from.
+HOURLY_FIELDS = {
+    'temperature': 'temperature',
+    'relative_humidity': 'relativeHumidity',
+    'wind_speed': 'windSpeed',
+    'wind_direction': 'windDirection',
+    'barometric_pressure': 'barometricPressure',
+    'precipitation': 'precipitation',
+    'ffmc': 'ffmc',
+    'isi': 'isi',
+    'fwi': 'fwi'
+}
+
+
+def parse_hourlies_columns(hourlies: List[dict]) -> Dict[str, np.ndarray]:
+    """ Decode raw WFWX hourlies into columns, keeping only ACTUAL values.
+
+    The datetime column holds epoch milliseconds (int64), all other columns are float64, with NaN for
+    missing values.
+    """
+    # We only accept "ACTUAL" values:
+    actuals = [hourly for hourly in hourlies
+               if hourly.get('hourlyMeasurementTypeCode', '').get('id') == 'ACTUAL']
+    columns = {'datetime': np.array(
+        [hourly['weatherTimestamp'] for hourly in actuals], dtype=np.int64)}
+    for field, attribute in HOURLY_FIELDS.items():
+        # None becomes NaN when converting to float.
+        columns[field] = np.array([hourly.get(attribute) for hourly in actuals], dtype=np.float64)
+    return columns
+
+
+def column_to_list(column: np.ndarray) -> list:
+    """ Return the column as a list, with NaN replaced by None. """
+    if column.dtype.kind != 'f':
+        return column.tolist()
+    values = column.astype(object)
+    values[np.isnan(column)] = None
+    return values.tolist()
+
+
+def columns_to_readings(columns: Dict[str, np.ndarray]) -> List[WeatherReading]:
+    """ Transform hourly columns into weather readings.
+
+    The columns are already typed, so the readings are constructed without being validated again.
+    """
+    timestamps = [datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc)
+                  for timestamp in columns['datetime'].tolist()]
+    fields = list(HOURLY_FIELDS)
+    rows = zip(*[column_to_list(columns[field]) for field in fields])
+    return [WeatherReading.construct(datetime=timestamp, **dict(zip(fields, row)))
+            for timestamp, row in zip(timestamps, rows)]
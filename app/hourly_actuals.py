@@ -0,0 +1,85 @@
+""" This module is used to fetch hourly actuals for weather stations from the hourly_actuals table in
+our database (populated by app.hourly_actuals_bot), optionally topped up with the most recent readings
+from WFWX.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Dict
+from app import config
+from app.schemas import WeatherReading, WeatherStationHourlyReadings, WeatherStationHourlyReadingsError
+import app.db.database
+from app.db.models import HourlyActual
+from app import wildfire_one
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _parse_hourly_actual(record: HourlyActual) -> WeatherReading:
+    """ Transform a hourly_actuals record into a weather reading. """
+    return WeatherReading(
+        datetime=record.weather_date,
+        temperature=record.temperature,
+        relative_humidity=record.relative_humidity,
+        wind_speed=record.wind_speed,
+        wind_direction=record.wind_direction,
+        barometric_pressure=record.barometric_pressure,
+        precipitation=record.precipitation,
+        ffmc=record.ffmc,
+        isi=record.isi,
+        fwi=record.fwi)
+
+
+def fetch_hourly_actuals(station_codes: List[int],
+                         start_date: datetime,
+                         end_date: datetime) -> Dict[int, List[WeatherReading]]:
+    """ Query the hourly actuals between start_date and end_date for the specified weather stations,
+    returning the readings for each station in time order. """
+    LOGGER.debug('Querying hourly actuals for stations %s from %s to %s',
+                 station_codes, start_date, end_date)
+    session = app.db.database.get_session()
+    actuals = session.query(HourlyActual)\
+        .filter(HourlyActual.station_code.in_(station_codes))\
+        .filter(HourlyActual.weather_date >= start_date)\
+        .filter(HourlyActual.weather_date <= end_date)\
+        .order_by(HourlyActual.station_code, HourlyActual.weather_date)
+    readings = {code: [] for code in station_codes}
+    for record in actuals:
+        readings[record.station_code].append(_parse_hourly_actual(record))
+    return readings
+
+
+async def _top_up(readings: Dict[int, List[WeatherReading]]):
+    """ Add readings newer than those in the database, straight from WFWX.
+
+    The bot only runs periodically, so the database can be up to one run behind. If WFWX is slow or
+    unavailable, we make do with what's in the database.
+    """
+    start_times = {code: values[-1].datetime if values else None
+                   for code, values in readings.items()}
+    timeout = float(config.get('HOURLY_ACTUALS_LIVE_TOP_UP_TIMEOUT', 5))
+    try:
+        recent = await asyncio.wait_for(wildfire_one.get_hourly_actuals_since(start_times), timeout)
+    # We intentionally catch a broad exception, the readings in the database are still good.
+    except Exception as exception:  # pylint: disable=broad-except
+        LOGGER.warning('unable to top up hourly actuals from WFWX', exc_info=exception)
+        return
+    for code, values in recent.items():
+        if isinstance(values, WeatherStationHourlyReadingsError):
+            # Make do with what's in the database for this station.
+            continue
+        latest = start_times.get(code)
+        readings[code].extend(
+            value for value in values if latest is None or value.datetime > latest)
+
+
+async def get_hourly_readings(station_codes: List[int]) -> List[WeatherStationHourlyReadings]:
+    """ Get the hourly readings for the last 5 days, for the list of station codes provided. """
+    stations = await wildfire_one.get_stations_by_codes(station_codes)
+    now = wildfire_one._get_now()  # pylint: disable=protected-access
+    readings = fetch_hourly_actuals(
+        [station.code for station in stations], now - wildfire_one.HOURLIES_WINDOW, now)
+    if config.get('HOURLY_ACTUALS_LIVE_TOP_UP') == 'True':
+        await _top_up(readings)
+    return [WeatherStationHourlyReadings(values=readings[station.code], station=station)
+            for station in stations]
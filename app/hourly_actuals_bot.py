@@ -0,0 +1,122 @@
+""" This is a bot to pull hourly weather actuals from the WFWX Fireweather API for all weather stations,
+and store them in our database.
+
+Only readings newer than those we already have for a station are requested.
+"""
+import os
+import json
+import sys
+import asyncio
+import logging
+import logging.config
+from datetime import datetime, timezone
+from typing import List, Dict
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+import app.db.database
+from app.db.models import HourlyActual
+from app.schemas import WeatherReading, WeatherStationHourlyReadingsError
+from app import wildfire_one
+
+
+# If running as it's own process, configure loggin appropriately.
+if __name__ == "__main__":
+    LOGGING_CONFIG = os.path.join(os.path.dirname(__file__), 'logging.json')
+    if os.path.exists(LOGGING_CONFIG):
+        with open(LOGGING_CONFIG) as config_file:
+            CONFIG = json.load(config_file)
+        logging.config.dictConfig(CONFIG)
+
+LOGGER = logging.getLogger(__name__)
+
+# Number of rows to insert per statement.
+INSERT_BATCH_SIZE = 1000
+
+
+def get_latest_weather_dates(session: Session) -> Dict[int, datetime]:
+    """ Return the date of the most recent hourly actual we have for each station. """
+    query = session.query(HourlyActual.station_code, func.max(HourlyActual.weather_date))\
+        .group_by(HourlyActual.station_code)
+    return dict(query)
+
+
+def _to_rows(station_code: int, readings: List[WeatherReading], created_at: datetime) -> List[dict]:
+    """ Transform weather readings into hourly_actuals rows. """
+    return [dict(reading.dict(exclude={'datetime'}),
+                 weather_date=reading.datetime,
+                 station_code=station_code,
+                 created_at=created_at) for reading in readings]
+
+
+def store_hourly_actuals(session: Session, rows: List[dict]) -> int:
+    """ Insert the rows into the hourly_actuals table, skipping any we already have. Returns the number
+    of rows inserted. """
+    inserted = 0
+    for index in range(0, len(rows), INSERT_BATCH_SIZE):
+        # pylint: disable=no-member
+        statement = insert(HourlyActual.__table__)\
+            .values(rows[index:index + INSERT_BATCH_SIZE])\
+            .on_conflict_do_nothing(index_elements=['station_code', 'weather_date'])
+        result = session.execute(statement)
+        inserted += result.rowcount or 0
+    session.commit()
+    return inserted
+
+
+async def get_hourly_actuals() -> int:
+    """ Fetch new hourly actuals for all stations from WFWX, and store them in the database. Stations that
+    fail don't stop the readings of the others from being stored. Returns the number of stations that
+    failed. """
+    session = app.db.database.get_session()
+    latest_weather_dates = get_latest_weather_dates(session)
+    LOGGER.info('fetching hourly actuals for all stations (%d with readings already stored)',
+                len(latest_weather_dates))
+    readings = await wildfire_one.get_hourly_actuals_since(latest_weather_dates, all_stations=True)
+    created_at = datetime.now(tz=timezone.utc)
+    rows = []
+    failures = 0
+    for station_code, station_readings in readings.items():
+        if isinstance(station_readings, WeatherStationHourlyReadingsError):
+            failures += 1
+        else:
+            rows.extend(_to_rows(station_code, station_readings, created_at))
+    inserted = store_hourly_actuals(session, rows)
+    LOGGER.info('stored %d new hourly actuals (%d fetched, %d stations failed)', inserted, len(rows),
+                failures)
+    return failures
+
+
+async def _run() -> int:
+    """ Run the bot with its own WFWX client, returning the number of stations that failed. """
+    await wildfire_one.open_wfwx_client()
+    try:
+        return await get_hourly_actuals()
+    finally:
+        await wildfire_one.close_wfwx_client()
+
+
+# pylint: disable=invalid-name
+def main():
+    """ Fetch hourly actuals for all weather stations that are newer than those in our database, and
+    write them to the database.
+    """
+    LOGGER.debug('Retrieving hourly actuals...')
+    try:
+        failures = asyncio.get_event_loop().run_until_complete(_run())
+        if failures:
+            # Exit non 0 - failure, even though the readings of the other stations have been stored.
+            LOGGER.error('Failed to retrieve hourly actuals for %d stations.', failures)
+            sys.exit(1)
+        LOGGER.debug('Finished retrieving hourly actuals for all weather stations.')
+        # Exit with 0 - success.
+        sys.exit(0)
+    # pylint: disable=broad-except
+    except Exception as exception:
+        # Exit non 0 - failure.
+        LOGGER.error('Failed to retrieve hourly actuals.', exc_info=exception)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,16 +7,18 @@ import json
 import logging
 import logging.config
 import datetime
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse, JSONResponse
 from app import schemas
 from app.models.fetch.predictions import fetch_model_predictions
 from app.models.fetch.summaries import fetch_model_prediction_summaries
 from app.models import ModelEnum
-from app.percentile import get_precalculated_percentiles
+from app.percentile import get_precalculated_percentiles, get_percentile_store, get_percentile_sketches
 from app.noon_forecasts import fetch_noon_forecasts
 from app.auth import authenticate
 from app import wildfire_one
+from app import hourly_actuals
 from app import config
 
 LOGGING_CONFIG = os.path.join(os.path.dirname(__file__), 'logging.json')
@@ -83,11 +85,35 @@ app.add_middleware(
 )
 
 
+@app.exception_handler(wildfire_one.WFWXUnavailableException)
+async def wfwx_unavailable_exception_handler(request: Request,
+                                             exception: wildfire_one.WFWXUnavailableException):
+    """ WFWX has been failing, let the caller know they should try again later. """
+    # pylint: disable=unused-argument
+    LOGGER.warning(exception)
+    return JSONResponse(status_code=503, content={'detail': 'Fire weather data is temporarily unavailable.'})
+
+
+@app.on_event('startup')
+async def startup():
+    """ Open connection pools that are shared for the lifetime of the application, and load data that's
+    kept in memory. """
+    await wildfire_one.open_wfwx_client()
+    get_percentile_store()
+    get_percentile_sketches()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    """ Close shared connection pools. """
+    await wildfire_one.close_wfwx_client()
+
+
 @app.get('/health')
 async def get_health():
-    """ A simple endpoint for Openshift Healthchecks """
+    """ A simple endpoint for Openshift Healthchecks, that also reports on requests made to WFWX """
     LOGGER.info('/health')
-    return {"message": "Healthy as ever"}
+    return {"message": "Healthy as ever", "wfwx": wildfire_one.get_wfwx_client().get_metrics()}
 
 
 @app.post('/models/{model}/predictions/', response_model=schemas.WeatherModelPredictionResponse)
@@ -139,13 +165,48 @@ async def get_hourlies(request: schemas.StationCodeList, _: bool = Depends(authe
     """ Returns hourlies for the last 5 days, for the specified weather stations """
     try:
         LOGGER.info('/hourlies/')
-        readings = await wildfire_one.get_hourly_readings(request.stations)
+        if config.get('USE_HOURLY_ACTUALS_DB') == 'True':
+            readings = await hourly_actuals.get_hourly_readings(request.stations)
+        else:
+            readings = await wildfire_one.get_hourly_readings(request.stations)
         return schemas.WeatherStationHourlyReadingsResponse(hourlies=readings)
     except Exception as exception:
         LOGGER.critical(exception, exc_info=True)
         raise
 
 
+@app.post('/hourlies/columns/', response_model=schemas.WeatherStationHourlyColumnsResponse)
+async def get_hourlies_columns(request: schemas.StationCodeList, _: bool = Depends(authenticate)):
+    """ Returns hourlies for the last 5 days, for the specified weather stations, with the readings for
+    each station as one array per field. """
+    try:
+        LOGGER.info('/hourlies/columns/')
+        readings = await wildfire_one.get_hourly_readings_columns(request.stations)
+        # The readings are already json ready, so we skip validating them against the response model.
+        return JSONResponse({'hourlies': readings})
+    except Exception as exception:
+        LOGGER.critical(exception, exc_info=True)
+        raise
+
+
+@app.post('/hourlies/stream/')
+async def get_hourlies_stream(request: schemas.StationCodeList, _: bool = Depends(authenticate)):
+    """ Returns hourlies for the last 5 days, for the specified weather stations, as newline delimited
+    json. Each line holds the readings for one station (or the reason they could not be retrieved),
+    in the order in which they become available. """
+    LOGGER.info('/hourlies/stream/')
+
+    async def generate_lines():
+        try:
+            async for readings in wildfire_one.stream_hourly_readings(request.stations):
+                yield readings.json() + '\n'
+        except Exception as exception:
+            LOGGER.critical(exception, exc_info=True)
+            raise
+
+    return StreamingResponse(generate_lines(), media_type='application/x-ndjson')
+
+
 @app.get('/stations/', response_model=schemas.WeatherStationsResponse)
 async def get_stations():
     """ Return a list of fire weather stations.
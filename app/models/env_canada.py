@@ -3,19 +3,32 @@ TODO: Move this file to app/models/ (not part of this PR as it makes comparing p
       there are so many changes, it's picked up as a delete instead of a move.)
 """
 
+import io
 import os
 import sys
 import json
+import hashlib
 import datetime
 import logging
 import logging.config
 import time
+import queue
 import tempfile
+import threading
+import collections
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from sqlalchemy.dialects.postgresql import insert
 import app.db.database
-from app.db.crud import get_processed_file_record
+from app import config
+from app.db.crud import get_processed_file_urls
 from app.db.models import ProcessedModelRunUrl
-from app.models.process_grib import GribFileProcessor, ModelRunInfo
+from app.models.process_grib import GribFileProcessor, ModelRunInfo, extract_station_data, vsimem_file
 
 
 # If running as it's own process, configure loggin appropriately.
@@ -28,6 +41,10 @@ if __name__ == "__main__":
 
 logger = logging.getLogger(__name__)
 
+# Server errors are worth retrying. Anything else, in particular a 404 for a prediction hour that hasn't
+# been published yet, fails fast.
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
 
 class UnhandledPredictionModelType(Exception):
     """ Exception raised when an unknown model type is encountered. """
@@ -120,9 +137,137 @@ def get_download_urls():
                 yield url, filename
 
 
-def download(url: str, path: str) -> str:
+def create_http_session() -> requests.Session:
+    """ Create a requests session to download with. The session re-uses connections, limits the number of
+    connections to each host (blocking until one is free), and retries server errors with exponential
+    backoff.
+    """
+    retry = Retry(total=int(config.get('ENV_CANADA_DOWNLOAD_RETRIES', 3)),
+                  backoff_factor=float(config.get('ENV_CANADA_DOWNLOAD_BACKOFF', 0.5)),
+                  status_forcelist=RETRY_STATUS_CODES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=int(config.get('ENV_CANADA_MAX_CONNECTIONS_PER_HOST', 8)),
+                          pool_block=True,
+                          max_retries=retry)
+    http_session = requests.Session()
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    return http_session
+
+
+class DownloadChecksumMismatch(Exception):
+    """ Exception raised when a downloaded file doesn't match its expected checksum. """
+
+
+class DownloadIncomplete(Exception):
+    """ Exception raised when the connection closes before the whole file has been received. """
+
+
+# Errors part way through a download, after which we can pick up where we left off.
+RESUMABLE_ERRORS = (DownloadIncomplete,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)
+
+
+def _get_expected_size(response: requests.Response):
+    """ The size of the complete file, if the server told us. """
+    if response.status_code == 206:
+        # e.g. Content-Range: bytes 5000-16383/16384
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length', '')
+    return int(length) if length.isdigit() else None
+
+
+def _update_hash(hasher, file_object, chunk_size: int):
+    """ Add what's been written to a file so far to a hash, in chunks """
+    file_object.seek(0)
+    for chunk in iter(lambda: file_object.read(chunk_size), b''):
+        hasher.update(chunk)
+
+
+def _write_response(response: requests.Response, file_object, hasher, chunk_size: int):
+    """ Stream the body of a response into a file, in chunks. A partial response (206) is appended to
+    what we already have, anything else replaces it. """
+    if response.status_code == 206:
+        if hasher:
+            _update_hash(hasher, file_object, chunk_size)
+        file_object.seek(0, io.SEEK_END)
+    else:
+        file_object.seek(0)
+        file_object.truncate()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        file_object.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+
+
+def _download_to(http_session: requests.Session, url: str, open_file) -> tuple:
+    """ Download a file, resuming with a Range request if the connection drops part way through.
+    The file is written to open_file(expected size), which is called once we know how large the file is.
+    Returns the file written to (None if it wasn't found, in which case anything written so far is
+    discarded), and its hash (None if we're not calculating checksums).
+    """
+    # It's important to have a timeout on the get, otherwise the call may get stuck for an indefinite
+    # amount of time - there is no default value for timeout. The connect timeout applies to establishing
+    # a connection, the read timeout to waiting for the next chunk of data.
+    timeout = (float(config.get('ENV_CANADA_CONNECT_TIMEOUT', 5)),
+               float(config.get('ENV_CANADA_READ_TIMEOUT', 60)))
+    chunk_size = int(config.get('ENV_CANADA_DOWNLOAD_CHUNK_SIZE', 64 * 1024))
+    algorithm = config.get('ENV_CANADA_DOWNLOAD_CHECKSUM', '')
+    resumes = int(config.get('ENV_CANADA_DOWNLOAD_RESUMES', 3))
+    file_object = None
+    attempt = 0
+    while True:
+        offset = file_object.seek(0, io.SEEK_END) if file_object else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+        hasher = hashlib.new(algorithm) if algorithm else None
+        try:
+            with http_session.get(url, headers=headers, timeout=timeout, stream=True) as response:
+                if response.status_code == 404:
+                    # We expect this to happen frequently - just log for info.
+                    logger.info('404 error for %s', url)
+                    if file_object:
+                        file_object.close()
+                    return None, None
+                if response.status_code == 416 or (
+                        response.status_code == 206 and not response.headers.get('Content-Range', '')
+                        .startswith('bytes {}-'.format(offset))):
+                    # What we have doesn't fit the file on the server, so we start over. Starting over
+                    # counts as a resume, so a server that keeps answering like this can't keep us here.
+                    if file_object:
+                        file_object.truncate(0)
+                    raise DownloadIncomplete('unable to resume from byte {} (status {}, {})'.format(
+                        offset, response.status_code, response.headers.get('Content-Range')))
+                # Raise an exception for anything else that isn't 200/OK or 206/Partial content.
+                response.raise_for_status()
+                expected_size = _get_expected_size(response)
+                if file_object is None:
+                    file_object = open_file(expected_size)
+                _write_response(response, file_object, hasher, chunk_size)
+            size = file_object.tell()
+            if expected_size is not None and size < expected_size:
+                raise DownloadIncomplete('received {} of {} bytes'.format(size, expected_size))
+            return file_object, hasher
+        except RESUMABLE_ERRORS as exception:
+            attempt += 1
+            if attempt > resumes:
+                if file_object:
+                    file_object.close()
+                raise
+            logger.warning('download of %s interrupted (%s), resuming', url, exception)
+
+
+def download(url: str, path: str, http_session: requests.Session = None, checksum: str = None,
+             in_memory_size: int = 0):
     """
     Download a file from a url.
+    The file is streamed to disk in chunks, so memory use doesn't depend on the size of the file. Files
+    no larger than in_memory_size bytes are kept in memory instead, and their content is returned rather
+    than their location.
+    If ENV_CANADA_DOWNLOAD_CHECKSUM names a hash algorithm (e.g. sha256), the file is hashed as it is
+    downloaded, and compared against checksum if one is given.
     NOTE: was using wget library initially, but has the drawback of not being able to control where the
     temporary files are stored. This is problematic, as giving the application write access to /app
     is a security concern.
@@ -131,94 +276,354 @@ def download(url: str, path: str) -> str:
     filename = os.path.split(url)[-1]
     # Construct target location for downloaded file.
     target = os.path.join(os.getcwd(), path, filename)
-    # Get the file.
-    # It's important to have a timeout on the get, otherwise the call may get stuck for an indefinite
-    # amount of time - there is no default value for timeout. During testing, it was observed that
-    # downloads usually complete in less than a second.
+    # Download into a partial file, which is only moved to the target location once complete.
+    partial = target + '.part'
+
+    def open_file(expected_size: int):
+        if expected_size is not None and expected_size <= in_memory_size:
+            return io.BytesIO()
+        return open(partial, 'w+b')
+
     logger.info('downloading %s', url)
-    response = requests.get(url, timeout=60)
-    # If the response is 200/OK.
-    if response.status_code == 200:
-        # Store the response.
-        with open(target, 'wb') as file_object:
-            # Write the file.
-            file_object.write(response.content)
-    elif response.status_code == 404:
-        # We expect this to happen frequently - just log for info.
-        logger.info('404 error for %s', url)
-        target = None
-    else:
-        # Raise an exception
-        response.raise_for_status()
+    file_object = None
+    try:
+        file_object, hasher = _download_to(http_session or requests, url, open_file)
+        if file_object is None:
+            # The file disappeared part way through, don't keep what we have of it.
+            if os.path.exists(partial):
+                os.remove(partial)
+            return None
+        if hasher:
+            digest = hasher.hexdigest()
+            logger.debug('%s %s: %s', hasher.name, filename, digest)
+            if checksum and checksum.lower() != digest:
+                raise DownloadChecksumMismatch(url, checksum, digest)
+        if isinstance(file_object, io.BytesIO):
+            return file_object.getvalue()
+    except Exception:
+        # Don't leave partial files lying around.
+        if file_object:
+            file_object.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    file_object.close()
+    os.replace(partial, target)
     # Return file location.
     return target
 
 
-def flag_file_as_processed(session, url):
-    """ Flag the file as processed in the database """
-    processed_file = get_processed_file_record(session, url)
-    if processed_file:
-        logger.info('re-procesed %s', url)
-    else:
-        logger.info('file processed %s', url)
-        processed_file = ProcessedModelRunUrl(
-            url=url,
-            create_date=datetime.datetime.now(datetime.timezone.utc))
-    processed_file.update_date = datetime.datetime.now(datetime.timezone.utc)
-    session.add(processed_file)
+def flag_file_as_processed(session, urls: List[str]):
+    """ Flag the files as processed in the database, in a single statement. Files that had already been
+    flagged (i.e. were re-processed) get their update date bumped. """
+    if not urls:
+        return
+    now = datetime.datetime.now(datetime.timezone.utc)
+    table = ProcessedModelRunUrl.__table__  # pylint: disable=no-member
+    statement = insert(table).values([dict(url=url, create_date=now, update_date=now) for url in urls])
+    statement = statement.on_conflict_do_update(
+        index_elements=['url'], set_={'update_date': statement.excluded.update_date})
+    session.execute(statement)
     session.commit()
+    logger.info('%d files flagged as processed', len(urls))
+
+
+class StageMetrics():
+    """ Keep track of how many files a pipeline stage handled (and how many made it through), and how
+    long its workers were busy. """
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.count = 0
+        self.completed = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, files: int = 1):
+        """ Measure the handling of one file (or of several files at once) """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.count += files
+                self.busy += time.perf_counter() - start
+
+    def complete(self, files: int = 1):
+        """ Count files that made it through the stage """
+        with self._lock:
+            self.completed += files
+
+    def report(self, elapsed: float):
+        """ Log the throughput of the stage """
+        logger.info('%s: %d files (%d completed), %.2f files/second, %.0f%% busy (%d workers)',
+                    self.name, self.count, self.completed, self.count / elapsed if elapsed else 0,
+                    100 * self.busy / (elapsed * self.workers) if elapsed else 0, self.workers)
+
+
+class StageQueue(queue.Queue):
+    """ A bounded queue between pipeline stages, that keeps track of the most files it held. """
+
+    def __init__(self, name: str, maxsize: int):
+        super().__init__(maxsize)
+        self.name = name
+        self.max_depth = 0
+
+    def _put(self, item):
+        super()._put(item)
+        self.max_depth = max(self.max_depth, len(self.queue))
+
+    def report(self):
+        """ Log the depth of the queue """
+        logger.info('%s queue: %d of %d, at most %d', self.name, self.qsize(), self.maxsize, self.max_depth)
+
+
+class PipelineStages():
+    """ The queues between the stages of the ingest pipeline, the slots that limit how many files are
+    on disk, and the metrics of each stage. """
+
+    def __init__(self, download_workers: int, extract_workers: int, max_files_on_disk: int,
+                 write_queue_size: int):
+        self.disk_slots = threading.BoundedSemaphore(max_files_on_disk)
+        self.extract_queue = StageQueue('extract', max_files_on_disk)
+        self.write_queue = StageQueue('write', write_queue_size)
+        self.download = StageMetrics('download', download_workers)
+        self.extract = StageMetrics('extract', extract_workers)
+        self.write = StageMetrics('write', 1)
+
+    def report(self, elapsed: float):
+        """ Log the throughput of each stage, and the depth of each queue """
+        for metrics in (self.download, self.extract, self.write):
+            metrics.report(elapsed)
+        for stage_queue in (self.extract_queue, self.write_queue):
+            stage_queue.report()
+
+
+_EXTRACT_WORKER_STATIONS = []
+
+
+def _init_extract_worker(stations: List[dict]):
+    """ Hold on to the list of stations in the extraction process """
+    _EXTRACT_WORKER_STATIONS.extend(stations)
+
+
+def _extract_in_worker(url: str, downloaded, model_info: ModelRunInfo):
+    """ Extract the station data from a grib file (its location, or its content), in an extraction
+    process """
+    if isinstance(downloaded, bytes):
+        with vsimem_file(os.path.split(url)[-1], downloaded) as filename:
+            return extract_station_data(filename, _EXTRACT_WORKER_STATIONS, model_info)
+    return extract_station_data(downloaded, _EXTRACT_WORKER_STATIONS, model_info)
+
+
+class IngestPipeline():
+    """ Download, extract and store grib files in stages, with bounded queues in between:
+
+    download (thread pool) -> extract (process pool, as GDAL work is CPU bound) -> write (single thread)
+
+    Stages block when the queue after them is full, and files wait on a limited number of slots before
+    being downloaded, so at most ENV_CANADA_MAX_FILES_ON_DISK files are on disk (or in memory) at any time.
+    Files no larger than ENV_CANADA_IN_MEMORY_MAX_SIZE bytes never touch the disk, they're handed to GDAL
+    in memory.
+    Unless ENV_CANADA_COMBINE_VARIABLES is False, the files of each variable (e.g. TMP_TGL_2 and RH_TGL_2)
+    for the same model run and prediction hour are written together, so each row is written once.
+    """
+
+    def __init__(self, processor: GribFileProcessor, path: str):
+        self.processor = processor
+        self.path = path
+        self.stages = PipelineStages(
+            download_workers=int(config.get('ENV_CANADA_DOWNLOAD_WORKERS', 8)),
+            extract_workers=int(config.get('ENV_CANADA_EXTRACT_WORKERS', os.cpu_count() or 1)),
+            max_files_on_disk=int(config.get('ENV_CANADA_MAX_FILES_ON_DISK', 8)),
+            write_queue_size=int(config.get('ENV_CANADA_WRITE_QUEUE_SIZE', 8)))
+        self.ledger_batch_size = int(config.get('ENV_CANADA_LEDGER_BATCH_SIZE', 20))
+        self.combine_variables = config.get('ENV_CANADA_COMBINE_VARIABLES', 'True') == 'True'
+        # Files that have been stored, but not yet flagged as processed.
+        self.processed_urls = []
+        self.exception_count = 0
+
+    @property
+    def files_downloaded(self) -> int:
+        """ The number of files downloaded """
+        return self.stages.download.completed
+
+    @property
+    def files_processed(self) -> int:
+        """ The number of files stored """
+        return self.stages.write.completed
+
+    def _download(self, http_session: requests.Session, url: str, model_info: ModelRunInfo):
+        """ Download stage: download the file, and pass it on to be extracted. """
+        in_memory_size = int(config.get('ENV_CANADA_IN_MEMORY_MAX_SIZE', 32 * 1024 * 1024))
+        self.stages.disk_slots.acquire()
+        try:
+            with self.stages.download.measure():
+                downloaded = download(url, self.path, http_session, in_memory_size=in_memory_size)
+        # pylint: disable=broad-except
+        except Exception as exception:
+            self.stages.disk_slots.release()
+            self.stages.write_queue.put((url, model_info, None, exception))
+            return
+        if downloaded:
+            self.stages.download.complete()
+            self.stages.extract_queue.put((url, model_info, downloaded))
+        else:
+            # Nothing to do for this file.
+            self.stages.disk_slots.release()
+            self.stages.write_queue.put((url, model_info, None, None))
+
+    def _extract(self, extract_pool: ProcessPoolExecutor):
+        """ Extract stage: extract the station data from downloaded files, and pass it on to be written. """
+        for url, model_info, downloaded in iter(self.stages.extract_queue.get, None):
+            try:
+                with self.stages.extract.measure():
+                    station_data = extract_pool.submit(
+                        _extract_in_worker, url, downloaded, model_info).result()
+                self.stages.extract.complete()
+                self.stages.write_queue.put((url, model_info, station_data, None))
+            # pylint: disable=broad-except
+            except Exception as exception:
+                self.stages.write_queue.put((url, model_info, None, exception))
+            finally:
+                # delete the file when done. A file we can't delete mustn't hold on to its slot, or the
+                # downloads (and so the whole pipeline) would wait on it forever.
+                try:
+                    if not isinstance(downloaded, bytes):
+                        os.remove(downloaded)
+                except OSError as exception:
+                    logger.error('unable to remove %s', downloaded, exc_info=exception)
+                finally:
+                    self.stages.disk_slots.release()
+
+    def _prediction_key(self, model_info: ModelRunInfo) -> tuple:
+        """ The files with the same key are written together """
+        key = (model_info.model_abbreviation, model_info.projection, model_info.model_run_timestamp,
+               model_info.prediction_timestamp)
+        return key if self.combine_variables else key + (model_info.variable_name,)
+
+    def _write(self, session, files: List[tuple]):
+        """ Write stage: store the station data of (url, model info, station data) files for the same
+        prediction, and flag the files as processed. """
+        with self.stages.write.measure(len(files)):
+            # Files of the same model share a grid, but don't count on it.
+            values_by_geotransform = {}
+            for _, model_info, (geotransform, station_values) in files:
+                values_by_geotransform.setdefault(geotransform, {})[model_info.variable_name] = station_values
+            for geotransform, values_by_variable in values_by_geotransform.items():
+                self.processor.store_variables(geotransform, values_by_variable, files[0][1])
+            self.stages.write.complete(len(files))
+            self.processed_urls.extend(url for url, _, _ in files)
+            if len(self.processed_urls) >= self.ledger_batch_size:
+                self._flag_processed(session)
+
+    def _log_exception(self, urls: List[str], exception: Exception):
+        """ Count and log an exception.
+        We catch and log exceptions, but keep trying to download. We intentionally catch a broad exception,
+        as we want to try and download as much as we can.
+        """
+        self.exception_count += 1
+        logger.error('unexpected exception processing %s', ', '.join(urls), exc_info=exception)
+
+    def _flag_processed(self, session):
+        """ Flag the files that have been stored as processed.
+        NOTE: Should the run fail before a file is flagged, it's simply processed again on the next run.
+        """
+        if self.processed_urls:
+            urls, self.processed_urls = self.processed_urls, []
+            flag_file_as_processed(session, urls)
+
+    def run(self, session, urls: List[tuple]):
+        """ Download, extract and store each of the (url, model info) pairs. """
+        start_time = time.perf_counter()
+        download_workers = self.stages.download.workers
+        extract_workers = self.stages.extract.workers
+        # Extraction processes are spawned, rather than forked: forking a process that has running threads
+        # (e.g. the download threads) isn't safe, and when the processes are started is up to the pool.
+        with ProcessPoolExecutor(max_workers=extract_workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_extract_worker,
+                                 initargs=(self.processor.stations,)) as extract_pool:
+            extract_threads = [threading.Thread(target=self._extract, args=(extract_pool,), daemon=True)
+                               for _ in range(extract_workers)]
+            for thread in extract_threads:
+                thread.start()
+            with create_http_session() as http_session, \
+                    ThreadPoolExecutor(max_workers=download_workers) as download_pool:
+                for url, model_info in urls:
+                    download_pool.submit(self._download, http_session, url, model_info)
+
+                # Every file ends up in the write queue, whether it was extracted, not found or failed. Files
+                # for the same prediction are written once the last of them comes through.
+                remaining = collections.Counter(self._prediction_key(model_info) for _, model_info in urls)
+                extracted = collections.defaultdict(list)
+                for _ in range(len(urls)):
+                    url, model_info, station_data, exception = self.stages.write_queue.get()
+                    key = self._prediction_key(model_info)
+                    if station_data is not None:
+                        extracted[key].append((url, model_info, station_data))
+                    if exception is not None:
+                        self._log_exception([url], exception)
+                    remaining[key] -= 1
+                    if remaining[key] == 0 and key in extracted:
+                        files = extracted.pop(key)
+                        try:
+                            self._write(session, files)
+                        # pylint: disable=broad-except
+                        except Exception as write_exception:
+                            self._log_exception([url for url, _, _ in files], write_exception)
+                    logger.debug('queue depths: extract %d, write %d',
+                                 self.stages.extract_queue.qsize(), self.stages.write_queue.qsize())
+                try:
+                    self._flag_processed(session)
+                # pylint: disable=broad-except
+                except Exception as exception:
+                    self.exception_count += 1
+                    logger.error('unexpected exception flagging files as processed', exc_info=exception)
+            for _ in extract_threads:
+                self.stages.extract_queue.put(None)
+            for thread in extract_threads:
+                thread.join()
+        self.stages.report(time.perf_counter() - start_time)
 
 
 def main():
     """ main script """
     start_time = time.time()
     session = app.db.database.get_session()
-    files_downloaded = 0
-    files_processed = 0
     exception_count = 0
-    urls = get_download_urls()
+    urls = list(get_download_urls())
     processor = GribFileProcessor()
-    with tempfile.TemporaryDirectory() as gdps_path:
+    # check the database for a record of these files, in one go:
+    processed_urls = get_processed_file_urls(session, [url for url, _ in urls])
+    unprocessed = []
+    for url, filename in urls:
+        try:
+            if url in processed_urls:
+                # This file has already been processed - so we skip it.
+                logger.info('file aready processed %s', url)
+            else:
+                # extract model info from filename:
+                unprocessed.append((url, parse_env_canada_filename(filename)))
+        # pylint: disable=broad-except
+        except Exception as exception:
+            exception_count += 1
+            logger.error('unexpected exception processing %s',
+                         url, exc_info=exception)
 
-        for url, filename in urls:
-            try:
-                # check the database for a record of this file:
-                processed_file_record = get_processed_file_record(session, url)
-                if processed_file_record:
-                    # This file has already been processed - so we skip it.
-                    logger.info('file aready processed %s', url)
-                else:
-                    # extract model info from filename:
-                    model_info = parse_env_canada_filename(filename)
-                    # download the file:
-                    downloaded = download(url, gdps_path)
-                    if downloaded:
-                        files_downloaded += 1
-                        # If we've downloaded the file ok, we can now process it.
-                        try:
-                            processor.process_grib_file(downloaded, model_info)
-                            # Flag the file as processed
-                            flag_file_as_processed(session, url)
-                            files_processed += 1
-                        finally:
-                            # delete the file when done.
-                            os.remove(downloaded)
-            # pylint: disable=broad-except
-            except Exception as exception:
-                exception_count += 1
-                # We catch and log exceptions, but keep trying to download.
-                # We intentionally catch a broad exception, as we want to try and download as much
-                # as we can.
-                logger.error('unexpected exception processing %s',
-                             url, exc_info=exception)
+    with tempfile.TemporaryDirectory() as gdps_path:
+        pipeline = IngestPipeline(processor, gdps_path)
+        pipeline.run(session, unprocessed)
+    exception_count += pipeline.exception_count
 
     execution_time = round(time.time() - start_time, 1)
     logger.info('%d downloaded, %d processed in total, took %s seconds',
-                files_downloaded, files_processed, execution_time)
+                pipeline.files_downloaded, pipeline.files_processed, execution_time)
     if exception_count > 0:
         logger.warning('completed processing with some exceptions')
         sys.exit(os.EX_SOFTWARE)
-    return files_processed
+    return pipeline.files_processed
 
 
 if __name__ == "__main__":
@@ -1,15 +1,23 @@
 """ Read a grib file, and store values relevant to weather stations in database.
 """
 
+import os
+import json
 import math
+import uuid
 import struct
+import hashlib
 import logging
 import logging.config
-from typing import List
-from sqlalchemy.dialects.postgresql import array
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+import numpy
+from sqlalchemy.dialects.postgresql import insert
 import sqlalchemy.exc
 import gdal
 import app.db.database
+from app import config
 from app.wildfire_one import _get_stations_local
 from app.db.models import (
     PredictionModel, PredictionModelRunTimestamp, ModelRunGridSubsetPrediction)
@@ -64,6 +72,29 @@ def get_surrounding_grid(
     return points, values
 
 
+def get_surrounding_grids(band: gdal.Band, x_indices: numpy.ndarray, y_indices: numpy.ndarray):
+    """ Get the grid and values surrounding each of the given raster coordinates (see
+    get_surrounding_grid), with a single read of the window that covers them all.
+    Returns the points, and the values, of each grid.
+    """
+    x_offset = int(x_indices.min())
+    y_offset = int(y_indices.min())
+    # The window includes the point to the right of, and below, the right- and bottom-most coordinates.
+    window = band.ReadAsArray(xoff=x_offset, yoff=y_offset,
+                              win_xsize=int(x_indices.max()) - x_offset + 2,
+                              win_ysize=int(y_indices.max()) - y_offset + 2,
+                              buf_type=gdal.GDT_Float32).astype(numpy.float32, copy=False)
+    column = x_indices - x_offset
+    row = y_indices - y_offset
+    # Vertices, and their values, are ordered clockwise.
+    values = numpy.stack((window[row, column], window[row, column + 1],
+                          window[row + 1, column + 1], window[row + 1, column]), axis=1)
+    points = numpy.stack(((x_indices, y_indices), (x_indices + 1, y_indices),
+                          (x_indices + 1, y_indices + 1), (x_indices, y_indices + 1)), axis=1)
+    # (coordinate, point, station) -> (station, point, coordinate)
+    return points.transpose(2, 1, 0).tolist(), values.tolist()
+
+
 def calculate_raster_coordinate(longitude: float, latitude: float, origin: List[int], pixel: List[int]):
     """ From a given longitude and latitude, calculate the raster coordinate corresponding to the
     top left point of the grid surrounding the given geographic coordinate.
@@ -87,6 +118,18 @@ def open_grib(filename: str) -> gdal.Dataset:
     return gdal.Open(filename, gdal.GA_ReadOnly)
 
 
+@contextmanager
+def vsimem_file(name: str, content: bytes):
+    """ Hand the content of a file to GDAL as an in-memory (/vsimem/) file, yielding its filename, and
+    removing it when done. """
+    filename = '/vsimem/{}/{}'.format(uuid.uuid4().hex, name)
+    gdal.FileFromMemBuffer(filename, content)
+    try:
+        yield filename
+    finally:
+        gdal.Unlink(filename)
+
+
 def get_dataset_geometry(dataset: gdal.Dataset) -> (List[int], List[int]):
     """ Get the geometry info (origin and pixel size) of the dataset.
     """
@@ -98,6 +141,137 @@ def get_dataset_geometry(dataset: gdal.Dataset) -> (List[int], List[int]):
     return origin, pixel
 
 
+def yield_data_for_stations(stations: List[dict], raster_band, origin: List[float], pixel: List[float]):
+    """ Given a list of stations, and a gdal raster band, yield relevant data
+    """
+    if not stations:
+        return
+    coordinates = numpy.array([calculate_raster_coordinate(float(station['long']), float(station['lat']),
+                                                           origin, pixel) for station in stations])
+    # Stations often share a grid cell, so we only read each cell once. And rather than reading the grid
+    # around each cell separately, we read one window around all of them.
+    cells, station_cells = numpy.unique(coordinates, axis=0, return_inverse=True)
+    points, values = get_surrounding_grids(raster_band, cells[:, 0], cells[:, 1])
+    for cell in station_cells:
+        yield points[cell], values[cell]
+
+
+def _hash(value) -> str:
+    """ A short hash of a json serializable value """
+    return hashlib.sha256(json.dumps(value).encode('utf-8')).hexdigest()[:16]
+
+
+class StationGridIndex():
+    """ Where each of a list of stations falls on the grid of a model. Stations often share a grid cell,
+    so the index holds each distinct cell once: the raster coordinate of its top left corner, and the
+    geographic coordinates of its corners (see get_surrounding_grid for the order). Along with the cell
+    that each station falls in.
+    """
+
+    def __init__(self, key: str, raster_coordinates: List[Tuple[int, int]], geographic_points: List[list],
+                 station_cells: List[int]):
+        self.key = key
+        raster_coordinates = numpy.array(raster_coordinates, dtype=numpy.int64).reshape(-1, 2)
+        self.x_indices = raster_coordinates[:, 0]
+        self.y_indices = raster_coordinates[:, 1]
+        self.geographic_points = geographic_points
+        self.station_cells = station_cells
+        # The grid subset of each cell. Grid subsets live in the database, so they're looked up by the
+        # process that writes to the database, and not persisted with the rest of the index.
+        self.grid_subset_ids = None
+
+    @classmethod
+    def build(cls, key: str, stations: List[dict], geotransform: tuple):
+        """ Calculate the index for the stations on a grid with the given geotransform """
+        origin, pixel = (geotransform[0], geotransform[3]), (geotransform[1], geotransform[5])
+        cells = {}
+        station_cells = []
+        for station in stations:
+            cell = calculate_raster_coordinate(float(station['long']), float(station['lat']), origin, pixel)
+            station_cells.append(cells.setdefault(cell, len(cells)))
+        raster_coordinates = list(cells)
+        geographic_points = []
+        for x_index, y_index in raster_coordinates:
+            points = [[x_index, y_index], [x_index+1, y_index],
+                      [x_index+1, y_index+1], [x_index, y_index+1]]
+            geographic_points.append(
+                [calculate_geographic_coordinate(point, origin, pixel) for point in points])
+        return cls(key, raster_coordinates, geographic_points, station_cells)
+
+    @classmethod
+    def load(cls, filename: str):
+        """ Load an index from a json file """
+        with open(filename) as file_object:
+            index = json.load(file_object)
+        return cls(index['key'], list(zip(index['x_indices'], index['y_indices'])),
+                   [[tuple(point) for point in points] for points in index['geographic_points']],
+                   index['station_cells'])
+
+    def save(self, filename: str):
+        """ Save the index to a json file. The file is written under a temporary name and then moved into
+        place, so other processes never see half an index. """
+        partial = '{}.{}'.format(filename, uuid.uuid4().hex)
+        with open(partial, 'w') as file_object:
+            json.dump({'key': self.key,
+                       'x_indices': self.x_indices.tolist(),
+                       'y_indices': self.y_indices.tolist(),
+                       'geographic_points': self.geographic_points,
+                       'station_cells': self.station_cells}, file_object)
+        os.replace(partial, filename)
+
+
+# Station grid indexes that have been loaded or built by this process, by key.
+_STATION_GRID_INDEXES = {}
+
+
+def get_station_grid_index(grib_info: ModelRunInfo, geotransform: tuple,
+                           stations: List[dict]) -> StationGridIndex:
+    """ Get the index of the stations on a model's grid.
+    The grid of a model doesn't change from one file to the next, so rather than calculating where each
+    station is for each file, the index is calculated once and then kept in memory, as well as on disk in
+    ENV_CANADA_GRID_INDEX_PATH (unless that's empty). Indexes are keyed by model, projection, and hashes of
+    the geotransform and station list, so a new one is built when either changes.
+    """
+    key = '{}_{}_{}_{}'.format(
+        grib_info.model_abbreviation, grib_info.projection, _hash(list(geotransform)),
+        _hash([[station['code'], station['lat'], station['long']] for station in stations]))
+    index = _STATION_GRID_INDEXES.get(key)
+    if index is not None:
+        return index
+    path = config.get('ENV_CANADA_GRID_INDEX_PATH',
+                      os.path.join(tempfile.gettempdir(), 'station_grid_indexes'))
+    filename = os.path.join(path, '{}.json'.format(key)) if path else None
+    try:
+        index = StationGridIndex.load(filename) if filename and os.path.exists(filename) else None
+    except (OSError, ValueError, KeyError) as exception:
+        logger.warning('unable to load station grid index %s, rebuilding it', filename, exc_info=exception)
+    if index is None:
+        logger.info('building station grid index %s', key)
+        index = StationGridIndex.build(key, stations, geotransform)
+        if filename:
+            os.makedirs(path, exist_ok=True)
+            index.save(filename)
+    logger.info('%d stations in %d grid cells (%.2f stations per cell)', len(index.station_cells),
+                len(index.geographic_points), len(index.station_cells) / max(len(index.geographic_points), 1))
+    _STATION_GRID_INDEXES[key] = index
+    return index
+
+
+def extract_station_data(filename: str, stations: List[dict], grib_info: ModelRunInfo):
+    """ Read the values of the grid surrounding the stations from a grib file, returning the geotransform of
+    the dataset, along with the values for each grid cell in the station grid index (see
+    get_station_grid_index).
+    This doesn't touch the database, so it can be run in another process.
+    """
+    dataset = open_grib(filename)
+    geotransform = dataset.GetGeoTransform()
+    if not stations:
+        return geotransform, []
+    index = get_station_grid_index(grib_info, geotransform, stations)
+    _, values = get_surrounding_grids(dataset.GetRasterBand(1), index.x_indices, index.y_indices)
+    return geotransform, values
+
+
 class GribFileProcessor():
     """ Instances of this object can be used to process and ingest a grib file.
     """
@@ -123,57 +297,52 @@ class GribFileProcessor():
     def yield_data_for_stations(self, raster_band):
         """ Given a list of stations, and a gdal dataset, yield relevant data
         """
-        for station in self.stations:
-            longitude = float(station['long'])
-            latitude = float(station['lat'])
-            x_coordinate, y_coordinate = calculate_raster_coordinate(
-                longitude, latitude, self.origin, self.pixel)
+        return yield_data_for_stations(self.stations, raster_band, self.origin, self.pixel)
 
-            points, values = get_surrounding_grid(
-                raster_band, x_coordinate, y_coordinate)
-
-            yield (points, values)
-
-    def store_bounding_values(self, points, values, preduction_model_run: PredictionModelRunTimestamp,
-                              grib_info: ModelRunInfo):
-        """ Store the values around the area of interest.
+    def get_grid_subset_ids(self, index: StationGridIndex) -> List[int]:
+        """ Get the grid subset, i.e. the relevant bounding area for this particular model, of each grid cell
+        in the index. They're only looked up (or created) the first time they're needed.
+        """
+        if index.grid_subset_ids is None:
+            index.grid_subset_ids = [
+                get_or_create_grid_subset(self.session, self.prediction_model, geographic_points).id
+                for geographic_points in index.geographic_points]
+        return index.grid_subset_ids
+
+    def store_predictions(self, grid_subset_ids: List[int], values_by_variable: Dict[str, List[List[float]]],
+                          prediction_run: PredictionModelRunTimestamp, grib_info: ModelRunInfo):
+        """ Store the values of each grid subset, of each variable (e.g. TMP_TGL_2), with a single upsert
+        for all the grid subsets. Values for grid subsets that already have a prediction for this run and
+        timestamp replace the existing ones, leaving the other variables as they are.
+        """
+        columns = [variable_name.lower() for variable_name in values_by_variable]
+        # Postgres won't upsert a row more than once in the same statement.
+        values_by_grid_subset = dict(zip(grid_subset_ids, zip(*values_by_variable.values())))
+        if not values_by_grid_subset:
+            return
+        table = ModelRunGridSubsetPrediction.__table__  # pylint: disable=no-member
+        # The id sequence is given for every row, otherwise sqlalchemy fetches the next id row by row.
+        statement = insert(table).values([
+            {'id': table.c.id.default.next_value(),
+             'prediction_model_run_timestamp_id': prediction_run.id,
+             'prediction_model_grid_subset_id': grid_subset_id,
+             'prediction_timestamp': grib_info.prediction_timestamp,
+             **dict(zip(columns, values))}
+            for grid_subset_id, values in values_by_grid_subset.items()])
+        statement = statement.on_conflict_do_update(
+            index_elements=['prediction_model_run_timestamp_id', 'prediction_model_grid_subset_id',
+                            'prediction_timestamp'],
+            set_={column: statement.excluded[column] for column in columns})
+        self.session.execute(statement)
+
+    def store_variables(self, geotransform: tuple, values_by_variable: Dict[str, List[List[float]]],
+                        grib_info: ModelRunInfo):
+        """ Store the data extracted from one or more grib files of the same model run and prediction
+        timestamp (see extract_station_data), by variable name. Each row is written once, with every
+        variable set.
         """
-        # Convert points to geographic coordinates:
-        geographic_points = []
-        for point in points:
-            geographic_points.append(
-                calculate_geographic_coordinate(point, self.origin, self.pixel))
-
-        # Get the grid subset, i.e. the relevant bounding area for this particular model.
-        grid_subset = get_or_create_grid_subset(
-            self.session, self.prediction_model, geographic_points)
-
-        # Load the record if it exists.
-        # pylint: disable=no-member
-        prediction = self.session.query(ModelRunGridSubsetPrediction).\
-            filter(
-                ModelRunGridSubsetPrediction.prediction_model_run_timestamp_id == preduction_model_run.id).\
-            filter(ModelRunGridSubsetPrediction.prediction_timestamp == grib_info.prediction_timestamp).\
-            filter(ModelRunGridSubsetPrediction.prediction_model_grid_subset_id ==
-                   grid_subset.id).first()
-        if not prediction:
-            # Record doesn't exist, so we create it.
-            prediction = ModelRunGridSubsetPrediction()
-            prediction.prediction_model_run_timestamp_id = preduction_model_run.id
-            prediction.prediction_timestamp = grib_info.prediction_timestamp
-            prediction.prediction_model_grid_subset_id = grid_subset.id
-
-        setattr(prediction, grib_info.variable_name.lower(), array(values))
-        self.session.add(prediction)
-        self.session.commit()
-
-    def process_grib_file(self, filename, grib_info: ModelRunInfo):
-        """ Process a grib file, extracting and storing relevant information. """
         try:
-            logger.info('processing %s', filename)
-            # Open grib file
-            dataset = open_grib(filename)
-            self.origin, self.pixel = get_dataset_geometry(dataset)
+            self.origin, self.pixel = (geotransform[0], geotransform[3]), (geotransform[1], geotransform[5])
 
             # get the model (.e.g. GPDS/RDPS latlon24x.24):
             self.prediction_model = self.get_prediction_model(grib_info)
@@ -181,12 +350,11 @@ class GribFileProcessor():
             prediction_run = get_or_create_prediction_run(
                 self.session, self.prediction_model, grib_info.model_run_timestamp)
 
-            raster_band = dataset.GetRasterBand(1)
-
-            # Iterate through stations:
-            for (points, values) in self.yield_data_for_stations(raster_band):
-                self.store_bounding_values(
-                    points, values, prediction_run, grib_info)
+            index = get_station_grid_index(grib_info, geotransform, self.stations)
+            # All the values are stored in one transaction.
+            self.store_predictions(self.get_grid_subset_ids(index), values_by_variable, prediction_run,
+                                   grib_info)
+            self.session.commit()
         except sqlalchemy.exc.OperationalError:
             # Sometimes this exception is thrown with a "server closed the connection unexpectedly" error.
             # This could happen due to the connection being closed.
@@ -198,3 +366,14 @@ class GribFileProcessor():
                 raise DatabaseException('Database disconnection')
             # Re-throw the exception.
             raise
+
+    def store_station_data(self, geotransform: tuple, station_values: List[List[float]],
+                           grib_info: ModelRunInfo):
+        """ Store the data extracted from a grib file (see extract_station_data). """
+        self.store_variables(geotransform, {grib_info.variable_name: station_values}, grib_info)
+
+    def process_grib_file(self, filename, grib_info: ModelRunInfo):
+        """ Process a grib file, extracting and storing relevant information. """
+        logger.info('processing %s', filename)
+        geotransform, station_values = extract_station_data(filename, self.stations, grib_info)
+        self.store_station_data(geotransform, station_values, grib_info)
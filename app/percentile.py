@@ -2,57 +2,397 @@
 """
 
 import os
+import re
+import json
+import time
+import struct
+import zipfile
 import logging
-from statistics import mean
+from typing import List, Dict, Tuple
+import numpy as np
+from pydantic import ValidationError
 from fastapi import HTTPException, status
 from app import schemas
 
 logger = logging.getLogger(__name__)
 
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data')
+# Generated by scripts/calculate_percentile_offline.py
+PACKED_FILENAME = 'percentiles.npz'
+SKETCHES_FILENAME = 'percentile_sketches.npz'
+# Calculated percentiles are rounded to match the pre-calculated ones.
+NUMBER_OF_DECIMAL_POINT = 5
 
-def get_precalculated_percentiles(request: schemas.PercentileRequest):
-    """ Return the pre calculated percentile response
+
+def _years_from_bitmask(bitmask: int, base_year: int) -> List[int]:
+    """ Return the years in the bitmask, where bit n set means base_year + n. """
+    return [base_year + bit for bit in range(bitmask.bit_length()) if bitmask >> bit & 1]
+
+
+def _to_float(value: float) -> float:
+    """ Return the value as a float, or None if it's NaN. """
+    return None if np.isnan(value) else float(value)
+
+
+def _has_values(ffmc: np.ndarray, isi: np.ndarray, bui: np.ndarray) -> np.ndarray:
+    """ Return a mask of the stations that count towards the mean, i.e. those with a (non zero) value for
+    all of ffmc, isi and bui. """
+    return np.all(np.nan_to_num(np.stack([ffmc, isi, bui])) != 0, axis=0)
+
+
+class PercentileRange():
+    """ The pre-calculated percentiles for all stations, for one year range.
+
+    Values are held in arrays (which may be memory mapped) with one element per station, keyed by
+    index (ffmc, isi and bui). Stations that aren't in the range are None.
     """
-    # NOTE: percentile is ignored, all responses overridden to match
-    # pre-calculated values; 90th percentile
+
+    def __init__(self, stations: List[schemas.WeatherStation], values: Dict[str, np.ndarray],
+                 years: np.ndarray, base_year: int):
+        """ Initialize object """
+        self.stations = stations
+        self.index = {station.code: row for row, station in enumerate(stations) if station is not None}
+        # Missing values are stored as NaN.
+        self.values = values
+        # Years with data, as a bitmask (see _years_from_bitmask).
+        self.years = years
+        self.base_year = base_year
+        self.has_values = _has_values(values['ffmc'], values['isi'], values['bui'])
+        self._summaries = {}
+
+    @property
+    def nbytes(self) -> int:
+        """ Bytes held in the range's arrays. """
+        arrays = list(self.values.values()) + ([] if self.years is None else [self.years])
+        return sum(array.nbytes for array in arrays)
+
+    @classmethod
+    def from_summaries(cls, summaries: List[schemas.StationSummary]) -> 'PercentileRange':
+        """ Create a year range from a list of station summaries. """
+        years = [year for summary in summaries for year in summary.years]
+        base_year = min(years) if years else 0
+        values = {key: np.array([getattr(summary, key) for summary in summaries], dtype=np.float64)
+                  for key in ('ffmc', 'isi', 'bui')}
+        range_ = cls(stations=[summary.station for summary in summaries], values=values,
+                     years=None, base_year=base_year)
+        # We already have the summaries, so there's no need for the bitmask.
+        range_._summaries = dict(enumerate(summaries))  # pylint: disable=protected-access
+        return range_
+
+    def get_summary(self, row: int) -> schemas.StationSummary:
+        """ Return the station summary for a row. """
+        summary = self._summaries.get(row)
+        if summary is None:
+            # Everything has already been validated, so there's no need to do it again.
+            summary = schemas.StationSummary.construct(
+                ffmc=_to_float(self.values['ffmc'][row]),
+                isi=_to_float(self.values['isi'][row]),
+                bui=_to_float(self.values['bui'][row]),
+                years=_years_from_bitmask(int(self.years[row]), self.base_year),
+                station=self.stations[row])
+            self._summaries[row] = summary
+        return summary
+
+
+def _mmap_npz(filename: str) -> Dict[str, np.ndarray]:
+    """ Memory map the arrays in an uncompressed .npz file.
+
+    np.load can only memory map .npy files, but a .npz file is just a zip file of .npy files, so
+    if they're stored uncompressed we can map them at their offsets in the zip file.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as npz_file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{} in {} is compressed'.format(info.filename, filename))
+            # Skip over the local file header, to where the .npy file starts.
+            npz_file.seek(info.header_offset)
+            local_header = npz_file.read(30)
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            npz_file.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(npz_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_file)
+            name = info.filename[:-len('.npy')]
+            if int(np.prod(shape)) == 0:
+                # Empty arrays can't be memory mapped.
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(npz_file, dtype=dtype, mode='r', shape=shape,
+                                         order='F' if fortran_order else 'C', offset=npz_file.tell())
+    return arrays
+
+
+class PercentileStore():
+    """ The pre-calculated percentiles for all stations and year ranges, loaded once and kept in
+    memory, so that requests don't have to read and validate a file per station.
+
+    Percentiles are memory mapped from the packed file generated by
+    scripts/calculate_percentile_offline.py if there is one, otherwise they're loaded from the json
+    files in the year range folders.
+    """
+
+    def __init__(self, data_path: str = DATA_PATH):
+        """ Initialize object """
+        self.data_path = data_path
+        self.ranges = {}
+        # Seconds taken to load the store.
+        self.load_time = None
+        # Bytes held in the loaded arrays (memory mapped arrays are only paged in as they're read).
+        self.memory_footprint = None
+
+    @staticmethod
+    def _load_range(foldername: str) -> PercentileRange:
+        """ Load the station summaries in a year range folder. """
+        summaries = []
+        for filename in sorted(os.listdir(foldername)):
+            if filename.endswith('.json'):
+                try:
+                    summaries.append(schemas.StationSummary.parse_file(
+                        os.path.join(foldername, filename)))
+                except ValidationError as exception:
+                    # A bad file shouldn't stop us serving all the other stations.
+                    logger.warning('skipping invalid percentile file %s/%s: %s',
+                                   foldername, filename, exception)
+        return PercentileRange.from_summaries(summaries)
+
+    def _load_json(self) -> Dict[Tuple[int, int], PercentileRange]:
+        """ Load all the year range folders in the data folder. """
+        ranges = {}
+        for name in sorted(os.listdir(self.data_path)):
+            match = re.fullmatch(r'(\d{4})-(\d{4})', name)
+            if match:
+                ranges[(int(match.group(1)), int(match.group(2)))] = self._load_range(
+                    os.path.join(self.data_path, name))
+        return ranges
+
+    @staticmethod
+    def _load_packed(filename: str) -> Dict[Tuple[int, int], PercentileRange]:
+        """ Load all the year ranges in the packed file. """
+        arrays = _mmap_npz(filename)
+        stations = []
+        for record in json.loads(arrays['stations'].tobytes().decode('utf-8')):
+            try:
+                stations.append(None if record is None else schemas.WeatherStation(**record))
+            except ValidationError as exception:
+                # A bad station shouldn't stop us serving all the other stations.
+                logger.warning('skipping invalid station in %s: %s', filename, exception)
+                stations.append(None)
+        base_year = int(arrays['base_year'][0])
+        ranges = {}
+        for row, (start, end) in enumerate(arrays['ranges'].tolist()):
+            present = arrays['present'][row]
+            ranges[(start, end)] = PercentileRange(
+                stations=[station if is_present else None
+                          for station, is_present in zip(stations, present.tolist())],
+                values={key: arrays[key][row] for key in ('ffmc', 'isi', 'bui')},
+                years=arrays['years'][row], base_year=base_year)
+        return ranges
+
+    def load(self):
+        """ Load all the year ranges. """
+        start = time.perf_counter()
+        packed_filename = os.path.join(self.data_path, PACKED_FILENAME)
+        if os.path.exists(packed_filename):
+            source = packed_filename
+            self.ranges = self._load_packed(packed_filename)
+        else:
+            source = self.data_path
+            self.ranges = self._load_json()
+        self.load_time = time.perf_counter() - start
+        self.memory_footprint = sum(percentile_range.nbytes for percentile_range in self.ranges.values())
+        logger.info('loaded percentiles for %d year ranges from %s in %.2f seconds (%s bytes)',
+                    len(self.ranges), source, self.load_time, self.memory_footprint)
+
+    def get_range(self, start: int, end: int) -> PercentileRange:
+        """ Return the percentiles for the year range, or None if there are none. """
+        return self.ranges.get((start, end))
+
+
+class PercentileSketches():
+    """ The sorted core fire season values of ffmc, isi and bui for every station and year, from which
+    any percentile over any year range can be calculated.
+
+    Generated by scripts/calculate_percentile_offline.py, the arrays are laid out as follows:
+        stations: json encoded list of station records.
+        station_offsets: entries station_offsets[i]:station_offsets[i + 1] belong to station i.
+        entry_years: the year of each entry, in ascending order for each station. There is an entry
+            for every year a station has data, even if none of it is in the core fire season.
+        <index>_offsets, <index>_values (for each of ffmc, isi and bui): the sorted valid values of
+            entry i are <index>_values[<index>_offsets[i]:<index>_offsets[i + 1]].
+    Since a station's entries are in year order, the values for a year range are contiguous.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        """ Initialize object """
+        self.stations = [schemas.WeatherStation(**record)
+                         for record in json.loads(arrays['stations'].tobytes().decode('utf-8'))]
+        self.index = {station.code: row for row, station in enumerate(self.stations)}
+        self.station_offsets = arrays['station_offsets']
+        self.entry_years = arrays['entry_years']
+        self.offsets = {key: arrays['{}_offsets'.format(key)] for key in ('ffmc', 'isi', 'bui')}
+        self.values = {key: arrays['{}_values'.format(key)] for key in ('ffmc', 'isi', 'bui')}
+
+    def _calculate(self, start: int, end: int, quantile: float) -> Tuple[Dict[str, float], np.ndarray]:
+        """ Calculate the percentile of each index over entries start to end, returning the percentiles,
+        along with a mask of the entries that have any values. """
+        percentiles = {}
+        has_data = np.zeros(end - start, dtype=bool)
+        for key, offsets in self.offsets.items():
+            values = self.values[key][offsets[start]:offsets[end]]
+            if len(values) > 0:
+                percentile = round(np.percentile(values, quantile * 100), NUMBER_OF_DECIMAL_POINT)
+                percentiles[key] = float(percentile)
+            else:
+                percentiles[key] = None
+            has_data |= np.diff(offsets[start:end + 1]) > 0
+        return percentiles, has_data
+
+    def get_summary(self, code: int, start_year: int, end_year: int,
+                    quantile: float) -> schemas.StationSummary:
+        """ Calculate the summary for a station over a year range. """
+        row = self.index[code]
+        first, last = self.station_offsets[row], self.station_offsets[row + 1]
+        years = self.entry_years[first:last]
+        start = first + int(np.searchsorted(years, start_year, side='left'))
+        end = first + int(np.searchsorted(years, end_year, side='right'))
+        if start >= end:
+            # No data at all for the year range (or the year range is empty).
+            return schemas.StationSummary.construct(
+                ffmc=None, isi=None, bui=None, years=list(range(start_year, end_year + 1)),
+                station=self.stations[row])
+        percentiles, has_data = self._calculate(start, end, quantile)
+        return schemas.StationSummary.construct(
+            years=self.entry_years[start:end][has_data].tolist(), station=self.stations[row],
+            **percentiles)
+
+    @classmethod
+    def load(cls, filename: str) -> 'PercentileSketches':
+        """ Load the sketches, memory mapping the values. """
+        start = time.perf_counter()
+        sketches = cls(_mmap_npz(filename))
+        logger.info('loaded percentile sketches for %d stations from %s in %.2f seconds',
+                    len(sketches.stations), filename, time.perf_counter() - start)
+        return sketches
+
+
+_PERCENTILE_STORE = None
+# False until we've looked for sketches, None if there aren't any.
+_PERCENTILE_SKETCHES = False
+
+
+def get_percentile_sketches() -> PercentileSketches:
+    """ Return the percentile sketches, loading them if this is the first time they're needed, or None if
+    they haven't been generated. """
+    global _PERCENTILE_SKETCHES  # pylint: disable=global-statement
+    if _PERCENTILE_SKETCHES is False:
+        filename = os.path.join(DATA_PATH, SKETCHES_FILENAME)
+        _PERCENTILE_SKETCHES = PercentileSketches.load(filename) if os.path.exists(filename) else None
+    return _PERCENTILE_SKETCHES
+
+
+def get_percentile_store() -> PercentileStore:
+    """ Return the percentile store, loading it if this is the first time it's needed. """
+    global _PERCENTILE_STORE  # pylint: disable=global-statement
+    if _PERCENTILE_STORE is None:
+        store = PercentileStore()
+        store.load()
+        _PERCENTILE_STORE = store
+    return _PERCENTILE_STORE
+
+
+def _get_rows(percentile_range: PercentileRange, station_codes: List[int]) -> np.ndarray:
+    """ Return the rows in the range matching the station codes. """
+    try:
+        return np.array([percentile_range.index[code] for code in station_codes], dtype=np.intp)
+    except KeyError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail='Weather station is not found.')
+
+
+def _mean(values: np.ndarray) -> float:
+    """ Return the mean of the values, or None if there aren't any. """
+    return float(np.mean(values)) if len(values) > 0 else None
+
+
+def _calculate_percentiles(sketches: PercentileSketches, request: schemas.PercentileRequest):
+    """ Calculate the percentile response from the percentile sketches. """
+    if not 0 <= request.percentile <= 100:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail='The percentile is not supported.')
+    if request.year_range.start > request.year_range.end:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail='The year range is not supported.')
     year_range_start = request.year_range.start
     year_range_end = request.year_range.end
+    quantile = request.percentile / 100
+
+    response = schemas.CalculatedResponse(
+        percentile=request.percentile,
+        year_range=schemas.YearRange(
+            start=year_range_start, end=year_range_end)
+    )
+    summaries = []
+    for code in request.stations:
+        if code not in sketches.index:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail='Weather station is not found.')
+        summary = sketches.get_summary(code, year_range_start, year_range_end, quantile)
+        response.stations[code] = summary
+        summaries.append(summary)
 
+    values = {key: np.array([getattr(summary, key) for summary in summaries], dtype=np.float64)
+              for key in ('ffmc', 'isi', 'bui')}
+    mask = _has_values(values['ffmc'], values['isi'], values['bui'])
+    response.mean_values = schemas.MeanValues()
+    response.mean_values.bui = _mean(values['bui'][mask])
+    response.mean_values.isi = _mean(values['isi'][mask])
+    response.mean_values.ffmc = _mean(values['ffmc'][mask])
+
+    return response
+
+
+def get_precalculated_percentiles(request: schemas.PercentileRequest):
+    """ Return the pre calculated percentile response
+
+    If percentile sketches have been generated, any percentile over any year range can be calculated,
+    otherwise only the pre-calculated 90th percentiles are available.
+    """
     if len(request.stations) == 0 or request.stations is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail='Weather station is not found.')
 
-    foldername = os.path.join(
-        os.path.dirname(__file__), 'data/{}-{}'.format(year_range_start, year_range_end))
-    logger.info(foldername)
+    sketches = get_percentile_sketches()
+    if sketches is not None:
+        return _calculate_percentiles(sketches, request)
+
+    # NOTE: percentile is ignored, all responses overridden to match
+    # pre-calculated values; 90th percentile
+    year_range_start = request.year_range.start
+    year_range_end = request.year_range.end
+
+    percentile_range = get_percentile_store().get_range(year_range_start, year_range_end)
 
-    if not os.path.exists(foldername):
+    if percentile_range is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail='The year range is not currently supported.')
 
+    rows = _get_rows(percentile_range, request.stations)
+
     response = schemas.CalculatedResponse(
         percentile=90,
         year_range=schemas.YearRange(
             start=year_range_start, end=year_range_end)
     )
+    for code, row in zip(request.stations, rows.tolist()):
+        response.stations[code] = percentile_range.get_summary(row)
 
-    bui = []
-    isi = []
-    ffmc = []
-    for code in request.stations:
-        filename = os.path.join(foldername, '{}.json'.format(code))
-        summary = schemas.StationSummary.parse_file(filename)
-
-        if summary.bui and summary.isi and summary.ffmc:
-            bui.append(summary.bui)
-            isi.append(summary.isi)
-            ffmc.append(summary.ffmc)
-
-        response.stations[code] = summary
-
+    rows = rows[percentile_range.has_values[rows]]
     response.mean_values = schemas.MeanValues()
-    response.mean_values.bui = mean(bui) if bui else None
-    response.mean_values.isi = mean(isi) if isi else None
-    response.mean_values.ffmc = mean(ffmc) if ffmc else None
+    response.mean_values.bui = _mean(percentile_range.values['bui'][rows])
+    response.mean_values.isi = _mean(percentile_range.values['isi'][rows])
+    response.mean_values.ffmc = _mean(percentile_range.values['ffmc'][rows])
 
     return response
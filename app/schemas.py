@@ -1,7 +1,7 @@
 """ This module contains pydandict schemas for the API.
 """
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Optional
 from pydantic import BaseModel
 
 
@@ -85,6 +85,33 @@ class WeatherStationHourlyReadings(BaseModel):
     station: WeatherStation
 
 
+class WeatherReadingColumns(BaseModel):
+    """ Weather readings for a particular station, as one array of values per field. Datetimes are in
+    milliseconds since the epoch. """
+    datetime: List[int]
+    temperature: List[Optional[float]]
+    relative_humidity: List[Optional[float]]
+    wind_speed: List[Optional[float]]
+    wind_direction: List[Optional[float]]
+    barometric_pressure: List[Optional[float]]
+    precipitation: List[Optional[float]]
+    ffmc: List[Optional[float]]
+    isi: List[Optional[float]]
+    fwi: List[Optional[float]]
+
+
+class WeatherStationHourlyColumns(BaseModel):
+    """ The weather readings for a particular station, as columns """
+    values: WeatherReadingColumns
+    station: WeatherStation
+
+
+class WeatherStationHourlyReadingsError(BaseModel):
+    """ Reason the weather readings for a particular station could not be retrieved """
+    station_code: int
+    detail: str
+
+
 class WeatherPredictionModel(BaseModel):
     """ The full name & acronym for a weather prediction model """
     name: str
@@ -142,6 +169,11 @@ class WeatherStationHourlyReadingsResponse(BaseModel):
     hourlies: List[WeatherStationHourlyReadings]
 
 
+class WeatherStationHourlyColumnsResponse(BaseModel):
+    """ Response containing a number of hourly readings, as columns. """
+    hourlies: List[WeatherStationHourlyColumns]
+
+
 class StationCodeList(BaseModel):
     """ List of station codes. """
     stations: List[int]
@@ -52,6 +52,10 @@ class MockResponse:
 
         self.text_response = text_response
         self.json_response = json_response
+        self.status = 200
+
+    def raise_for_status(self):
+        """ Fixture responses are always successful """
 
     async def text(self) -> str:
         """ Return text response """
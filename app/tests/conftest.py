@@ -9,6 +9,7 @@ from alchemy_mock.compat import mock
 from app.tests.common import MockJWTDecode
 from app.db.models import PredictionModel, PredictionModelRunTimestamp
 import app.db.database
+import app.wildfire_one
 
 LOGGER = logging.getLogger(__name__)
 
@@ -60,6 +61,14 @@ def mock_session(monkeypatch):
     monkeypatch.setattr(app.db.database, 'get_session', mock_get_session)
 
 
+@pytest.fixture(autouse=True)
+def clear_wfwx_caches():
+    """ Make sure stations and readings cached by one test don't leak into another. """
+    app.wildfire_one.LOCAL_STATION_CATALOG.clear()
+    app.wildfire_one.REMOTE_STATION_CATALOG.clear()
+    app.wildfire_one.HOURLY_READINGS_CACHE.clear()
+
+
 @pytest.fixture()
 def mock_env_with_use_wfwx(monkeypatch):
     """ Set environment variable USE_WFWX to 'True' """
@@ -1,13 +1,18 @@
 """ Unit tests for app/env_canada.py """
 
 import os
+import hashlib
 import logging
 import datetime
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 import pytest
 import requests
 from alchemy_mock.mocking import UnifiedAlchemyMagicMock
 from alchemy_mock.compat import mock
+from sqlalchemy.dialects import postgresql
 from app.models import env_canada
+from app.models import process_grib
 from app.db.models import PredictionModel, ProcessedModelRunUrl
 import app.db.database
 # pylint: disable=unused-argument, redefined-outer-name
@@ -22,6 +27,23 @@ class MockResponse:
     def __init__(self, status_code, content=None):
         self.status_code = status_code
         self.content = content
+        self.headers = {} if content is None else {'Content-Length': str(len(content))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def iter_content(self, chunk_size):
+        """ Iterate over the content in chunks """
+        for index in range(0, len(self.content), chunk_size):
+            yield self.content[index:index + chunk_size]
+
+    def raise_for_status(self):
+        """ Raise an exception for error status codes """
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(self.status_code)
 
 
 @pytest.fixture()
@@ -56,6 +78,17 @@ def mock_session(monkeypatch):
     monkeypatch.setattr(app.db.database, 'get_session', mock_get_session)
 
 
+@pytest.fixture()
+def mock_processed_files(monkeypatch):
+    """ Mark all files, except one, as already having been processed """
+    unprocessed_url = ('https://dd.weather.gc.ca/model_gem_global/15km/grib2/lat_lon/00/000/'
+                       'CMC_glb_RH_TGL_2_latlon.15x.15_2021020300_P000.grib2')
+
+    def mock_get_processed_file_urls(session, urls):
+        return set(urls) - {unprocessed_url}
+    monkeypatch.setattr(env_canada, 'get_processed_file_urls', mock_get_processed_file_urls)
+
+
 @pytest.fixture()
 def mock_download(monkeypatch):
     """ fixture for env_canada.download """
@@ -67,7 +100,7 @@ def mock_download(monkeypatch):
         with open(filename, 'rb') as file:
             content = file.read()
         return MockResponse(status_code=200, content=content)
-    monkeypatch.setattr(requests, 'get', mock_requests_get)
+    monkeypatch.setattr(requests.Session, 'get', mock_requests_get)
 
 
 @pytest.fixture()
@@ -76,7 +109,7 @@ def mock_download_fail(monkeypatch):
     def mock_requests_get(*args, **kwargs):
         """ mock env_canada download method """
         return MockResponse(status_code=400)
-    monkeypatch.setattr(requests, 'get', mock_requests_get)
+    monkeypatch.setattr(requests.Session, 'get', mock_requests_get)
 
 
 def test_get_download_urls():
@@ -85,8 +118,263 @@ def test_get_download_urls():
     assert len(list(env_canada.get_download_urls())) == total_num_of_urls
 
 
-def test_main(mock_download, mock_session, mock_utcnow):
+def test_main(mock_download, mock_session, mock_processed_files, mock_utcnow):
     """ run main method to see if it runs successfully. """
     # All files, except one, are marked as already having been downloaded, so we expect one file to
     # be processed.
     assert env_canada.main() == 1
+
+
+@pytest.fixture()
+def grib_server():
+    """ Serve a grib file over http, failing with whatever status codes are queued up first, and cutting
+    responses short at whatever lengths are queued up. """
+    requests_received = []
+    status_codes = []
+    truncate_at = []
+    content = bytes(range(256)) * 64
+
+    class Handler(BaseHTTPRequestHandler):
+        """ Request handler for the grib server """
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """ Respond with the next queued status code, or the file. """
+            requests_received.append(dict(self.headers))
+            status_code = status_codes.pop(0) if status_codes else 200
+            body = b''
+            # A queued 206 claims to start somewhere it shouldn't.
+            start = 1
+            if status_code == 200:
+                body = content
+                if 'Range' in self.headers:
+                    status_code = 206
+                    start = int(self.headers['Range'][len('bytes='):-1])
+                    body = content[start:]
+            self.send_response(status_code)
+            self.send_header('Content-Length', str(len(body)))
+            if status_code == 206:
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    start, len(content) - 1, len(content)))
+            self.end_headers()
+            self.wfile.write(body[:truncate_at.pop(0)] if truncate_at else body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            """ Keep the test output quiet """
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield dict(url='http://127.0.0.1:{}/'.format(server.server_port),
+               requests=requests_received,
+               status_codes=status_codes,
+               truncate_at=truncate_at,
+               content=content)
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_retries_server_errors(monkeypatch, grib_server, tmp_path):
+    """ Server errors are retried """
+    monkeypatch.setenv('ENV_CANADA_DOWNLOAD_BACKOFF', '0')
+    grib_server['status_codes'].extend([503, 502])
+    with env_canada.create_http_session() as http_session:
+        target = env_canada.download(grib_server['url'] + 'file.grib2', str(tmp_path), http_session)
+    assert len(grib_server['requests']) == 3
+    with open(target, 'rb') as file_object:
+        assert file_object.read() == grib_server['content']
+
+
+def test_download_not_found(grib_server, tmp_path):
+    """ A 404 (the file hasn't been published yet) is not retried """
+    grib_server['status_codes'].append(404)
+    with env_canada.create_http_session() as http_session:
+        assert env_canada.download(grib_server['url'] + 'file.grib2', str(tmp_path), http_session) is None
+    assert len(grib_server['requests']) == 1
+
+
+def test_download_resumes(monkeypatch, grib_server, tmp_path):
+    """ An interrupted download picks up where it left off, and is hashed as it goes """
+    monkeypatch.setenv('ENV_CANADA_DOWNLOAD_CHUNK_SIZE', '1000')
+    monkeypatch.setenv('ENV_CANADA_DOWNLOAD_CHECKSUM', 'sha256')
+    grib_server['truncate_at'].extend([5000, 3000])
+    checksum = hashlib.sha256(grib_server['content']).hexdigest()
+    with env_canada.create_http_session() as http_session:
+        target = env_canada.download(grib_server['url'] + 'file.grib2', str(tmp_path), http_session,
+                                     checksum)
+    assert [request.get('Range') for request in grib_server['requests']] == [
+        None, 'bytes=5000-', 'bytes=8000-']
+    with open(target, 'rb') as file_object:
+        assert file_object.read() == grib_server['content']
+    assert os.listdir(str(tmp_path)) == ['file.grib2']
+
+
+def test_download_not_found_on_resume(grib_server, tmp_path):
+    """ A file that can no longer be found when resuming is discarded, rather than kept half downloaded """
+    grib_server['truncate_at'].append(5000)
+    grib_server['status_codes'].extend([200, 404])
+    assert env_canada.download(grib_server['url'] + 'file.grib2', str(tmp_path)) is None
+    assert [request.get('Range') for request in grib_server['requests']] == [None, 'bytes=5000-']
+    assert os.listdir(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('status_code', [416, 206])
+def test_download_unable_to_resume(monkeypatch, grib_server, tmp_path, status_code):
+    """ Starting over because the server can't resume where we left off counts against the resume
+    budget, rather than going on forever """
+    monkeypatch.setenv('ENV_CANADA_DOWNLOAD_RESUMES', '2')
+    grib_server['truncate_at'].append(5000)
+    grib_server['status_codes'].extend([200] + [status_code] * 10)
+    with pytest.raises(env_canada.DownloadIncomplete):
+        env_canada.download(grib_server['url'] + 'file.grib2', str(tmp_path))
+    assert [request.get('Range') for request in grib_server['requests']] == [None, 'bytes=5000-', None]
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_download_in_memory(grib_server, tmp_path):
+    """ A file that's small enough is kept in memory """
+    content = env_canada.download(grib_server['url'] + 'file.grib2', str(tmp_path),
+                                  in_memory_size=len(grib_server['content']))
+    assert content == grib_server['content']
+    assert os.listdir(str(tmp_path)) == []
+    target = env_canada.download(grib_server['url'] + 'file.grib2', str(tmp_path),
+                                 in_memory_size=len(grib_server['content']) - 1)
+    assert os.listdir(str(tmp_path)) == ['file.grib2']
+    with open(target, 'rb') as file_object:
+        assert file_object.read() == grib_server['content']
+
+
+def test_extract_in_memory(monkeypatch, tmp_path):
+    """ Extracting from a file in memory gives the same result as extracting from the file on disk """
+    monkeypatch.setenv('ENV_CANADA_GRID_INDEX_PATH', str(tmp_path))
+    monkeypatch.setattr(env_canada, '_EXTRACT_WORKER_STATIONS', MockGribFileProcessor().stations)
+    filename = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            'CMC_glb_RH_TGL_2_latlon.15x.15_2020071300_P000.grib2')
+    with open(filename, 'rb') as file_object:
+        content = file_object.read()
+    url = 'https://somewhere/CMC_glb_RH_TGL_2_latlon.15x.15_2020071300_P000.grib2'
+    model_info = env_canada.parse_env_canada_filename(os.path.basename(filename))
+    # pylint: disable=protected-access
+    assert env_canada._extract_in_worker(url, content, model_info) == \
+        env_canada._extract_in_worker(url, filename, model_info)
+
+
+def test_download_checksum_mismatch(monkeypatch, grib_server, tmp_path):
+    """ A download that doesn't match its checksum is discarded """
+    monkeypatch.setenv('ENV_CANADA_DOWNLOAD_CHECKSUM', 'sha256')
+    with pytest.raises(env_canada.DownloadChecksumMismatch):
+        env_canada.download(grib_server['url'] + 'file.grib2', str(tmp_path), checksum='00')
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_download_timeouts(monkeypatch, mock_download, tmp_path):
+    """ Downloads are streamed, with separate connect and read timeouts """
+    monkeypatch.setenv('ENV_CANADA_CONNECT_TIMEOUT', '3')
+    monkeypatch.setenv('ENV_CANADA_READ_TIMEOUT', '30')
+    mock_get = requests.Session.get
+    calls = []
+
+    def mock_requests_get(self, url, **kwargs):
+        calls.append(kwargs)
+        return mock_get(self, url, **kwargs)
+    monkeypatch.setattr(requests.Session, 'get', mock_requests_get)
+    with env_canada.create_http_session() as http_session:
+        env_canada.download('https://somewhere/file.grib2', str(tmp_path), http_session)
+    assert calls[0]['timeout'] == (3.0, 30.0)
+    assert calls[0]['stream']
+
+
+class MockGribFileProcessor():
+    """ Mocked out GribFileProcessor, that keeps the station data it's asked to store """
+
+    def __init__(self):
+        self.stations = [{'code': '322', 'lat': '50.6733333', 'long': '-120.4816667'}]
+        self.stored = []
+
+    def store_variables(self, geotransform, values_by_variable, grib_info):
+        """ Keep the station data """
+        self.stored.append((grib_info.prediction_timestamp, values_by_variable))
+
+
+@pytest.mark.parametrize('in_memory_max_size, combine_variables',
+                         [('0', 'True'), ('100000000', 'True'), ('0', 'False')])
+def test_ingest_pipeline(monkeypatch, tmp_path, mock_download, in_memory_max_size, combine_variables):
+    """ Every file makes it through the pipeline, while only one file is on disk (or in memory) at a time
+    """
+    monkeypatch.setenv('ENV_CANADA_IN_MEMORY_MAX_SIZE', in_memory_max_size)
+    monkeypatch.setenv('ENV_CANADA_COMBINE_VARIABLES', combine_variables)
+    monkeypatch.setenv('ENV_CANADA_MAX_FILES_ON_DISK', '1')
+    monkeypatch.setenv('ENV_CANADA_EXTRACT_WORKERS', '2')
+    monkeypatch.setenv('ENV_CANADA_LEDGER_BATCH_SIZE', '2')
+    monkeypatch.setenv('ENV_CANADA_GRID_INDEX_PATH', str(tmp_path / 'index'))
+    monkeypatch.setattr(process_grib, '_STATION_GRID_INDEXES', {})
+    urls = [(url, env_canada.parse_env_canada_filename(filename))
+            for url, filename in list(env_canada.get_download_urls())[:6]]
+    mock_get = requests.Session.get
+
+    def mock_requests_get(self, url, **kwargs):
+        if url == urls[1][0]:
+            return MockResponse(status_code=404)
+        if url == urls[2][0]:
+            raise requests.exceptions.ConnectionError()
+        return mock_get(self, url, **kwargs)
+    monkeypatch.setattr(requests.Session, 'get', mock_requests_get)
+    flagged = []
+    monkeypatch.setattr(env_canada, 'flag_file_as_processed', lambda session, urls: flagged.append(urls))
+
+    processor = MockGribFileProcessor()
+    pipeline = env_canada.IngestPipeline(processor, str(tmp_path))
+    pipeline.run(None, urls)
+
+    # Files are flagged as processed in batches (of files for the same prediction, when those are combined).
+    assert len(flagged) == 2
+    assert sorted(sum(flagged, [])) == sorted(url for url, _ in urls[:1] + urls[3:])
+    assert pipeline.files_downloaded == pipeline.files_processed == 4
+    assert pipeline.exception_count == 1
+    assert pipeline.stages.extract_queue.max_depth <= 1
+    assert os.listdir(str(tmp_path)) == ['index']
+    expected = [[70.74049377441406, 71.74049377441406, 77.49049377441406, 76.99049377441406]]
+    if combine_variables == 'True':
+        # The variables for the same prediction are stored together, once all of them have come through.
+        assert dict(processor.stored) == {
+            urls[0][1].prediction_timestamp: {'TMP_TGL_2': expected},
+            urls[3][1].prediction_timestamp: {'RH_TGL_2': expected},
+            urls[4][1].prediction_timestamp: {'TMP_TGL_2': expected, 'RH_TGL_2': expected}}
+    else:
+        assert len(processor.stored) == 4
+        for _, values_by_variable in processor.stored:
+            assert list(values_by_variable.values()) == [expected]
+
+
+def test_ingest_pipeline_remove_fails(monkeypatch, tmp_path, mock_download):
+    """ A downloaded file that can't be removed doesn't hold on to its slot, and so doesn't stop the files
+    after it from going through the pipeline """
+    monkeypatch.setenv('ENV_CANADA_IN_MEMORY_MAX_SIZE', '0')
+    monkeypatch.setenv('ENV_CANADA_MAX_FILES_ON_DISK', '1')
+    monkeypatch.setenv('ENV_CANADA_EXTRACT_WORKERS', '1')
+    monkeypatch.setenv('ENV_CANADA_GRID_INDEX_PATH', '')
+    monkeypatch.setattr(env_canada, 'flag_file_as_processed', lambda session, urls: None)
+
+    def mock_remove(path):
+        raise PermissionError(path)
+    monkeypatch.setattr(env_canada.os, 'remove', mock_remove)
+    urls = [(url, env_canada.parse_env_canada_filename(filename))
+            for url, filename in list(env_canada.get_download_urls())[:3]]
+
+    pipeline = env_canada.IngestPipeline(MockGribFileProcessor(), str(tmp_path))
+    thread = threading.Thread(target=pipeline.run, args=(None, urls), daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive()
+    assert pipeline.files_processed == 3
+
+
+def test_flag_file_as_processed():
+    """ Files are flagged as processed with a single upsert """
+    session = mock.MagicMock()
+    env_canada.flag_file_as_processed(session, ['https://a/1.grib2', 'https://a/2.grib2'])
+    statement = session.execute.call_args[0][0]
+    compiled = statement.compile(dialect=postgresql.dialect())
+    assert str(compiled).startswith('INSERT INTO processed_model_run_urls')
+    assert 'ON CONFLICT (url) DO UPDATE SET update_date = excluded.update_date' in str(compiled)
+    assert {'https://a/1.grib2', 'https://a/2.grib2'} <= set(compiled.params.values())
+    session.commit.assert_called_once()
@@ -1,9 +1,15 @@
 """ BDD tests for grib file processing """
 import os
 import logging
+from unittest import mock
 from pytest_bdd import scenario, given, then, when
+from sqlalchemy.dialects import postgresql
 import gdal
+import app.db.database
 import app.models.process_grib as process_grib
+from app.db.models import PredictionModelRunTimestamp
+from app.models.env_canada import parse_env_canada_filename
+from app.wildfire_one import _get_stations_local
 
 logger = logging.getLogger(__name__)
 
@@ -124,3 +130,41 @@ def calculate_geographic_coordinate(given_origin_and_pixels, given_raster_coordi
 def assert_geographic_coordinate(given_origin_and_pixels, geographic_coordinate):
     expected_coordinate = eval(geographic_coordinate)
     assert given_origin_and_pixels['geographic_coordinate'] == expected_coordinate
+
+
+def test_yield_data_for_stations_matches_surrounding_grid():
+    """ Reading the grid around all stations at once gives the same points and values as reading the grid
+    around each station separately. """
+    dirname = os.path.dirname(os.path.realpath(__file__))
+    dataset = process_grib.open_grib(os.path.join(
+        dirname, 'CMC_glb_RH_TGL_2_latlon.15x.15_2020071300_P000.grib2'))
+    origin, pixel = process_grib.get_dataset_geometry(dataset)
+    raster_band = dataset.GetRasterBand(1)
+    stations = _get_stations_local()
+    expected = [process_grib.get_surrounding_grid(raster_band, *process_grib.calculate_raster_coordinate(
+        float(station['long']), float(station['lat']), origin, pixel)) for station in stations]
+    actual = list(process_grib.yield_data_for_stations(stations, raster_band, origin, pixel))
+    assert actual == expected
+
+
+def test_store_predictions(monkeypatch):
+    """ The predictions for all stations are stored with a single upsert, with one row per grid subset,
+    and every variable set. """
+    session = mock.MagicMock()
+    monkeypatch.setattr(app.db.database, 'get_session', lambda: session)
+    processor = process_grib.GribFileProcessor()
+    grib_info = parse_env_canada_filename('CMC_glb_RH_TGL_2_latlon.15x.15_2020071300_P000.grib2')
+    processor.store_predictions(
+        [1, 2, 1],
+        {'RH_TGL_2': [[1.0, 2.0, 3.0, 4.0], [5.0, 6.0, 7.0, 8.0], [1.0, 2.0, 3.0, 4.0]],
+         'TMP_TGL_2': [[9.0, 9.0, 9.0, 9.0], [0.0, 0.0, 0.0, 0.0], [9.0, 9.0, 9.0, 9.0]]},
+        PredictionModelRunTimestamp(id=3), grib_info)
+    session.execute.assert_called_once()
+    compiled = session.execute.call_args[0][0].compile(dialect=postgresql.dialect())
+    assert str(compiled).count("nextval('model_run_grid_subset_predictions_id_seq')") == 2
+    assert ('ON CONFLICT (prediction_model_run_timestamp_id, prediction_model_grid_subset_id, '
+            'prediction_timestamp) DO UPDATE SET tmp_tgl_2 = excluded.tmp_tgl_2, '
+            'rh_tgl_2 = excluded.rh_tgl_2') in str(compiled)
+    assert compiled.params['rh_tgl_2_m1'] == [5.0, 6.0, 7.0, 8.0]
+    assert compiled.params['tmp_tgl_2_m1'] == [0.0, 0.0, 0.0, 0.0]
+    assert compiled.params['prediction_model_run_timestamp_id_m0'] == 3
@@ -0,0 +1,106 @@
+""" Unit tests for the station grid index """
+import os
+import pytest
+import app.models.process_grib as process_grib
+from app.models.env_canada import parse_env_canada_filename
+from app.wildfire_one import _get_stations_local
+
+FILENAME = 'CMC_glb_RH_TGL_2_latlon.15x.15_2020071300_P000.grib2'
+
+
+@pytest.fixture
+def grid_index_path(monkeypatch, tmp_path):
+    """ Keep station grid indexes in a temporary folder, and out of the in memory cache """
+    monkeypatch.setenv('ENV_CANADA_GRID_INDEX_PATH', str(tmp_path))
+    monkeypatch.setattr(process_grib, '_STATION_GRID_INDEXES', {})
+    return tmp_path
+
+
+@pytest.fixture
+def dataset():
+    """ The grib file used for testing """
+    dirname = os.path.dirname(os.path.realpath(__file__))
+    return process_grib.open_grib(os.path.join(dirname, FILENAME))
+
+
+def test_index_matches_station_coordinates(grid_index_path, dataset):
+    """ The index gives the same grid as calculating it for each station """
+    geotransform = dataset.GetGeoTransform()
+    origin, pixel = process_grib.get_dataset_geometry(dataset)
+    stations = _get_stations_local()
+    index = process_grib.get_station_grid_index(parse_env_canada_filename(FILENAME), geotransform, stations)
+    assert len(index.station_cells) == len(stations)
+    for station, cell in zip(stations, index.station_cells):
+        x_index, y_index = index.x_indices[cell], index.y_indices[cell]
+        geographic_points = index.geographic_points[cell]
+        x_expected, y_expected = process_grib.calculate_raster_coordinate(
+            float(station['long']), float(station['lat']), origin, pixel)
+        assert (x_index, y_index) == (x_expected, y_expected)
+        assert geographic_points[0] == process_grib.calculate_geographic_coordinate(
+            (x_expected, y_expected), origin, pixel)
+        assert geographic_points[2] == process_grib.calculate_geographic_coordinate(
+            (x_expected + 1, y_expected + 1), origin, pixel)
+
+
+def test_index_loaded_from_disk(grid_index_path, dataset, monkeypatch):
+    """ An index that has been saved is loaded as is, rather than being built again """
+    geotransform = dataset.GetGeoTransform()
+    grib_info = parse_env_canada_filename(FILENAME)
+    stations = _get_stations_local()
+    built = process_grib.get_station_grid_index(grib_info, geotransform, stations)
+    assert os.listdir(str(grid_index_path)) == ['{}.json'.format(built.key)]
+
+    monkeypatch.setattr(process_grib, '_STATION_GRID_INDEXES', {})
+    monkeypatch.setattr(process_grib.StationGridIndex, 'build', None)
+    loaded = process_grib.get_station_grid_index(grib_info, geotransform, stations)
+    assert loaded is not built
+    assert loaded.x_indices.tolist() == built.x_indices.tolist()
+    assert loaded.y_indices.tolist() == built.y_indices.tolist()
+    assert loaded.geographic_points == built.geographic_points
+    assert loaded.station_cells == built.station_cells
+
+
+def test_corrupt_index_rebuilt(grid_index_path, dataset):
+    """ An index that can't be read is built again """
+    geotransform = dataset.GetGeoTransform()
+    grib_info = parse_env_canada_filename(FILENAME)
+    stations = _get_stations_local()
+    built = process_grib.get_station_grid_index(grib_info, geotransform, stations)
+    filename = os.path.join(str(grid_index_path), '{}.json'.format(built.key))
+    with open(filename, 'w') as file_object:
+        file_object.write('{"key"')
+    process_grib._STATION_GRID_INDEXES.clear()  # pylint: disable=protected-access
+    rebuilt = process_grib.get_station_grid_index(grib_info, geotransform, stations)
+    assert rebuilt.geographic_points == built.geographic_points
+    assert process_grib.StationGridIndex.load(filename).geographic_points == built.geographic_points
+
+
+def test_index_key(grid_index_path, dataset):
+    """ A different grid, or different stations, get a different index """
+    geotransform = dataset.GetGeoTransform()
+    grib_info = parse_env_canada_filename(FILENAME)
+    stations = _get_stations_local()
+    key = process_grib.get_station_grid_index(grib_info, geotransform, stations).key
+    assert process_grib.get_station_grid_index(grib_info, geotransform, stations).key == key
+    assert process_grib.get_station_grid_index(grib_info, geotransform, stations[1:]).key != key
+    moved = (geotransform[0] + 1,) + tuple(geotransform[1:])
+    assert process_grib.get_station_grid_index(grib_info, moved, stations).key != key
+    assert len(os.listdir(str(grid_index_path))) == 3
+
+
+def test_stations_sharing_cell(grid_index_path, dataset, monkeypatch):
+    """ Stations that fall in the same grid cell share it, and their values are only read once """
+    geotransform = dataset.GetGeoTransform()
+    grib_info = parse_env_canada_filename(FILENAME)
+    station = _get_stations_local()[0]
+    neighbour = dict(station, code='0', lat=str(float(station['lat']) + 0.001))
+    stations = [station, neighbour, _get_stations_local()[1]]
+    messages = []
+    monkeypatch.setattr(process_grib.logger, 'info', lambda message, *args: messages.append(message % args))
+    index = process_grib.get_station_grid_index(grib_info, geotransform, stations)
+    assert index.station_cells == [0, 0, 1]
+    assert len(index.geographic_points) == len(index.x_indices) == 2
+    assert '3 stations in 2 grid cells (1.50 stations per cell)' in messages
+    filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), FILENAME)
+    _, values = process_grib.extract_station_data(filename, stations, grib_info)
+    assert len(values) == 2
@@ -0,0 +1,26 @@
+""" Unit tests for the ecodivision locator in app/wildfire_one.py """
+import json
+from app.wildfire_one import (EcodivisionLocator, get_ecodivision_locator,
+                              weather_stations_file_path)
+
+
+def test_locate_matches_pre_generated_stations():
+    """ The locator should agree with the ecodivisions in our pre-generated station list. """
+    with open(weather_stations_file_path) as file_pointer:
+        stations = json.load(file_pointer)['weather_stations'][:50]
+    # Watson Lake is in the Yukon, so it's not in any of our ecodivisions.
+    stations = [station for station in stations if station['code'] != '447']
+    locator = EcodivisionLocator()
+    names = locator.locate([station['long'] for station in stations],
+                           [station['lat'] for station in stations])
+    assert names == [station['ecodivision_name'] for station in stations]
+
+
+def test_locate_outside_of_bc():
+    """ A coordinate outside of all ecodivisions can't be located. """
+    assert get_ecodivision_locator().locate([0], [0]) == [None]
+
+
+def test_locator_is_only_loaded_once():
+    """ The locator is expensive to build, so we only want one. """
+    assert get_ecodivision_locator() is get_ecodivision_locator()
@@ -9,4 +9,14 @@ Feature: /hourlies/
         Examples:
             | codes      | status | num_groups | num_readings_per_group |
             | [146, 230] | 200    | 2          | [118, 118]             |
-            | [230]      | 200    | 1          | [118]                  |
\ No newline at end of file
+            | [230]      | 200    | 1          | [118]                  |
+    Scenario: Stream hourlies
+        Given I stream hourlies for stations: <codes>
+        Then the response status code is <status>
+        And there are <num_groups> streamed groups of hourlies
+        And there are <num_readings_per_group> streamed readings per group
+
+        Examples:
+            | codes      | status | num_groups | num_readings_per_group |
+            | [146, 230] | 200    | 2          | [118, 118]             |
+            | [230]      | 200    | 1          | [118]                  |
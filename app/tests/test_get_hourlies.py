@@ -1,5 +1,7 @@
 """ BDD tests for API /hourlies. """
 import logging
+import json
+import asyncio
 from datetime import datetime, timezone
 from pytest_bdd import scenario, given, then
 from starlette.testclient import TestClient
@@ -7,6 +9,7 @@ from aiohttp import ClientSession
 import app.main
 from app.tests.common import default_mock_client_get
 import app.wildfire_one
+import app.hourlies_columns
 
 LOGGER = logging.getLogger(__name__)
 
@@ -17,10 +20,15 @@ def test_hourlies():
     """ BDD Scenario. """
 
 
+@scenario('test_get_hourlies.feature', 'Stream hourlies',
+          example_converters=dict(codes=str, status=int, num_groups=int, num_readings_per_group=str))
+def test_stream_hourlies():
+    """ BDD Scenario. """
+
+
 # pylint: disable=unused-argument
-@given('I request hourlies for stations: <codes>')
-def response(monkeypatch, mock_env_with_use_wfwx, mock_jwt_decode, codes):
-    """ Make /hourlies/ request using mocked out ClientSession.
+def _post_hourlies(monkeypatch, url: str, codes: str):
+    """ Make a hourlies request using mocked out ClientSession.
     """
 
     # Mock out the part that gives us a datetime.
@@ -38,13 +46,34 @@ def response(monkeypatch, mock_env_with_use_wfwx, mock_jwt_decode, codes):
     client = TestClient(app.main.app)
     headers = {'Content-Type': 'application/json',
                'Authorization': 'Bearer token'}
-    return client.post('/hourlies/', headers=headers, json={"stations": stations})
+    return client.post(url, headers=headers, json={"stations": stations})
+
+
+# pylint: disable=unused-argument
+@given('I request hourlies for stations: <codes>')
+def response(monkeypatch, mock_env_with_use_wfwx, mock_jwt_decode, codes):
+    """ Make /hourlies/ request using mocked out ClientSession.
+    """
+    return _post_hourlies(monkeypatch, '/hourlies/', codes)
+
+
+# pylint: disable=unused-argument
+@given('I stream hourlies for stations: <codes>')
+def stream_response(monkeypatch, mock_env_with_use_wfwx, mock_jwt_decode, codes):
+    """ Make /hourlies/stream/ request using mocked out ClientSession.
+    """
+    return _post_hourlies(monkeypatch, '/hourlies/stream/', codes)
 
 
 # pylint: disable=redefined-outer-name
 @then('the response status code is <status>')
-def assert_status_code(response, status):
+def assert_status_code(request, status):
     """ Assert that we recieve the expected status code """
+    # The response could come from either of the given steps, depending on the scenario.
+    if 'stream_response' in request.fixturenames:
+        response = request.getfixturevalue('stream_response')
+    else:
+        response = request.getfixturevalue('response')
     assert response.status_code == status
 
 
@@ -61,3 +90,55 @@ def assert_number_of_hourlies_per_group(response, num_readings_per_group):
     for index, item in enumerate(eval(num_readings_per_group)):
         assert len(response.json()['hourlies']
                    [index]['values']) == item
+
+
+@then('there are <num_groups> streamed groups of hourlies')
+def assert_number_of_streamed_hourlies_groups(stream_response, num_groups):
+    """ Assert that we recieve the expected number of lines, one per station """
+    lines = stream_response.text.splitlines()
+    assert len(lines) == num_groups
+
+
+@then('there are <num_readings_per_group> streamed readings per group')
+def assert_number_of_streamed_hourlies_per_group(stream_response, num_readings_per_group):
+    """ Assert that we receive the expected number of hourlies per line. Stations are streamed in the
+    order in which they complete, so we don't care about the order. """
+    groups = [json.loads(line) for line in stream_response.text.splitlines()]
+    # pylint: disable=eval-used
+    assert sorted(len(group['values']) for group in groups) == sorted(eval(num_readings_per_group))
+
+
+def test_stream_hourlies_station_timeout(monkeypatch):
+    """ A station that takes too long should result in an error record, not a failed request. """
+    monkeypatch.setenv('WFWX_HOURLIES_STATION_TIMEOUT', '0.01')
+
+    # pylint: disable=unused-argument
+    async def mock_fetch_hourlies(client, raw_station, headers):
+        await asyncio.sleep(1)
+
+    monkeypatch.setattr(app.wildfire_one, 'fetch_hourlies', mock_fetch_hourlies)
+    monkeypatch.setattr(ClientSession, 'get', default_mock_client_get)
+
+    async def run():
+        return [item async for item in app.wildfire_one.stream_hourly_readings([230])]
+
+    result = asyncio.get_event_loop().run_until_complete(run())
+    assert len(result) == 1
+    assert result[0].station_code == 230
+    assert result[0].detail == 'Timed out after 0.01 seconds'
+
+
+def test_hourlies_columns(monkeypatch, mock_env_with_use_wfwx, mock_jwt_decode):
+    """ Hourlies as columns should hold the same readings as the regular hourlies response. """
+    rows = _post_hourlies(monkeypatch, '/hourlies/', '[146, 230]').json()['hourlies']
+    app.wildfire_one.HOURLY_READINGS_CACHE.clear()
+    response = _post_hourlies(monkeypatch, '/hourlies/columns/', '[146, 230]')
+    assert response.status_code == 200
+    columns = response.json()['hourlies']
+    assert [group['station'] for group in columns] == [group['station'] for group in rows]
+    for row_group, column_group in zip(rows, columns):
+        values = column_group['values']
+        assert [datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc).isoformat()
+                for timestamp in values['datetime']] == [row['datetime'] for row in row_group['values']]
+        for field in app.hourlies_columns.HOURLY_FIELDS:
+            assert values[field] == [row[field] for row in row_group['values']]
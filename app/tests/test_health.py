@@ -0,0 +1,12 @@
+""" Unit tests for the health endpoint """
+from starlette.testclient import TestClient
+import app.main
+
+
+def test_health_reports_wfwx_metrics():
+    """ The health endpoint reports on requests made to WFWX """
+    response = TestClient(app.main.app).get('/health')
+    assert response.status_code == 200
+    wfwx = response.json()['wfwx']
+    assert wfwx['circuit_breaker'] == 'closed'
+    assert {'requests', 'retries', 'timeouts', 'failures', 'rejected', 'in_flight'} <= set(wfwx)
@@ -0,0 +1,46 @@
+""" Unit tests for the columnar hourlies parser in app/hourlies_columns.py """
+import math
+from datetime import datetime, timezone
+import numpy as np
+from app.hourlies_columns import parse_hourlies_columns, columns_to_readings
+from app.schemas import WeatherReading
+
+HOURLIES = [
+    {'weatherTimestamp': 1589644800000, 'hourlyMeasurementTypeCode': {'id': 'ACTUAL'},
+     'temperature': 12.5, 'relativeHumidity': 45, 'windSpeed': None},
+    {'weatherTimestamp': 1589648400000, 'hourlyMeasurementTypeCode': {'id': 'FORECAST'},
+     'temperature': 13},
+    {'weatherTimestamp': 1589652000000, 'hourlyMeasurementTypeCode': {'id': 'ACTUAL'},
+     'temperature': 14, 'isi': 2.1}
+]
+
+
+def test_parse_hourlies_columns():
+    """ Only actuals are kept, with missing values as NaN. """
+    columns = parse_hourlies_columns(HOURLIES)
+    assert columns['datetime'].dtype == np.int64
+    assert columns['datetime'].tolist() == [1589644800000, 1589652000000]
+    assert columns['temperature'].tolist() == [12.5, 14.0]
+    assert columns['relative_humidity'][0] == 45.0
+    assert math.isnan(columns['relative_humidity'][1])
+    assert np.isnan(columns['wind_speed']).all()
+
+
+def test_parse_empty():
+    """ No hourlies, no readings. """
+    columns = parse_hourlies_columns([])
+    assert len(columns['datetime']) == 0
+    assert columns_to_readings(columns) == []
+
+
+def test_columns_to_readings_match_validated_readings():
+    """ Readings constructed from columns should be the same as ones validated from the raw values. """
+    readings = columns_to_readings(parse_hourlies_columns(HOURLIES))
+    expected = [WeatherReading(
+        datetime=datetime.fromtimestamp(hourly['weatherTimestamp'] / 1000, tz=timezone.utc).isoformat(),
+        temperature=hourly.get('temperature'),
+        relative_humidity=hourly.get('relativeHumidity'),
+        wind_speed=hourly.get('windSpeed'),
+        isi=hourly.get('isi')) for hourly in (HOURLIES[0], HOURLIES[2])]
+    assert readings == expected
+    assert [reading.dict() for reading in readings] == [reading.dict() for reading in expected]
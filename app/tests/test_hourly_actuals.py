@@ -0,0 +1,79 @@
+""" Unit tests for serving hourlies from the hourly_actuals table """
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+from alchemy_mock.mocking import UnifiedAlchemyMagicMock
+import app.hourly_actuals
+import app.wildfire_one
+import app.db.database
+from app.db.models import HourlyActual
+from app.schemas import WeatherReading, WeatherStationHourlyReadingsError
+
+NOW = datetime(2020, 8, 14, 12, tzinfo=timezone.utc)
+
+
+@pytest.fixture()
+def mock_hourly_actuals(monkeypatch):
+    """ Mock out the database with a couple of hours of readings for station 322. """
+    def mock_get_session(*args):  # pylint: disable=unused-argument
+        session = UnifiedAlchemyMagicMock()
+        for hours_ago in (2, 1):
+            session.add(HourlyActual(station_code=322, weather_date=NOW - timedelta(hours=hours_ago),
+                                     temperature=hours_ago))
+        return session
+
+    monkeypatch.setattr(app.db.database, 'get_session', mock_get_session)
+    monkeypatch.setattr(app.wildfire_one, '_get_now', lambda: NOW)
+
+
+# pylint: disable=redefined-outer-name, unused-argument
+def test_readings_from_database(mock_hourly_actuals):
+    """ Readings should be served from the database, with station details from the station catalog. """
+    readings = asyncio.get_event_loop().run_until_complete(
+        app.hourly_actuals.get_hourly_readings([322]))
+    assert len(readings) == 1
+    assert readings[0].station.code == 322
+    assert [value.temperature for value in readings[0].values] == [2, 1]
+
+
+def test_live_top_up(monkeypatch, mock_hourly_actuals):
+    """ Readings newer than those in the database should be added from WFWX. """
+    monkeypatch.setenv('HOURLY_ACTUALS_LIVE_TOP_UP', 'True')
+    requested = {}
+
+    async def mock_get_hourly_actuals_since(start_times):
+        requested.update(start_times)
+        return {322: [WeatherReading(datetime=NOW - timedelta(hours=1), temperature=1),
+                      WeatherReading(datetime=NOW, temperature=0)]}
+
+    monkeypatch.setattr(app.wildfire_one, 'get_hourly_actuals_since', mock_get_hourly_actuals_since)
+    readings = asyncio.get_event_loop().run_until_complete(
+        app.hourly_actuals.get_hourly_readings([322]))
+    assert requested == {322: NOW - timedelta(hours=1)}
+    assert [value.temperature for value in readings[0].values] == [2, 1, 0]
+
+
+def test_live_top_up_failure(monkeypatch, mock_hourly_actuals):
+    """ If WFWX is unavailable, the readings in the database are still served. """
+    monkeypatch.setenv('HOURLY_ACTUALS_LIVE_TOP_UP', 'True')
+
+    async def mock_get_hourly_actuals_since(start_times):
+        raise app.wildfire_one.WFWXUnavailableException()
+
+    monkeypatch.setattr(app.wildfire_one, 'get_hourly_actuals_since', mock_get_hourly_actuals_since)
+    readings = asyncio.get_event_loop().run_until_complete(
+        app.hourly_actuals.get_hourly_readings([322]))
+    assert [value.temperature for value in readings[0].values] == [2, 1]
+
+
+def test_live_top_up_station_failure(monkeypatch, mock_hourly_actuals):
+    """ If a station fails in WFWX, its readings in the database are still served. """
+    monkeypatch.setenv('HOURLY_ACTUALS_LIVE_TOP_UP', 'True')
+
+    async def mock_get_hourly_actuals_since(start_times):
+        return {322: WeatherStationHourlyReadingsError(station_code=322, detail='Failed')}
+
+    monkeypatch.setattr(app.wildfire_one, 'get_hourly_actuals_since', mock_get_hourly_actuals_since)
+    readings = asyncio.get_event_loop().run_until_complete(
+        app.hourly_actuals.get_hourly_readings([322]))
+    assert [value.temperature for value in readings[0].values] == [2, 1]
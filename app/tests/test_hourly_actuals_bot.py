@@ -0,0 +1,131 @@
+""" Unit tests for the hourly actuals bot """
+import asyncio
+from datetime import datetime, timezone
+import pytest
+from aiohttp import ClientResponseError, RequestInfo
+from multidict import CIMultiDict
+from yarl import URL
+from alchemy_mock.mocking import UnifiedAlchemyMagicMock
+import app.hourly_actuals_bot
+import app.db.database
+from app.schemas import WeatherReading
+
+LATEST = datetime(2020, 8, 14, 10, tzinfo=timezone.utc)
+
+
+@pytest.fixture()
+def mock_database_session(monkeypatch):
+    """ Mock out the database session. """
+    session = UnifiedAlchemyMagicMock()
+    # pylint: disable=unused-argument
+    monkeypatch.setattr(app.db.database, 'get_session', lambda *args: session)
+    return session
+
+
+@pytest.fixture()
+def mock_wfwx(monkeypatch):
+    """ Mock out WFWX (with stations 1 and 2), keeping track of the start times asked for. """
+    requested = {}
+
+    async def mock_get_hourly_actuals_since(start_times, all_stations=False):
+        assert all_stations
+        requested.update({code: start_times.get(code) for code in (1, 2)})
+        return {code: [WeatherReading(datetime=datetime(2020, 8, 14, 11, tzinfo=timezone.utc),
+                                      temperature=20)] for code in requested}
+
+    monkeypatch.setattr(app.wildfire_one, 'get_hourly_actuals_since', mock_get_hourly_actuals_since)
+    monkeypatch.setattr(app.hourly_actuals_bot, 'get_latest_weather_dates',
+                        lambda session: {1: LATEST})
+    return requested
+
+
+# pylint: disable=redefined-outer-name, unused-argument
+def test_hourly_actuals_bot(mock_database_session, mock_wfwx):
+    """ The bot should only ask for readings newer than the ones we have, and exit with a success
+    code. """
+    with pytest.raises(SystemExit) as excinfo:
+        app.hourly_actuals_bot.main()
+    assert excinfo.value.code == 0
+    assert mock_wfwx == {1: LATEST, 2: None}
+    mock_database_session.commit.assert_called()
+
+
+def test_to_rows():
+    """ Readings are stored with their station code. """
+    created_at = datetime.now(tz=timezone.utc)
+    rows = app.hourly_actuals_bot._to_rows(  # pylint: disable=protected-access
+        1, [WeatherReading(datetime=LATEST, temperature=20)], created_at)
+    assert rows == [{'weather_date': LATEST, 'station_code': 1, 'created_at': created_at,
+                     'temperature': 20, 'relative_humidity': None, 'wind_speed': None,
+                     'wind_direction': None, 'barometric_pressure': None, 'precipitation': None,
+                     'ffmc': None, 'isi': None, 'fwi': None}]
+
+
+@pytest.fixture()
+def mock_raw_stations(monkeypatch):
+    """ Mock out the WFWX station list (stations 1 and 2, and inactive station 3), keeping track of the
+    queries made for it. """
+    raw_stations = [{'stationCode': code, 'displayLabel': str(code), 'stationStatus': {'id': status},
+                     'latitude': 1, 'longitude': 1}
+                    for code, status in ((1, 'ACTIVE'), (2, 'ACTIVE'), (3, 'INACTIVE'))]
+    query_builders = []
+
+    async def mock_fetch_raw_stations(client, headers, query_builder):
+        query_builders.append(query_builder)
+        for raw_station in raw_stations:
+            yield raw_station
+
+    async def mock_get_auth_header(client):
+        return {}
+
+    monkeypatch.setattr(app.wildfire_one, '_fetch_raw_stations', mock_fetch_raw_stations)
+    monkeypatch.setattr(app.wildfire_one, '_get_auth_header', mock_get_auth_header)
+    return query_builders
+
+
+def test_hourly_actuals_since_all_stations(monkeypatch, mock_raw_stations):
+    """ All stations are listed with a single unfiltered query, rather than by station code, and only
+    valid stations have their readings fetched. """
+    requested = {}
+
+    async def mock_fetch_hourly_actuals(client, raw_station, headers, start_time=None):
+        requested[raw_station['stationCode']] = start_time
+        return []
+
+    monkeypatch.setattr(app.wildfire_one, 'fetch_hourly_actuals', mock_fetch_hourly_actuals)
+
+    async def run():
+        try:
+            return await app.wildfire_one.get_hourly_actuals_since({1: LATEST}, all_stations=True)
+        finally:
+            await app.wildfire_one.close_wfwx_client()
+
+    readings = asyncio.get_event_loop().run_until_complete(run())
+    assert [type(query_builder) for query_builder in mock_raw_stations] == [
+        app.wildfire_one.BuildQueryAllStations]
+    assert requested == {1: LATEST, 2: None}
+    assert readings == {1: [], 2: []}
+
+
+def test_hourly_actuals_bot_station_fails(monkeypatch, mock_database_session, mock_raw_stations):
+    """ A station that fails (WFWX answers 500) doesn't stop the readings of the other stations from
+    being stored, but the bot exits with a failure code. """
+    async def mock_fetch_hourly_actuals(client, raw_station, headers, start_time=None):
+        if raw_station['stationCode'] == 2:
+            raise ClientResponseError(
+                RequestInfo(URL('http://wfwx/v1/hourlies'), 'GET', CIMultiDict()), (), status=500)
+        return [WeatherReading(datetime=LATEST, temperature=20)]
+
+    stored = []
+
+    def mock_store_hourly_actuals(session, rows):
+        stored.extend(rows)
+        return len(rows)
+
+    monkeypatch.setattr(app.wildfire_one, 'fetch_hourly_actuals', mock_fetch_hourly_actuals)
+    monkeypatch.setattr(app.hourly_actuals_bot, 'get_latest_weather_dates', lambda session: {})
+    monkeypatch.setattr(app.hourly_actuals_bot, 'store_hourly_actuals', mock_store_hourly_actuals)
+    with pytest.raises(SystemExit) as excinfo:
+        app.hourly_actuals_bot.main()
+    assert excinfo.value.code == 1
+    assert [row['station_code'] for row in stored] == [1]
@@ -0,0 +1,79 @@
+""" Unit tests for the hourly readings cache in app/wildfire_one.py """
+import asyncio
+from datetime import datetime, timedelta, timezone
+from aiohttp import ClientSession
+import app.wildfire_one
+from app.wildfire_one import HourlyReadingsCache, WFWXClient
+from app.schemas import WeatherReading
+from app.tests.common import default_mock_client_get, MockClientSession
+
+RAW_STATION = {'id': 'df4832f9-5318-4aee-94bc-f24c8f039f2e', 'stationCode': '230',
+               'displayLabel': 'ZZ STATION', 'latitude': 49.3806, 'longitude': -121.525967}
+NOW = datetime.fromtimestamp(1590076213962/1000, tz=timezone.utc)
+
+
+def _mock_now():
+    return NOW
+
+
+def _reading(hours_ago: int) -> WeatherReading:
+    return WeatherReading(datetime=NOW - timedelta(hours=hours_ago))
+
+
+def _to_epoch_ms(timestamp: datetime) -> int:
+    """ Convert a datetime to epoch milliseconds. """
+    return int(timestamp.timestamp() * 1000)
+
+
+def test_only_new_readings_are_requested(monkeypatch):
+    """ Once we have readings for a station, we should only ask for newer ones. """
+    monkeypatch.setattr(app.wildfire_one, '_get_now', _mock_now)
+    requested = []
+
+    # pylint: disable=unused-argument
+    def mock_get_nothing_new(*args, **kwargs):
+        requested.append(kwargs.get('params'))
+        return MockClientSession(json_response={'_embedded': {'hourlies': []}})
+
+    async def run():
+        client = WFWXClient()
+        try:
+            monkeypatch.setattr(ClientSession, 'get', default_mock_client_get)
+            first = await app.wildfire_one.fetch_hourlies(client, RAW_STATION, {})
+            monkeypatch.setattr(ClientSession, 'get', mock_get_nothing_new)
+            second = await app.wildfire_one.fetch_hourlies(client, RAW_STATION, {})
+            return first, second
+        finally:
+            await client.close()
+
+    first, second = asyncio.get_event_loop().run_until_complete(run())
+    assert len(first.values) == 118
+    assert requested[0]['startTimestamp'] == _to_epoch_ms(first.values[-1].datetime) + 1
+    assert second.values == first.values
+
+
+def test_merge_ignores_readings_already_cached():
+    """ Readings we already have shouldn't be added again. """
+    cache = HourlyReadingsCache()
+    cache.merge('station', [_reading(3), _reading(2)], NOW - timedelta(days=5))
+    readings = cache.merge('station', [_reading(2), _reading(1)], NOW - timedelta(days=5))
+    assert [reading.datetime for reading in readings] == [
+        NOW - timedelta(hours=3), NOW - timedelta(hours=2), NOW - timedelta(hours=1)]
+
+
+def test_merge_evicts_readings_outside_of_window():
+    """ Readings older than the window should be evicted. """
+    cache = HourlyReadingsCache()
+    readings = cache.merge('station', [_reading(200), _reading(100), _reading(1)],
+                           NOW - timedelta(hours=150))
+    assert [reading.datetime for reading in readings] == [
+        NOW - timedelta(hours=100), NOW - timedelta(hours=1)]
+
+
+def test_cache_size_is_bounded(monkeypatch):
+    """ Each station only keeps so many readings. """
+    monkeypatch.setenv('WFWX_HOURLIES_CACHE_SIZE', '2')
+    cache = HourlyReadingsCache()
+    readings = cache.merge('station', [_reading(3), _reading(2), _reading(1)],
+                           NOW - timedelta(days=5))
+    assert len(readings) == 2
@@ -0,0 +1,193 @@
+""" Unit tests for calculating percentiles from percentile sketches """
+# pylint: disable=redefined-outer-name
+import os
+import sys
+import json
+import importlib.util
+import numpy as np
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+import app.percentile
+from app.percentile import PercentileSketches, get_precalculated_percentiles
+from app import schemas
+
+
+def _load_offline_script():
+    """ Load the script that generates the sketches (it's not part of the app package). """
+    filename = os.path.join(os.path.dirname(__file__), '..', '..', 'scripts',
+                            'calculate_percentile_offline.py')
+    spec = importlib.util.spec_from_file_location('calculate_percentile_offline', filename)
+    module = importlib.util.module_from_spec(spec)
+    # Register the module, so that its functions can be sent to worker processes.
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+SCRIPT = _load_offline_script()
+
+STATIONS = [
+    {'code': str(code), 'name': 'STATION {}'.format(code), 'lat': '50.1', 'long': '-120.1',
+     'ecodivision_name': 'SEMI-ARID STEPPE HIGHLANDS',
+     'core_season': {'start_month': '5', 'start_day': '15', 'end_month': '8', 'end_day': '31'}}
+    for code in (1, 2, 3)
+]
+
+
+def _daily_weather() -> pd.DataFrame:
+    """ Make up some daily weather. """
+    random = np.random.RandomState(42)  # pylint: disable=no-member
+    dates = pd.date_range('1995-01-01', '2019-12-31', freq='3D')
+    frames = []
+    for code, station_dates in ((1, dates),
+                                # Station 2 only has data outside of the core fire season.
+                                (2, dates[dates.month < 5]),  # pylint: disable=no-member
+                                # Station 3 only has data up to 1999.
+                                (3, dates[dates.year < 2000])):  # pylint: disable=no-member
+        frame = pd.DataFrame({
+            'weather_date': station_dates.strftime('%Y%m%d').astype(int),
+            'station_code': code})
+        for key in ('ffmc', 'isi', 'bui'):
+            frame[key] = np.round(random.uniform(0, 100, len(frame)), 3)
+            frame['{}_valid'.format(key)] = random.uniform(size=len(frame)) > 0.1
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def daily_weather() -> pd.DataFrame:
+    """ Daily weather, as the offline script would read it. """
+    weather = _daily_weather()
+    SCRIPT.split_dates_into_multiple_cols(weather)
+    return weather
+
+
+@pytest.fixture(scope='module')
+def season_values(daily_weather) -> pd.DataFrame:
+    """ Core fire season values, as selected by the offline script. """
+    return SCRIPT.get_season_values(daily_weather, STATIONS)
+
+
+@pytest.fixture(scope='module')
+def station_years(daily_weather) -> pd.DataFrame:
+    """ Years with data for each station, as selected by the offline script. """
+    return SCRIPT.get_station_years(daily_weather)
+
+
+@pytest.fixture()
+def sketches(monkeypatch, tmp_path, season_values, station_years) -> PercentileSketches:
+    """ Sketches generated by the offline script. """
+    filename = str(tmp_path / 'sketches.npz')
+    SCRIPT.pack_sketches(season_values, station_years, STATIONS, filename)
+    loaded = PercentileSketches.load(filename)
+    monkeypatch.setattr(app.percentile, '_PERCENTILE_SKETCHES', loaded)
+    return loaded
+
+
+def _remove_data_outside_fire_season(weather: pd.DataFrame, station: dict) -> pd.DataFrame:
+    """ Remove data recorded outside of the station's core fire season, one station at a time. """
+    season = {key: int(value) for key, value in station['core_season'].items()}
+    weather = weather[(weather['month'] >= season['start_month']) & (weather['month'] <= season['end_month'])]
+    weather = weather[~((weather['month'] == season['start_month']) & (weather['day'] < season['start_day']))]
+    return weather[~((weather['month'] == season['end_month']) & (weather['day'] > season['end_day']))]
+
+
+def _expected_summary(weather: pd.DataFrame, station: dict, start_year: int, end_year: int,
+                      percentile: int) -> dict:
+    """ Calculate the summary one station at a time, the way the offline script used to. """
+    year_range = list(range(start_year, end_year + 1))
+    year_df = weather[weather['year'].isin(year_range)]
+    station_df = year_df[year_df['station_code'] == int(station['code'])]
+    if station_df.empty:
+        return SCRIPT.create_null_summary(station, year_range)
+    station_df = _remove_data_outside_fire_season(station_df, station)
+    summary = {}
+    years = set()
+    for key in ('ffmc', 'isi', 'bui'):
+        valid_df = station_df[station_df['{}_valid'.format(key)]]
+        value = valid_df[key].quantile(percentile / 100)
+        summary[key] = round(value, SCRIPT.NUMBER_OF_DECIMAL_POINT) if not pd.isna(value) else None
+        years |= set(valid_df['year'].unique().tolist())
+    summary['years'] = sorted(years)
+    summary['station'] = station
+    return summary
+
+
+@pytest.mark.parametrize('start_year,end_year,percentile', [
+    (1995, 2019, 90), (2000, 2019, 90), (2010, 2019, 90), (1997, 2003, 50), (2005, 2005, 99),
+    (1990, 1994, 90)])
+@pytest.mark.usefixtures('sketches')
+def test_matches_offline_calculation(daily_weather, start_year, end_year, percentile):
+    """ Percentiles calculated from the sketches should match those calculated offline. """
+    response = get_precalculated_percentiles(schemas.PercentileRequest(
+        stations=[1, 2, 3], percentile=percentile,
+        year_range=schemas.YearRange(start=start_year, end=end_year)))
+    assert response.percentile == percentile
+    for station in STATIONS:
+        expected = schemas.StationSummary(
+            **_expected_summary(daily_weather, station, start_year, end_year, percentile))
+        assert response.stations[int(station['code'])] == expected
+
+
+@pytest.mark.usefixtures('sketches')
+def test_unknown_station():
+    """ Asking for a station we don't have sketches for is a bad request. """
+    with pytest.raises(HTTPException) as excinfo:
+        get_precalculated_percentiles(schemas.PercentileRequest(
+            stations=[1, 4], percentile=90, year_range=schemas.YearRange(start=2000, end=2019)))
+    assert excinfo.value.status_code == 400
+
+
+@pytest.mark.usefixtures('sketches')
+def test_invalid_percentile():
+    """ Percentiles are between 0 and 100. """
+    with pytest.raises(HTTPException) as excinfo:
+        get_precalculated_percentiles(schemas.PercentileRequest(
+            stations=[1], percentile=101, year_range=schemas.YearRange(start=2000, end=2019)))
+    assert excinfo.value.status_code == 400
+
+
+@pytest.mark.usefixtures('sketches')
+def test_invalid_year_range():
+    """ A year range can't end before it starts. """
+    with pytest.raises(HTTPException) as excinfo:
+        get_precalculated_percentiles(schemas.PercentileRequest(
+            stations=[1], percentile=90, year_range=schemas.YearRange(start=2019, end=2000)))
+    assert excinfo.value.status_code == 400
+
+
+def test_empty_year_range(sketches):
+    """ A station has no data for a year range that ends before it starts. """
+    summary = sketches.get_summary(1, 2019, 2000, 0.9)
+    assert (summary.ffmc, summary.isi, summary.bui, summary.years) == (None, None, None, [])
+
+
+@pytest.mark.parametrize('year_range', [(1970, 2019), (2000, 2019), (2010, 2019), (1990, 1994)])
+def test_summaries_match_per_station_calculation(tmp_path, daily_weather, season_values, station_years,
+                                                 year_range):
+    """ The json written by the offline script should match, byte for byte, the json we wrote when
+    calculating one station at a time. """
+    start_year, end_year = year_range
+    SCRIPT.calculate_ranges(season_values, station_years, STATIONS, [(start_year, end_year)],
+                            str(tmp_path))
+    for station in STATIONS:
+        expected = _expected_summary(daily_weather, station, start_year, end_year, 90)
+        with open(str(tmp_path / '{}-{}'.format(start_year, end_year) / '{}.json'.format(
+                station['code']))) as json_file:
+            assert json_file.read() == json.dumps(expected, indent=4, allow_nan=False)
+
+
+def test_read_daily_weather(tmp_path):
+    """ The daily weather csv is read with the types we expect. """
+    filename = tmp_path / 'DailyWeather.csv'
+    filename.write_text('"station_code","weather_date","temperature","ffmc","ffmc_valid","isi",'
+                        '"isi_valid","bui","bui_valid"\n'
+                        '"322","20190531","12.5","85.2","True","3.1","False","40","True"\n')
+    weather = SCRIPT.read_daily_weather(str(filename))
+    assert list(weather.columns) == ['station_code', 'weather_date', 'ffmc', 'ffmc_valid', 'isi',
+                                     'isi_valid', 'bui', 'bui_valid']
+    assert weather.dtypes.to_dict() == {key: np.dtype(value)
+                                        for key, value in SCRIPT.DAILY_WEATHER_DTYPES.items()}
+    SCRIPT.split_dates_into_multiple_cols(weather)
+    assert weather[['year', 'month', 'day']].iloc[0].tolist() == [2019, 5, 31]
@@ -0,0 +1,90 @@
+""" Unit tests for the percentile store in app/percentile.py """
+import os
+import json
+import shutil
+from statistics import mean
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from app import schemas
+from app.percentile import (PercentileStore, get_precalculated_percentiles, _mmap_npz, DATA_PATH,
+                            PACKED_FILENAME)
+
+
+def _request(stations, start=2010, end=2019) -> schemas.PercentileRequest:
+    return schemas.PercentileRequest(
+        stations=stations, percentile=90, year_range=schemas.YearRange(start=start, end=end))
+
+
+def test_store_matches_files():
+    """ The summaries in the store should be the same as the ones in the files. """
+    filename = os.path.join(DATA_PATH, '2010-2019', '331.json')
+    expected = schemas.StationSummary.parse_file(filename)
+    response = get_precalculated_percentiles(_request([331, 328]))
+    assert response.stations[331] == expected
+    assert list(response.stations) == [331, 328]
+
+
+def test_mean_values():
+    """ The mean should only include stations that have all of ffmc, isi and bui. """
+    codes = [331, 328, 1281]
+    summaries = [schemas.StationSummary.parse_file(os.path.join(DATA_PATH, '2010-2019', '{}.json'.format(
+        code))) for code in codes]
+    summaries = [summary for summary in summaries if summary.bui and summary.isi and summary.ffmc]
+    response = get_precalculated_percentiles(_request(codes))
+    assert response.mean_values.ffmc == pytest.approx(mean(summary.ffmc for summary in summaries))
+    assert response.mean_values.isi == pytest.approx(mean(summary.isi for summary in summaries))
+    assert response.mean_values.bui == pytest.approx(mean(summary.bui for summary in summaries))
+
+
+def test_unknown_station():
+    """ Asking for a station we don't have percentiles for is a bad request. """
+    with pytest.raises(HTTPException) as excinfo:
+        get_precalculated_percentiles(_request([331, 999999]))
+    assert excinfo.value.status_code == 400
+
+
+def test_load(tmp_path):
+    """ The store should report how long it took to load and how much memory it uses, and skip invalid
+    files. """
+    data_path = tmp_path / 'percentile_data'
+    os.makedirs(data_path / 'ignored')
+    os.makedirs(data_path / '2010-2019')
+    shutil.copy(os.path.join(DATA_PATH, '2010-2019', '331.json'), data_path / '2010-2019' / '331.json')
+    with open(data_path / '2010-2019' / '1.json', 'w') as invalid_file:
+        json.dump({'years': []}, invalid_file)
+
+    store = PercentileStore(str(data_path))
+    store.load()
+    assert list(store.ranges) == [(2010, 2019)]
+    assert list(store.get_range(2010, 2019).index) == [331]
+    assert store.load_time > 0
+    assert store.memory_footprint > 0
+
+
+def test_packed_store_matches_json(tmp_path):
+    """ The packed file should hold the same percentiles as the json files (i.e. it's up to date). """
+    packed = PercentileStore()
+    packed.load()
+    # Without the packed file, the json files are loaded.
+    for name in os.listdir(DATA_PATH):
+        if name != PACKED_FILENAME:
+            os.symlink(os.path.join(DATA_PATH, name), tmp_path / name)
+    unpacked = PercentileStore(str(tmp_path))
+    unpacked.load()
+
+    assert list(packed.ranges) == list(unpacked.ranges)
+    for year_range, packed_range in packed.ranges.items():
+        unpacked_range = unpacked.ranges[year_range]
+        assert packed_range.index.keys() == unpacked_range.index.keys()
+        for code, row in packed_range.index.items():
+            assert packed_range.get_summary(row) == unpacked_range.get_summary(unpacked_range.index[code])
+
+
+def test_packed_arrays_are_memory_mapped():
+    """ Arrays in the packed file should be memory mapped, rather than read into memory. """
+    arrays = _mmap_npz(os.path.join(DATA_PATH, PACKED_FILENAME))
+    assert isinstance(arrays['ffmc'], np.memmap)
+    with np.load(os.path.join(DATA_PATH, PACKED_FILENAME)) as expected:
+        for name, array in arrays.items():
+            np.testing.assert_array_equal(array, expected[name])
@@ -0,0 +1,115 @@
+""" Unit tests for request coalescing in app/wildfire_one.py """
+import asyncio
+import pytest
+import app.wildfire_one
+from app.wildfire_one import RequestCoalescer
+from app.schemas import WeatherStation, WeatherStationHourlyReadings, Season
+
+
+def _counting_request(calls: dict, result=None, exception: Exception = None):
+    """ Return a request that keeps track of how many times it's made. """
+    async def request():
+        calls['count'] += 1
+        # Give other callers a chance to join in.
+        await asyncio.sleep(0.01)
+        if exception:
+            raise exception
+        return result
+    return request
+
+
+def test_concurrent_requests_are_shared():
+    """ Concurrent callers asking for the same thing should share one request. """
+    calls = {'count': 0}
+    coalescer = RequestCoalescer('test')
+    request = _counting_request(calls, 'result')
+
+    async def run():
+        return await asyncio.gather(*[coalescer.run('key', request) for _ in range(5)])
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == ['result'] * 5
+    assert calls['count'] == 1
+    assert (coalescer.hits, coalescer.misses) == (4, 1)
+    assert coalescer.in_flight == {}
+
+
+def test_different_keys_are_not_shared():
+    """ Requests for different things should each be made. """
+    calls = {'count': 0}
+    coalescer = RequestCoalescer('test')
+    request = _counting_request(calls)
+
+    async def run():
+        await asyncio.gather(coalescer.run('a', request), coalescer.run('b', request))
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert calls['count'] == 2
+
+
+def test_failures_are_not_remembered():
+    """ Everyone waiting on a failed request gets the failure, but the next caller tries again. """
+    calls = {'count': 0}
+    coalescer = RequestCoalescer('test')
+    request = _counting_request(calls, exception=ValueError('oops'))
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        return await asyncio.gather(coalescer.run('key', request), coalescer.run('key', request),
+                                    return_exceptions=True)
+
+    results = loop.run_until_complete(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    with pytest.raises(ValueError):
+        loop.run_until_complete(coalescer.run('key', request))
+    assert calls['count'] == 2
+
+
+def test_cancelled_caller_does_not_cancel_request():
+    """ One caller giving up shouldn't affect anyone else waiting on the same request. """
+    calls = {'count': 0}
+    coalescer = RequestCoalescer('test')
+    request = _counting_request(calls, 'result')
+
+    async def run():
+        impatient = asyncio.ensure_future(coalescer.run('key', request))
+        patient = asyncio.ensure_future(coalescer.run('key', request))
+        await asyncio.sleep(0)
+        impatient.cancel()
+        return await patient
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == 'result'
+    assert calls['count'] == 1
+
+
+def test_fetch_hourlies_is_coalesced(monkeypatch):
+    """ Concurrent requests for the same station's hourlies should result in one WFWX request. """
+    calls = {'count': 0}
+    raw_station = {'id': 'abc', 'stationCode': 1}
+    readings = WeatherStationHourlyReadings(
+        values=[], station=WeatherStation(code=1, name='A', lat=0, long=0, core_season=Season(
+            start_month=5, start_day=1, end_month=8, end_day=31)))
+    fetch = _counting_request(calls, readings)
+    # pylint: disable=unused-argument
+    monkeypatch.setattr(app.wildfire_one, '_fetch_hourlies', lambda *args: fetch())
+
+    async def run():
+        return await asyncio.gather(*[app.wildfire_one.fetch_hourlies(None, raw_station, {})
+                                      for _ in range(3)])
+
+    results = asyncio.get_event_loop().run_until_complete(run())
+    assert calls['count'] == 1
+    # Each caller gets its own list of values.
+    assert results[0].values is not results[1].values
+
+
+def test_get_stations_by_codes_keeps_order():
+    """ Requests for the same stations in a different order are shared, but each caller gets the
+    stations in the order they asked for. """
+    async def run():
+        return await asyncio.gather(app.wildfire_one.get_stations_by_codes([331, 322]),
+                                    app.wildfire_one.get_stations_by_codes([322, 331]))
+
+    first, second = asyncio.get_event_loop().run_until_complete(run())
+    assert [station.code for station in first] == [331, 322]
+    assert [station.code for station in second] == [322, 331]
+    assert app.wildfire_one.STATIONS_COALESCER.hits >= 1
@@ -0,0 +1,75 @@
+""" Unit tests for the station catalog in app/wildfire_one.py """
+import asyncio
+from app.schemas import WeatherStation, Season
+from app.wildfire_one import StationCatalog
+
+
+def _create_station(code: int) -> WeatherStation:
+    """ Create a station with the given code. """
+    return WeatherStation(code=code, name='STATION {}'.format(code), lat=50, long=-120,
+                          core_season=Season(start_month=5, start_day=1, end_month=9, end_day=15))
+
+
+class MockLoader:
+    """ Station loader that keeps track of how many times it's been called. """
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+
+    async def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise Exception('WFWX is down')
+        return [_create_station(code) for code in range(self.calls, self.calls + 3)]
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def test_stations_are_loaded_once():
+    """ The catalog should only be loaded once while it's fresh. """
+    loader = MockLoader()
+    catalog = StationCatalog('test', loader)
+    assert [station.code for station in _run(catalog.get_stations())] == [1, 2, 3]
+    assert [station.code for station in _run(catalog.get_stations_by_codes([3, 1, 42]))] == [3, 1]
+    assert loader.calls == 1
+
+
+def test_stale_catalog_is_served_while_refreshing(monkeypatch):
+    """ A stale catalog should be served as is, with a refresh happening in the background. """
+    monkeypatch.setenv('STATION_CATALOG_TTL', '0')
+    loader = MockLoader()
+    catalog = StationCatalog('test', loader)
+    _run(catalog.get_stations())
+    loaded_at = catalog.loaded_at
+
+    async def get_stations_then_refresh():
+        stations = await catalog.get_stations()
+        # The refresh hasn't happened yet.
+        assert catalog.loaded_at == loaded_at
+        # Let the background refresh complete.
+        await asyncio.sleep(0)
+        return stations
+
+    assert [station.code for station in _run(get_stations_then_refresh())] == [1, 2, 3]
+    assert [station.code for station in catalog.stations] == [2, 3, 4]
+    assert loader.calls == 2
+
+
+def test_stale_catalog_kept_if_refresh_fails(monkeypatch):
+    """ If the refresh fails, we keep serving what we have. """
+    monkeypatch.setenv('STATION_CATALOG_TTL', '0')
+    loader = MockLoader()
+    catalog = StationCatalog('test', loader)
+    _run(catalog.get_stations())
+    loader.fail = True
+
+    async def get_stations_then_refresh():
+        stations = await catalog.get_stations()
+        await asyncio.sleep(0)
+        return stations
+
+    assert [station.code for station in _run(get_stations_then_refresh())] == [1, 2, 3]
+    assert [station.code for station in _run(catalog.get_stations())] == [1, 2, 3]
@@ -0,0 +1,138 @@
+""" Unit tests for the WFWX access token cache in app/wildfire_one.py """
+import asyncio
+import pytest
+from aiohttp import ClientSession, ClientResponseError, web
+from aiohttp.test_utils import TestServer
+import app.wildfire_one
+from app.wildfire_one import AccessTokenManager, WFWXClient
+from app.tests.common import default_mock_client_get
+
+
+def _count_token_fetches(monkeypatch) -> dict:
+    """ Mock out fetching the token, and keep track of how many times it's called. """
+    calls = {'count': 0}
+
+    async def mock_fetch_access_token(client):  # pylint: disable=unused-argument
+        calls['count'] += 1
+        # Give concurrent callers a chance to pile up.
+        await asyncio.sleep(0.01)
+        return {'access_token': 'token{}'.format(calls['count']), 'expires_in': 43199}
+
+    monkeypatch.setattr(app.wildfire_one, '_fetch_access_token',
+                        mock_fetch_access_token)
+    return calls
+
+
+def test_concurrent_requests_share_one_refresh(monkeypatch):
+    """ Concurrent callers should all wait on the same token refresh. """
+    calls = _count_token_fetches(monkeypatch)
+    manager = AccessTokenManager()
+
+    async def run():
+        return await asyncio.gather(*[manager.get_access_token(None) for _ in range(5)])
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == ['token1'] * 5
+    assert calls['count'] == 1
+    assert manager.misses == 5
+    assert manager.hits == 0
+
+
+def test_token_is_cached_until_it_expires(monkeypatch):
+    """ The token should be re-used until it expires. """
+    calls = _count_token_fetches(monkeypatch)
+    manager = AccessTokenManager()
+    loop = asyncio.get_event_loop()
+
+    assert loop.run_until_complete(manager.get_access_token(None)) == 'token1'
+    assert loop.run_until_complete(manager.get_access_token(None)) == 'token1'
+    assert (manager.hits, manager.misses) == (1, 1)
+
+    # Pretend the token has expired.
+    manager.expires_at = 0
+    assert loop.run_until_complete(manager.get_access_token(None)) == 'token2'
+    assert calls['count'] == 2
+
+
+def test_expiry_margin(monkeypatch):
+    """ The token should be considered expired a little while before it actually expires. """
+    monkeypatch.setenv('WFWX_TOKEN_EXPIRY_MARGIN', '43200')
+    calls = _count_token_fetches(monkeypatch)
+    manager = AccessTokenManager()
+    loop = asyncio.get_event_loop()
+
+    loop.run_until_complete(manager.get_access_token(None))
+    loop.run_until_complete(manager.get_access_token(None))
+    assert calls['count'] == 2
+
+
+def test_fetch_from_fixture(monkeypatch):
+    """ The token should be read from the WFWX auth response. """
+    monkeypatch.setattr(ClientSession, 'get', default_mock_client_get)
+    manager = AccessTokenManager()
+
+    async def run():
+        client = WFWXClient()
+        try:
+            return await manager.get_access_token(client)
+        finally:
+            await client.close()
+
+    assert asyncio.get_event_loop().run_until_complete(run()).startswith('eyJhbGciOiJIUzI1NiJ9')
+
+
+def _get_against_stub(monkeypatch, valid_tokens):
+    """ Make an authorized request against a stub WFWX server that only accepts the given tokens.
+    Returns a tuple of (result, authorization headers of every request the server received). """
+    monkeypatch.setattr(app.wildfire_one, 'ACCESS_TOKEN_MANAGER', AccessTokenManager())
+    received = []
+
+    async def handler(request):
+        received.append(request.headers['Authorization'])
+        if request.headers['Authorization'] in valid_tokens:
+            return web.json_response({'ok': True})
+        return web.json_response({}, status=401)
+
+    async def run():
+        stub = web.Application()
+        stub.router.add_get('/', handler)
+        server = TestServer(stub)
+        await server.start_server()
+        client = WFWXClient()
+        try:
+            # pylint: disable=protected-access
+            headers = await app.wildfire_one._get_auth_header(client)
+            return await app.wildfire_one._get_authorized_json(client, str(server.make_url('/')), headers)
+        except ClientResponseError as exception:
+            return exception
+        finally:
+            await client.close()
+            await server.close()
+
+    return asyncio.get_event_loop().run_until_complete(run()), received
+
+
+def test_rejected_token_is_refreshed(monkeypatch):
+    """ A token that WFWX rejects before it was due to expire is replaced, and the request tried again """
+    calls = _count_token_fetches(monkeypatch)
+    result, received = _get_against_stub(monkeypatch, ['Bearer token2'])
+    assert result == {'ok': True}
+    assert received == ['Bearer token1', 'Bearer token2']
+    assert calls['count'] == 2
+
+
+def test_rejected_token_is_retried_once(monkeypatch):
+    """ A request is only tried once more with a new token """
+    _count_token_fetches(monkeypatch)
+    result, received = _get_against_stub(monkeypatch, [])
+    assert isinstance(result, ClientResponseError)
+    assert result.status == 401
+    assert received == ['Bearer token1', 'Bearer token2']
+
+
+@pytest.mark.parametrize('cached_token, expected', [('token1', None), ('token2', 'token2')])
+def test_invalidate(cached_token, expected):
+    """ Invalidating a token that is no longer cached leaves the cached token alone """
+    manager = AccessTokenManager()
+    manager.access_token, manager.expires_at = cached_token, 1
+    manager.invalidate('token1')
+    assert manager.access_token == expected
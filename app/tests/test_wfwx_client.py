@@ -0,0 +1,183 @@
+""" Unit tests for the shared WFWX client in app/wildfire_one.py """
+import asyncio
+import pytest
+from aiohttp import web, ClientResponseError
+from aiohttp.test_utils import TestServer
+from app import wildfire_one
+from app.circuit_breaker import CircuitBreaker, WFWXUnavailableException
+
+
+def test_client_is_shared():
+    """ The same client (and connection pool) should be re-used across requests. """
+    async def run():
+        client = await wildfire_one.open_wfwx_client()
+        assert wildfire_one.get_wfwx_client() is client
+        assert wildfire_one.get_wfwx_client() is client
+        await wildfire_one.close_wfwx_client()
+        assert client.closed
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def test_client_per_event_loop():
+    """ Each event loop gets its own client, and a client isn't dropped (unclosed) when another event
+    loop asks for one. """
+    main_loop = asyncio.get_event_loop()
+    client = main_loop.run_until_complete(wildfire_one.open_wfwx_client())
+    other_loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(other_loop)
+        other_client = other_loop.run_until_complete(wildfire_one.open_wfwx_client())
+        assert other_client is not client
+        other_loop.run_until_complete(wildfire_one.close_wfwx_client())
+        assert other_client.closed
+    finally:
+        asyncio.set_event_loop(main_loop)
+        other_loop.close()
+    assert not client.closed
+    assert wildfire_one.get_wfwx_client() is client
+    main_loop.run_until_complete(wildfire_one.close_wfwx_client())
+    assert client.closed
+
+
+def test_connection_pool_is_configurable(monkeypatch):
+    """ Connection pool limits should be read from config. """
+    monkeypatch.setenv('WFWX_CONNECTION_LIMIT_PER_HOST', '3')
+    monkeypatch.setenv('WFWX_CONNECTION_LIMIT', '7')
+
+    async def run():
+        # Make sure we're not picking up a client opened elsewhere.
+        await wildfire_one.close_wfwx_client()
+        client = await wildfire_one.open_wfwx_client()
+        connector = client.session.connector
+        assert (connector.limit_per_host, connector.limit) == (3, 7)
+        await wildfire_one.close_wfwx_client()
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+def _run_against_stub(monkeypatch, handler, requests):
+    """ Start a stub WFWX server that answers with handler, and make some requests against it.
+
+    Returns a tuple of (results, client metrics, number of times the server was called).
+    """
+    # Keep retries quick.
+    monkeypatch.setenv('WFWX_RETRY_BACKOFF', '0')
+    calls = {'count': 0}
+
+    async def counting_handler(request):
+        calls['count'] += 1
+        return await handler(request)
+
+    async def run():
+        stub = web.Application()
+        stub.router.add_get('/', counting_handler)
+        server = TestServer(stub)
+        await server.start_server()
+        client = wildfire_one.WFWXClient()
+        results = []
+        try:
+            for _ in range(requests):
+                try:
+                    results.append(await client.get_json(str(server.make_url('/'))))
+                except Exception as exception:  # pylint: disable=broad-except
+                    results.append(exception)
+        finally:
+            await client.close()
+            await server.close()
+        return results, client.get_metrics()
+
+    results, metrics = asyncio.get_event_loop().run_until_complete(run())
+    return results, metrics, calls['count']
+
+
+def test_retry_on_server_error(monkeypatch):
+    """ A server error might go away if we try again. """
+    responses = [503, 200]
+
+    async def handler(request):  # pylint: disable=unused-argument
+        return web.json_response({'ok': True}, status=responses.pop(0))
+
+    results, metrics, calls = _run_against_stub(monkeypatch, handler, 1)
+    assert results == [{'ok': True}]
+    assert calls == 2
+    assert metrics['retries'] == 1
+
+
+def test_no_retry_on_client_error(monkeypatch):
+    """ Asking again for something that isn't there won't help. """
+    async def handler(request):  # pylint: disable=unused-argument
+        return web.json_response({}, status=404)
+
+    results, metrics, calls = _run_against_stub(monkeypatch, handler, 1)
+    assert isinstance(results[0], ClientResponseError)
+    assert results[0].status == 404
+    assert calls == 1
+    assert metrics['failures'] == 0
+
+
+def test_request_timeout(monkeypatch):
+    """ A slow server should not hold up the request indefinitely. """
+    monkeypatch.setenv('WFWX_REQUEST_TIMEOUT', '0.1')
+    monkeypatch.setenv('WFWX_MAX_RETRIES', '1')
+
+    async def handler(request):  # pylint: disable=unused-argument
+        # aiohttp rounds timeouts up to the next second, so we have to be a lot slower than the timeout.
+        await asyncio.sleep(3)
+        return web.json_response({})
+
+    results, metrics, calls = _run_against_stub(monkeypatch, handler, 1)
+    assert isinstance(results[0], asyncio.TimeoutError)
+    assert calls == 2
+    assert metrics['timeouts'] == 2
+
+
+def test_circuit_breaker_opens(monkeypatch):
+    """ Once most calls are failing, we should stop calling the server altogether. """
+    monkeypatch.setenv('WFWX_MAX_RETRIES', '0')
+    monkeypatch.setenv('WFWX_CIRCUIT_BREAKER_MIN_CALLS', '4')
+
+    async def handler(request):  # pylint: disable=unused-argument
+        return web.json_response({}, status=500)
+
+    results, metrics, calls = _run_against_stub(monkeypatch, handler, 6)
+    assert calls == 4
+    assert all(isinstance(result, wildfire_one.WFWXUnavailableException) for result in results[4:])
+    assert metrics['circuit_breaker'] == 'open'
+    assert metrics['rejected'] == 2
+
+
+def test_circuit_breaker_unexpected_exception(monkeypatch):
+    """ A trial call that fails in an unexpected way re-opens the breaker, rather than leaving it waiting
+    on the trial call forever. """
+    monkeypatch.setenv('WFWX_MAX_RETRIES', '0')
+    monkeypatch.setenv('WFWX_CIRCUIT_BREAKER_MIN_CALLS', '1')
+    monkeypatch.setenv('WFWX_CIRCUIT_BREAKER_RESET_TIMEOUT', '0')
+    responses = [web.json_response({}, status=500),
+                 web.Response(text='{"ok":', content_type='application/json'),
+                 web.json_response({'ok': True})]
+
+    async def handler(request):  # pylint: disable=unused-argument
+        return responses.pop(0)
+
+    results, metrics, calls = _run_against_stub(monkeypatch, handler, 3)
+    assert isinstance(results[0], ClientResponseError)
+    assert isinstance(results[1], ValueError)
+    assert results[2] == {'ok': True}
+    assert calls == 3
+    assert metrics['failures'] == 2
+    assert metrics['circuit_breaker'] == 'closed'
+
+
+def test_circuit_breaker_half_open():
+    """ After a while, a single trial call is let through, and closes the breaker if it succeeds. """
+    breaker = CircuitBreaker(window=4, min_calls=2, failure_ratio=0.5, reset_timeout=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(WFWXUnavailableException):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
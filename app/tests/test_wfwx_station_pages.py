@@ -0,0 +1,31 @@
+""" Unit tests for fetching paged stations in app/wildfire_one.py """
+import asyncio
+import app.wildfire_one
+from app.wildfire_one import BuildQueryAllStations
+
+
+def test_pages_fetched_concurrently_and_yielded_in_order(monkeypatch):
+    """ Once we know how many pages there are, the rest should be requested at the same time,
+    with the stations still coming out in page order. """
+    in_flight = {'current': 0, 'max': 0}
+
+    # pylint: disable=unused-argument
+    async def mock_fetch_stations_page(client, headers, query_builder, page):
+        in_flight['current'] += 1
+        in_flight['max'] = max(in_flight['max'], in_flight['current'])
+        # Later pages arrive first.
+        await asyncio.sleep(0.01 * (5 - page))
+        in_flight['current'] -= 1
+        return {'page': {'totalPages': 5},
+                '_embedded': {'stations': [page * 10, page * 10 + 1]}}
+
+    monkeypatch.setattr(app.wildfire_one, '_fetch_stations_page', mock_fetch_stations_page)
+    monkeypatch.setenv('WFWX_MAX_CONCURRENT_PAGES', '3')
+
+    async def run():
+        return [station async for station in app.wildfire_one._fetch_raw_stations(  # pylint: disable=protected-access
+            None, {}, BuildQueryAllStations())]
+
+    stations = asyncio.get_event_loop().run_until_complete(run())
+    assert stations == [0, 1, 10, 11, 20, 21, 30, 31, 40, 41]
+    assert in_flight['max'] == 3
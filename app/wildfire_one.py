@@ -4,15 +4,27 @@ import os
 import json
 from datetime import datetime, timedelta, timezone
 import math
+import functools
+import time
+import random
 from abc import abstractmethod, ABC
 import logging
-from typing import List
+from typing import List, Dict, Sequence, Callable, Awaitable, AsyncGenerator, Union
 import asyncio
+import weakref
+from collections import deque
+import numpy as np
 import geopandas
-from aiohttp import ClientSession, BasicAuth, TCPConnector
+from aiohttp import (ClientSession, BasicAuth, TCPConnector, ClientTimeout, ClientResponseError,
+                     ClientConnectionError)
 from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from . import config
-from .schemas import WeatherStation, WeatherStationHourlyReadings, WeatherReading
+from .schemas import (WeatherStation, WeatherStationHourlyReadings, WeatherStationHourlyReadingsError,
+                      WeatherReading)
+from .hourlies_columns import parse_hourlies_columns, columns_to_readings, column_to_list
+from .circuit_breaker import CircuitBreaker, WFWXUnavailableException
 
 LOGGER = logging.getLogger(__name__)
 
@@ -73,45 +85,360 @@ class BuildQueryByStationCode(BuildQuery):
         return [url, params]
 
 
-async def _fetch_access_token(session: ClientSession) -> dict:
+class WFWXClient():
+    """ Pooled http client for the WFWX Fireweather API.
+
+    A single client is shared for the lifetime of the application, so that connections (and the TLS
+    handshakes that go with them) are re-used across requests.
+
+    Requests made through the client are protected by a timeout, retried (with jittered exponential
+    backoff) if they fail in a way that might be temporary, limited to a maximum number in flight at
+    any one time, and blocked outright by a circuit breaker if WFWX keeps failing.
+    """
+
+    def __init__(self):
+        """ Initialize object """
+        connector = TCPConnector(
+            # Total number of simultaneous connections.
+            limit=int(config.get('WFWX_CONNECTION_LIMIT', 100)),
+            # Number of simultaneous connections to the same host.
+            limit_per_host=int(config.get(
+                'WFWX_CONNECTION_LIMIT_PER_HOST', 10)),
+            # Seconds to keep an idle connection open for re-use.
+            keepalive_timeout=float(config.get('WFWX_KEEPALIVE_TIMEOUT', 30)),
+            use_dns_cache=True,
+            ttl_dns_cache=int(config.get('WFWX_DNS_CACHE_TTL', 300)))
+        timeout = ClientTimeout(
+            total=float(config.get('WFWX_REQUEST_TIMEOUT', 30)),
+            sock_connect=float(config.get('WFWX_CONNECT_TIMEOUT', 5)))
+        self.session = ClientSession(connector=connector, timeout=timeout)
+        self.max_retries = int(config.get('WFWX_MAX_RETRIES', 2))
+        self.retry_backoff = float(config.get('WFWX_RETRY_BACKOFF', 0.5))
+        self.semaphore = asyncio.Semaphore(
+            int(config.get('WFWX_MAX_CONCURRENT_REQUESTS', 20)))
+        self.circuit_breaker = CircuitBreaker(
+            window=int(config.get('WFWX_CIRCUIT_BREAKER_WINDOW', 20)),
+            min_calls=int(config.get('WFWX_CIRCUIT_BREAKER_MIN_CALLS', 10)),
+            failure_ratio=float(config.get(
+                'WFWX_CIRCUIT_BREAKER_FAILURE_RATIO', 0.5)),
+            reset_timeout=float(config.get('WFWX_CIRCUIT_BREAKER_RESET_TIMEOUT', 30)))
+        self.metrics = {'requests': 0, 'retries': 0, 'timeouts': 0,
+                        'failures': 0, 'rejected': 0, 'in_flight': 0}
+
+    @property
+    def closed(self) -> bool:
+        """ Return True if the client can no longer be used. """
+        return self.session.closed
+
+    async def close(self):
+        """ Close the client, and all pooled connections. """
+        await self.session.close()
+
+    def get_metrics(self) -> dict:
+        """ Return request metrics, and the state of the circuit breaker. """
+        return dict(self.metrics, circuit_breaker=self.circuit_breaker.state)
+
+    @staticmethod
+    def _is_retryable(exception: Exception) -> bool:
+        """ Return True if the request failed in a way that might succeed if we try again. """
+        if isinstance(exception, ClientResponseError):
+            return exception.status >= 500 or exception.status == 429
+        return isinstance(exception, (asyncio.TimeoutError, ClientConnectionError))
+
+    async def _get_json(self, url: str, **kwargs) -> dict:
+        """ Make a single GET request, returning the json response. """
+        async with self.semaphore:
+            self.metrics['requests'] += 1
+            self.metrics['in_flight'] += 1
+            try:
+                async with self.session.get(url, **kwargs) as response:
+                    response.raise_for_status()
+                    return await response.json()
+            finally:
+                self.metrics['in_flight'] -= 1
+
+    async def get_json(self, url: str, **kwargs) -> dict:
+        """ GET a url, returning the json response. Keyword arguments are passed on to
+        ClientSession.get. """
+        try:
+            self.circuit_breaker.before_call()
+        except WFWXUnavailableException:
+            self.metrics['rejected'] += 1
+            raise
+        attempt = 0
+        while True:
+            try:
+                result = await self._get_json(url, **kwargs)
+            except ClientResponseError as exception:
+                if not self._is_retryable(exception):
+                    # WFWX is up, it just doesn't like our request.
+                    self.circuit_breaker.record_success()
+                    raise
+                failure = exception
+            except (asyncio.TimeoutError, ClientConnectionError) as exception:
+                if isinstance(exception, asyncio.TimeoutError):
+                    self.metrics['timeouts'] += 1
+                failure = exception
+            except asyncio.CancelledError:
+                # Nobody is waiting on the result, so we can't say if WFWX is healthy or not.
+                self.circuit_breaker.trial_in_flight = False
+                raise
+            except Exception:
+                # Anything else (e.g. a truncated or malformed body) counts as a failure, that we don't retry.
+                # If it isn't recorded, a half open breaker waits on its trial call forever.
+                self.metrics['failures'] += 1
+                self.circuit_breaker.record_failure()
+                raise
+            else:
+                self.circuit_breaker.record_success()
+                return result
+            if attempt >= self.max_retries or self.circuit_breaker.state != CircuitBreaker.CLOSED:
+                self.metrics['failures'] += 1
+                self.circuit_breaker.record_failure()
+                raise failure
+            # Full jitter, so that clients failing at the same time don't all retry at the same time.
+            delay = random.uniform(0, self.retry_backoff * 2 ** attempt)
+            attempt += 1
+            self.metrics['retries'] += 1
+            LOGGER.warning('retrying %s in %.2f seconds (attempt %d) after %r',
+                           url, delay, attempt, failure)
+            await asyncio.sleep(delay)
+
+
+# A client (and its connections) can only be used on the event loop it was created on, so there's one
+# shared client per event loop. A client is kept until it's closed, or its event loop goes away.
+_WFWX_CLIENTS = weakref.WeakKeyDictionary()
+
+
+async def open_wfwx_client() -> WFWXClient:
+    """ Create the shared WFWX client. Called on application startup. """
+    client = _WFWX_CLIENTS.get(asyncio.get_event_loop())
+    if client is None or client.closed:
+        LOGGER.info('Opening WFWX client')
+    return get_wfwx_client()
+
+
+async def close_wfwx_client():
+    """ Close the shared WFWX client. Called on application shutdown. """
+    client = _WFWX_CLIENTS.pop(asyncio.get_event_loop(), None)
+    if client is not None:
+        LOGGER.info('Closing WFWX client, %s', client.get_metrics())
+        await client.close()
+
+
+def get_wfwx_client() -> WFWXClient:
+    """ Return the shared WFWX client for the current event loop.
+
+    The client is normally opened on application startup, but if it hasn't been (e.g. when running
+    a script, or in unit tests), a new client is created.
+    """
+    loop = asyncio.get_event_loop()
+    client = _WFWX_CLIENTS.get(loop)
+    if client is None or client.closed:
+        client = _WFWX_CLIENTS[loop] = WFWXClient()
+    return client
+
+
+async def _fetch_access_token(client: WFWXClient) -> dict:
     """ Fetch an access token for WFWX Fireweather API
     """
     LOGGER.debug('fetching access token...')
     password = config.get('WFWX_SECRET')
     user = config.get('WFWX_USER')
     auth_url = config.get('WFWX_AUTH_URL')
-    async with session.get(auth_url, auth=BasicAuth(login=user, password=password)) as response:
-        return await response.json()
+    return await client.get_json(auth_url, auth=BasicAuth(login=user, password=password))
+
+
+def _is_pending(task: asyncio.Future) -> bool:
+    """ Return True if the task is still running on the current event loop. """
+    return task is not None and not task.done() and task.get_loop() is asyncio.get_event_loop()
+
+
+class RequestCoalescer():
+    """ Share in-flight requests between concurrent callers.
+
+    Callers asking for the same key while a request for it is already underway wait on that request,
+    rather than each making their own. Once the request completes, the next caller starts a new one, so
+    nothing is cached beyond the lifetime of the request.
+    """
 
+    def __init__(self, name: str):
+        """ Initialize object """
+        self.name = name
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _on_done(self, key, task: asyncio.Future):
+        """ Forget about the request once it's done. """
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        # Every caller may have given up waiting, so make sure the exception counts as retrieved.
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key, request: Callable[[], Awaitable]):
+        """ Return the result of the request in flight for the key, starting one if there isn't. """
+        task = self.in_flight.get(key)
+        if _is_pending(task):
+            self.hits += 1
+            LOGGER.debug('joining in-flight %s request for %s', self.name, key)
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(request())
+            self.in_flight[key] = task
+            task.add_done_callback(functools.partial(self._on_done, key))
+        # Shield the request, so that a cancelled caller doesn't cancel it for everyone else.
+        return await asyncio.shield(task)
+
+
+class AccessTokenManager():
+    """ Cache the WFWX access token, sharing it across requests until shortly before it expires.
+
+    When the token needs refreshing, concurrent callers all wait on the same refresh rather than
+    each fetching a token of their own.
+    """
 
-async def _get_auth_header(session: ClientSession) -> dict:
-    # Fetch access token
-    token = await _fetch_access_token(session)
+    def __init__(self):
+        """ Initialize object """
+        self.access_token = None
+        # Monotonic time after which the access token should no longer be used.
+        self.expires_at = None
+        self.hits = 0
+        self.misses = 0
+        self._refresh_task = None
+
+    def _is_valid(self) -> bool:
+        """ Return True if we have a token that isn't about to expire. """
+        return self.access_token is not None and time.monotonic() < self.expires_at
+
+    async def _refresh(self, client: WFWXClient) -> str:
+        """ Fetch a new access token, and note when we should stop using it. """
+        token = await _fetch_access_token(client)
+        # Stop using the token a little while before it actually expires, to allow for clock skew
+        # and requests that are already in flight.
+        expiry_margin = int(config.get('WFWX_TOKEN_EXPIRY_MARGIN', 300))
+        lifetime = max(int(token.get('expires_in', 0)) - expiry_margin, 0)
+        self.access_token = token['access_token']
+        self.expires_at = time.monotonic() + lifetime
+        LOGGER.info('access token refreshed, valid for %d seconds (%d cache hits, %d misses so far)',
+                    lifetime, self.hits, self.misses)
+        return self.access_token
+
+    async def get_access_token(self, client: WFWXClient) -> str:
+        """ Return a cached access token, fetching a new one if needed. """
+        if self._is_valid():
+            self.hits += 1
+            return self.access_token
+        self.misses += 1
+        if not _is_pending(self._refresh_task):
+            self._refresh_task = asyncio.ensure_future(self._refresh(client))
+        # Shield the refresh, so that a cancelled caller doesn't cancel it for everyone else.
+        return await asyncio.shield(self._refresh_task)
+
+    def invalidate(self, access_token: str):
+        """ Discard the cached token, forcing a refresh on the next request. Nothing is discarded if the
+        cache has already moved on from the given token (e.g. another request already refreshed it). """
+        if access_token == self.access_token:
+            self.access_token = None
+            self.expires_at = None
+
+
+ACCESS_TOKEN_MANAGER = AccessTokenManager()
+
+
+async def _get_auth_header(client: WFWXClient) -> dict:
+    # Get access token
+    access_token = await ACCESS_TOKEN_MANAGER.get_access_token(client)
     # Construct the header.
-    header = {'Authorization': 'Bearer {}'.format(token['access_token'])}
+    header = {'Authorization': 'Bearer {}'.format(access_token)}
     return header
 
 
-async def _fetch_raw_stations(session: ClientSession, headers: dict, query_builder: BuildQuery) -> dict:
+async def _get_authorized_json(client: WFWXClient, url: str, headers: dict, **kwargs) -> dict:
+    """ GET a url from WFWX, with the authorization headers (see _get_auth_header).
+    Should WFWX reject the access token (e.g. it was revoked, or expired early), the cached token is
+    discarded, and the request is tried once more with a new one. The new token is written into headers,
+    so that later requests made with the same headers use it too.
+    """
+    try:
+        return await client.get_json(url, headers=headers, **kwargs)
+    except ClientResponseError as exception:
+        if exception.status not in (401, 403):
+            raise
+        LOGGER.warning('WFWX rejected the access token (%d), fetching a new one', exception.status)
+        ACCESS_TOKEN_MANAGER.invalidate(headers['Authorization'][len('Bearer '):])
+        headers.update(await _get_auth_header(client))
+        return await client.get_json(url, headers=headers, **kwargs)
+
+
+async def _fetch_stations_page(client: WFWXClient, headers: dict, query_builder: BuildQuery,
+                               page: int) -> dict:
+    """ Fetch one page of raw stations from the API. """
+    # Build up the request URL.
+    url, params = query_builder.query(page)
+    LOGGER.debug('loading station page %d...', page)
+    station_json = await _get_authorized_json(client, url, headers, params=params)
+    LOGGER.debug('done loading station page %d.', page)
+    return station_json
+
+
+async def _fetch_raw_stations(client: WFWXClient, headers: dict, query_builder: BuildQuery) -> dict:
     """ Asynchronous generator for iterating through raw stations from the API.
     The station list is a paged response, but this generator abstracts that away.
+
+    We only learn how many pages there are from the first page, after which the remaining pages are
+    requested concurrently (WFWX_MAX_CONCURRENT_PAGES at a time). Stations are yielded in page order,
+    as soon as a page and all the pages before it have arrived.
     """
-    # We don't know how many pages until our first call - so we assume one page to start with.
-    total_pages = 1
-    page_count = 0
-    while page_count < total_pages:
-        # Build up the request URL.
-        url, params = query_builder.query(page_count)
-        LOGGER.debug('loading station page %d...', page_count)
-        async with session.get(url, headers=headers, params=params) as response:
-            station_json = await response.json()
-            LOGGER.debug('done loading station page %d.', page_count)
-        # Update the total page count.
-        total_pages = station_json['page']['totalPages']
-        for station in station_json['_embedded']['stations']:
-            yield station
-        # Keep track of our page count.
-        page_count = page_count + 1
+    station_json = await _fetch_stations_page(client, headers, query_builder, 0)
+    total_pages = station_json['page']['totalPages']
+    for station in station_json['_embedded']['stations']:
+        yield station
+
+    semaphore = asyncio.Semaphore(
+        int(config.get('WFWX_MAX_CONCURRENT_PAGES', 4)))
+
+    async def fetch_page(page: int) -> dict:
+        async with semaphore:
+            return await _fetch_stations_page(client, headers, query_builder, page)
+
+    tasks = [asyncio.ensure_future(fetch_page(page))
+             for page in range(1, total_pages)]
+    try:
+        for task in tasks:
+            station_json = await task
+            for station in station_json['_embedded']['stations']:
+                yield station
+    finally:
+        # If we stopped early (e.g. a page failed, or the caller stopped iterating), clean up
+        # any pages still in flight.
+        for task in tasks:
+            if task.done():
+                if not task.cancelled():
+                    # Retrieve the exception, so that it isn't logged as never retrieved.
+                    task.exception()
+            else:
+                task.cancel()
+
+
+RAW_STATIONS_COALESCER = RequestCoalescer('raw stations')
+
+
+async def _get_raw_stations_by_codes(client: WFWXClient, headers: dict,
+                                     station_codes: List[int]) -> List[dict]:
+    """ Get the raw stations matching the station codes provided.
+
+    Concurrent requests for the same set of stations share a single request to WFWX.
+    """
+    normalized_codes = tuple(sorted(set(station_codes)))
+
+    async def fetch() -> List[dict]:
+        iterator = _fetch_raw_stations(
+            client, headers, BuildQueryByStationCode(normalized_codes))
+        return [raw_station async for raw_station in iterator]
+
+    return list(await RAW_STATIONS_COALESCER.run(normalized_codes, fetch))
 
 
 def _is_station_valid(station) -> bool:
@@ -129,89 +456,83 @@ def _is_station_valid(station) -> bool:
     return True
 
 
-def _parse_station(station) -> WeatherStation:
-    """ Transform from the json object returned by wf1, to our station object.
+class EcodivisionLocator():
+    """ Locate the ecodivision (and corresponding core fire season) for geographic coordinates.
+
+    Loading the ecodivision shapefile is expensive, so the polygons are loaded once, prepared for
+    repeated point-in-polygon tests, and indexed with an STRtree.
     """
-    with open(core_season_file_path) as file_handle:
-        core_seasons = json.load(file_handle)
-    ecodivisions = geopandas.read_file(ecodiv_shape_file_path)
-    station_coord = Point(
-        float(station['longitude']), float(station['latitude']))
-
-    # hacky fix for station 447 (WATSON LAKE FS), which is in the Yukon
-    # so ecodivision name has to be hard-coded
-    if station['stationCode'] == '447':
-        ecodiv_name = "SUB-ARCTIC HIGHLANDS"
-    else:
-        for index, row in ecodivisions.iterrows():  # pylint: disable=redefined-outer-name, unused-variable
-            geom = row['geometry']
-            if station_coord.within(geom):
-                ecodiv_name = row['CDVSNNM']
-                break
-    return WeatherStation(
-        code=station['stationCode'],
-        name=station['displayLabel'],
-        lat=station['latitude'],
-        long=station['longitude'],
-        ecodivision_name=ecodiv_name,
-        core_season=core_seasons[ecodiv_name]['core_season'])
-
-
-def _parse_hourly(hourly) -> WeatherReading:
-    """ Transform from the raw hourly json object returned by wf1, to our hourly obkect.
+
+    def __init__(self, shape_file_path: str = ecodiv_shape_file_path,
+                 core_seasons_file_path: str = core_season_file_path):
+        """ Load the ecodivisions and core seasons, and build the spatial index. """
+        with open(core_seasons_file_path) as file_handle:
+            self.core_seasons = json.load(file_handle)
+        ecodivisions = geopandas.read_file(shape_file_path)
+        self.names = list(ecodivisions['CDVSNNM'])
+        geometries = list(ecodivisions['geometry'])
+        self.prepared_geometries = [prep(geometry) for geometry in geometries]
+        # The tree returns geometries, so we keep track of where each geometry lives in our lists.
+        self.geometry_index = {id(geometry): index for index,
+                               geometry in enumerate(geometries)}
+        self.tree = STRtree(geometries)
+
+    def _locate_point(self, point: Point) -> str:
+        """ Return the name of the ecodivision containing the point, or None if not found. """
+        for candidate in self.tree.query(point):
+            index = self.geometry_index[id(candidate)]
+            if self.prepared_geometries[index].contains(point):
+                return self.names[index]
+        return None
+
+    def locate(self, lons: Sequence[float], lats: Sequence[float]) -> List[str]:
+        """ Return the ecodivision names for a batch of coordinates. """
+        return [self._locate_point(Point(float(lon), float(lat))) for lon, lat in zip(lons, lats)]
+
+    def get_core_season(self, ecodivision_name: str) -> dict:
+        """ Return the core fire season for a given ecodivision. """
+        return self.core_seasons[ecodivision_name]['core_season']
+
+
+_ECODIVISION_LOCATOR = None
+
+
+def get_ecodivision_locator() -> EcodivisionLocator:
+    """ Return the ecodivision locator, creating it on first use. """
+    global _ECODIVISION_LOCATOR  # pylint: disable=global-statement
+    if _ECODIVISION_LOCATOR is None:
+        LOGGER.info('Loading ecodivisions...')
+        _ECODIVISION_LOCATOR = EcodivisionLocator()
+    return _ECODIVISION_LOCATOR
+
+
+def _parse_stations(stations: List[dict]) -> List[WeatherStation]:
+    """ Transform from a list of json objects returned by wf1, to a list of our station objects.
     """
-    timestamp = datetime.fromtimestamp(
-        int(hourly['weatherTimestamp'])/1000, tz=timezone.utc).isoformat()
-    return WeatherReading(
-        datetime=timestamp,
-        temperature=hourly.get('temperature', None),
-        relative_humidity=hourly.get('relativeHumidity', None),
-        wind_speed=hourly.get('windSpeed', None),
-        wind_direction=hourly.get('windDirection', None),
-        barometric_pressure=hourly.get('barometricPressure', None),
-        precipitation=hourly.get('precipitation', None),
-        ffmc=hourly.get('ffmc', None),
-        isi=hourly.get('isi', None),
-        fwi=hourly.get('fwi', None)
-    )
-
-
-def _get_stations_by_codes_local(station_codes: List[int]) -> List[WeatherStation]:
-    """ Get a list of stations by code, from local json files. """
-    LOGGER.info('Using pre-generated json to retrieve station by code')
-    with open(weather_stations_file_path) as file_pointer:
-        stations = json.load(file_pointer)
-        results = []
-        for station in stations['weather_stations']:
-            if int(station['code']) in station_codes:
-                results.append(WeatherStation(**station))
-        return results
-
-
-async def _get_stations_by_codes_remote(station_codes: List[int]) -> List[WeatherStation]:
-    """ Get a list of stations by code, from WFWX Fireweather API. """
-    LOGGER.info('Using WFWX to retrieve stations by code')
-    async with ClientSession() as session:
-        # Get the authentication header
-        header = await _get_auth_header(session)
-        stations = []
-        # Iterate through "raw" station data.
-        iterator = _fetch_raw_stations(
-            session, header, BuildQueryByStationCode(station_codes))
-        async for raw_station in iterator:
-            # If the station is valid, add it to our list of stations.
-            if _is_station_valid(raw_station):
-                stations.append(_parse_station(raw_station))
-        LOGGER.debug('total stations: %d', len(stations))
-        return stations
+    locator = get_ecodivision_locator()
+    ecodiv_names = locator.locate(
+        [station['longitude'] for station in stations],
+        [station['latitude'] for station in stations])
+    result = []
+    for station, ecodiv_name in zip(stations, ecodiv_names):
+        # hacky fix for station 447 (WATSON LAKE FS), which is in the Yukon
+        # so ecodivision name has to be hard-coded
+        if station['stationCode'] == '447':
+            ecodiv_name = "SUB-ARCTIC HIGHLANDS"
+        result.append(WeatherStation(
+            code=station['stationCode'],
+            name=station['displayLabel'],
+            lat=station['latitude'],
+            long=station['longitude'],
+            ecodivision_name=ecodiv_name,
+            core_season=locator.get_core_season(ecodiv_name)))
+    return result
 
 
-async def get_stations_by_codes(station_codes: List[int]) -> List[WeatherStation]:
-    """ Get a list of stations by code, from WFWX Fireweather API. """
-    use_wfwx = config.get('USE_WFWX') == 'True'
-    if use_wfwx:
-        return await _get_stations_by_codes_remote(station_codes)
-    return _get_stations_by_codes_local(station_codes)
+def _parse_station(station) -> WeatherStation:
+    """ Transform from the json object returned by wf1, to our station object.
+    """
+    return _parse_stations([station])[0]
 
 
 def _get_stations_local() -> List[dict]:
@@ -227,29 +548,146 @@ async def _get_stations_remote() -> List[WeatherStation]:
     """ Get list of stations from WFWX Fireweather API.
     """
     LOGGER.info('Using WFWX to retrieve station list')
-    async with ClientSession() as session:
-        # Get the authentication header
-        header = await _get_auth_header(session)
-        stations = []
-        # Iterate through "raw" station data.
-        async for raw_station in _fetch_raw_stations(session, header, BuildQueryAllStations()):
-            # If the station is valid, add it to our list of stations.
-            if _is_station_valid(raw_station):
-                LOGGER.info('Processing raw_station %d',
-                            int(raw_station['stationCode']))
-                stations.append(_parse_station(raw_station))
-        LOGGER.debug('total stations: %d', len(stations))
+    client = get_wfwx_client()
+    # Get the authentication header
+    header = await _get_auth_header(client)
+    raw_stations = []
+    # Iterate through "raw" station data.
+    async for raw_station in _fetch_raw_stations(client, header, BuildQueryAllStations()):
+        # If the station is valid, add it to our list of stations.
+        if _is_station_valid(raw_station):
+            LOGGER.info('Processing raw_station %d',
+                        int(raw_station['stationCode']))
+            raw_stations.append(raw_station)
+    stations = _parse_stations(raw_stations)
+    LOGGER.debug('total stations: %d', len(stations))
     return stations
 
 
-async def get_stations() -> List[WeatherStation]:
-    """ Get list of stations from WFWX Fireweather API.
+async def _load_stations_local() -> List[WeatherStation]:
+    """ Get list of stations from local json files, as station objects.
     """
+    return [WeatherStation(**station) for station in _get_stations_local()]
+
+
+class StationCatalog():
+    """ In memory catalog of weather stations, indexed by station code.
+
+    The station list rarely changes, so it's loaded once and then kept for STATION_CATALOG_TTL seconds.
+    Once that time has passed, the catalog is refreshed in the background while the stale list
+    continues to be served. If the refresh fails (e.g. WFWX is down), the stale list is kept.
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Awaitable[List[WeatherStation]]]):
+        """ Initialize object """
+        self.name = name
+        self.loader = loader
+        self.stations = None
+        self.stations_by_code = {}
+        # Monotonic time at which the catalog was last loaded.
+        self.loaded_at = None
+        self._refresh_task = None
+
+    def is_stale(self) -> bool:
+        """ Return True if the catalog is older than its time to live. """
+        ttl = int(config.get('STATION_CATALOG_TTL', 3600))
+        return time.monotonic() - self.loaded_at > ttl
+
+    async def _refresh(self):
+        """ Load the station list, replacing the current one. """
+        LOGGER.info('refreshing %s station catalog', self.name)
+        stations = await self.loader()
+        self.stations = stations
+        self.stations_by_code = {station.code: station for station in stations}
+        self.loaded_at = time.monotonic()
+        LOGGER.info('%s station catalog loaded with %d stations',
+                    self.name, len(stations))
+
+    def _on_refresh_done(self, task: asyncio.Future):
+        """ Log failed refreshes, which are otherwise not awaited if running in the background. """
+        if not task.cancelled() and task.exception():
+            LOGGER.error('failed to refresh %s station catalog', self.name,
+                         exc_info=task.exception())
+
+    def _start_refresh(self) -> asyncio.Future:
+        """ Start refreshing the catalog, unless a refresh is already underway. """
+        if not _is_pending(self._refresh_task):
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+            self._refresh_task.add_done_callback(self._on_refresh_done)
+        return self._refresh_task
+
+    async def _load(self):
+        """ Make sure the catalog is loaded, and kick off a refresh if it's stale. """
+        if self.stations is None:
+            # Nothing to serve yet, so we have to wait.
+            await asyncio.shield(self._start_refresh())
+        elif self.is_stale():
+            self._start_refresh()
+
+    async def get_stations(self) -> List[WeatherStation]:
+        """ Return all the stations in the catalog. """
+        await self._load()
+        return list(self.stations)
+
+    async def get_stations_by_codes(self, station_codes: List[int]) -> List[WeatherStation]:
+        """ Return the stations in the catalog matching the codes provided. """
+        await self._load()
+        stations = []
+        for code in dict.fromkeys(station_codes):
+            station = self.stations_by_code.get(code)
+            if station is None:
+                LOGGER.warning('station %s not found in %s station catalog', code, self.name)
+            else:
+                stations.append(station)
+        return stations
+
+    def clear(self):
+        """ Empty the catalog, forcing it to be loaded on the next request. """
+        self.stations = None
+        self.stations_by_code = {}
+        self.loaded_at = None
+        self._refresh_task = None
+
+
+LOCAL_STATION_CATALOG = StationCatalog('local', _load_stations_local)
+REMOTE_STATION_CATALOG = StationCatalog('WFWX', _get_stations_remote)
+
+
+def _get_station_catalog() -> StationCatalog:
+    """ Return the station catalog to use. """
     # Check if we're really using the api, or loading from pre-generated files.
     use_wfwx = config.get('USE_WFWX') == 'True'
     if use_wfwx:
-        return await _get_stations_remote()
-    return _get_stations_local()
+        return REMOTE_STATION_CATALOG
+    return LOCAL_STATION_CATALOG
+
+
+STATIONS_COALESCER = RequestCoalescer('stations')
+
+
+async def get_stations_by_codes(station_codes: List[int]) -> List[WeatherStation]:
+    """ Get a list of stations by code, from the station catalog.
+
+    Concurrent requests for the same set of stations (in any order) share a single lookup.
+    """
+    catalog = _get_station_catalog()
+    normalized_codes = tuple(sorted(set(station_codes)))
+    stations = await STATIONS_COALESCER.run(
+        (catalog.name, normalized_codes),
+        lambda: catalog.get_stations_by_codes(normalized_codes))
+    # Return the stations in the order they were asked for.
+    stations_by_code = {station.code: station for station in stations}
+    return [stations_by_code[code] for code in dict.fromkeys(station_codes) if code in stations_by_code]
+
+
+async def get_stations() -> List[WeatherStation]:
+    """ Get list of stations, from the station catalog.
+
+    Concurrent requests share a single lookup.
+    """
+    catalog = _get_station_catalog()
+    # Callers are free to modify the list they get back, so each gets a copy.
+    return list(await STATIONS_COALESCER.run((catalog.name, None), catalog.get_stations))
 
 
 def _get_now():
@@ -257,17 +695,71 @@ def _get_now():
     return datetime.now(tz=timezone.utc)
 
 
-def prepare_fetch_hourlies_query(raw_station):
+# By default we're concerned with the last 5 days only.
+HOURLIES_WINDOW = timedelta(days=5)
+
+
+class HourlyReadingsCache():
+    """ Per station cache of hourly readings, so that we only have to ask WFWX for readings we haven't
+    seen yet.
+
+    Readings are kept in time order, in a bounded ring buffer per station, and are evicted once they
+    fall outside of the hourlies window.
+    """
+
+    def __init__(self):
+        """ Initialize object """
+        self.readings = {}
+
+    def get_latest_timestamp(self, station_id: str) -> datetime:
+        """ Return the timestamp of the most recent reading cached for the station, if any. """
+        buffer = self.readings.get(station_id)
+        if buffer:
+            return buffer[-1].datetime
+        return None
+
+    def merge(self, station_id: str, readings: List[WeatherReading],
+              window_start: datetime) -> List[WeatherReading]:
+        """ Add readings newer than those we have, evict those older than the window, and return
+        all the readings cached for the station. """
+        buffer = self.readings.get(station_id)
+        if buffer is None:
+            buffer = deque(maxlen=int(config.get('WFWX_HOURLIES_CACHE_SIZE', 240)))
+            self.readings[station_id] = buffer
+        latest = self.get_latest_timestamp(station_id)
+        for reading in readings:
+            if latest is None or reading.datetime > latest:
+                buffer.append(reading)
+                latest = reading.datetime
+        while buffer and buffer[0].datetime < window_start:
+            buffer.popleft()
+        return list(buffer)
+
+    def clear(self):
+        """ Empty the cache. """
+        self.readings = {}
+
+
+HOURLY_READINGS_CACHE = HourlyReadingsCache()
+
+
+def prepare_fetch_hourlies_query(raw_station, start_time: datetime = None):
     """ Prepare url and params to fetch hourly readings from the WFWX Fireweather API.
+
+    If a start time is given (e.g. the time of the last reading we have), only readings after that
+    are requested, otherwise all readings in the hourlies window are requested.
     """
     base_url = config.get('WFWX_BASE_URL')
-    # By default we're concerned with the last 5 days only.
     now = _get_now()
-    five_days_ago = now - timedelta(days=5)
-    LOGGER.debug('requesting historic data from %s to %s', five_days_ago, now)
+    window_start = now - HOURLIES_WINDOW
     # Prepare query params and query:
-    start_time_stamp = math.floor(five_days_ago.timestamp()*1000)
+    start_time_stamp = math.floor(window_start.timestamp()*1000)
+    if start_time and start_time >= window_start:
+        # WFWX includes the start time in the results, so we ask for anything after it.
+        start_time_stamp = math.floor(start_time.timestamp()*1000) + 1
     end_time_stamp = math.floor(now.timestamp()*1000)
+    LOGGER.debug('requesting historic data from %s to %s', datetime.fromtimestamp(
+        start_time_stamp/1000, tz=timezone.utc), now)
     station_id = raw_station['id']
     params = {'startTimestamp': start_time_stamp,
               'endTimestamp': end_time_stamp, 'stationId': station_id}
@@ -279,26 +771,67 @@ def prepare_fetch_hourlies_query(raw_station):
     return url, params
 
 
-async def fetch_hourlies(
-        session: ClientSession,
+async def fetch_hourly_columns(
+        client: WFWXClient,
         raw_station: dict,
-        headers: dict) -> WeatherStationHourlyReadings:
-    """ Fetch hourly weather readings for a give station.
+        headers: dict,
+        start_time: datetime = None) -> Dict[str, np.ndarray]:
+    """ Fetch ACTUAL hourly weather readings for a given station as columns (see parse_hourlies_columns),
+    newer than start_time if given, otherwise for the whole hourlies window.
     """
-    url, params = prepare_fetch_hourlies_query(raw_station)
+    url, params = prepare_fetch_hourlies_query(raw_station, start_time)
     LOGGER.debug('fetching hourlies for %s(%s)',
                  raw_station['displayLabel'], raw_station['stationCode'])
     # Get hourlies
-    async with session.get(url, params=params, headers=headers) as response:
-        hourlies_json = await response.json()
-        hourlies = []
-        for hourly in hourlies_json['_embedded']['hourlies']:
-            # We only accept "ACTUAL" values:
-            if hourly.get('hourlyMeasurementTypeCode', '').get('id') == 'ACTUAL':
-                hourlies.append(_parse_hourly(hourly))
-        LOGGER.debug('fetched %d hourlies for %s(%s)', len(
-            hourlies), raw_station['displayLabel'], raw_station['stationCode'])
-        return WeatherStationHourlyReadings(values=hourlies, station=_parse_station(raw_station))
+    hourlies_json = await _get_authorized_json(client, url, headers, params=params)
+    columns = parse_hourlies_columns(hourlies_json['_embedded']['hourlies'])
+    LOGGER.debug('fetched %d hourlies for %s(%s)', len(
+        columns['datetime']), raw_station['displayLabel'], raw_station['stationCode'])
+    return columns
+
+
+async def fetch_hourly_actuals(
+        client: WFWXClient,
+        raw_station: dict,
+        headers: dict,
+        start_time: datetime = None) -> List[WeatherReading]:
+    """ Fetch ACTUAL hourly weather readings for a given station, newer than start_time if given,
+    otherwise for the whole hourlies window.
+    """
+    return columns_to_readings(
+        await fetch_hourly_columns(client, raw_station, headers, start_time))
+
+
+async def _fetch_hourlies(
+        client: WFWXClient,
+        raw_station: dict,
+        headers: dict) -> WeatherStationHourlyReadings:
+    """ Fetch hourly weather readings for a give station.
+
+    Readings already in the hourly readings cache aren't requested again.
+    """
+    station_id = raw_station['id']
+    hourlies = await fetch_hourly_actuals(
+        client, raw_station, headers, HOURLY_READINGS_CACHE.get_latest_timestamp(station_id))
+    values = HOURLY_READINGS_CACHE.merge(
+        station_id, hourlies, _get_now() - HOURLIES_WINDOW)
+    return WeatherStationHourlyReadings(values=values, station=_parse_station(raw_station))
+
+
+HOURLIES_COALESCER = RequestCoalescer('hourlies')
+
+
+async def fetch_hourlies(
+        client: WFWXClient,
+        raw_station: dict,
+        headers: dict) -> WeatherStationHourlyReadings:
+    """ Fetch hourly weather readings for a give station.
+
+    Concurrent requests for the same station share a single request to WFWX.
+    """
+    readings = await HOURLIES_COALESCER.run(
+        raw_station['id'], lambda: _fetch_hourlies(client, raw_station, headers))
+    return readings.copy(update={'values': list(readings.values)})
 
 
 async def get_hourly_readings(station_codes: List[int]) -> List[WeatherStationHourlyReadings]:
@@ -306,18 +839,127 @@ async def get_hourly_readings(station_codes: List[int]) -> List[WeatherStationHo
     """
     # Create a list containing all the tasks to run in parallel.
     tasks = []
-    # Limit the number of concurrent connections.
-    conn = TCPConnector(limit=10)
-    async with ClientSession(connector=conn) as session:
-        # Get the authentication header
-        header = await _get_auth_header(session)
+    # The number of concurrent requests is limited by the shared client.
+    client = get_wfwx_client()
+    # Get the authentication header
+    header = await _get_auth_header(client)
+
+    # Iterate through "raw" station data.
+    for raw_station in await _get_raw_stations_by_codes(client, header, station_codes):
+        task = asyncio.create_task(
+            fetch_hourlies(client, raw_station, header))
+        tasks.append(task)
+    # Run the tasks concurrently, waiting for them all to complete.
+    return await asyncio.gather(*tasks)
+
+
+async def get_hourly_readings_columns(station_codes: List[int]) -> List[dict]:
+    """ Get the hourly readings for the list of station codes provided, as columns, ready to be
+    serialized as json.
+
+    Readings are decoded straight into arrays, skipping per reading model validation. Unlike
+    get_hourly_readings, the readings aren't cached, so the whole hourlies window is fetched every time.
+    """
+    client = get_wfwx_client()
+    # Get the authentication header
+    header = await _get_auth_header(client)
+    raw_stations = await _get_raw_stations_by_codes(client, header, station_codes)
+    columns = await asyncio.gather(*[
+        fetch_hourly_columns(client, raw_station, header) for raw_station in raw_stations])
+    stations = _parse_stations(raw_stations)
+    return [{'values': {field: column_to_list(column) for field, column in station_columns.items()},
+             'station': station.dict()}
+            for station, station_columns in zip(stations, columns)]
+
+
+async def _fetch_hourly_actuals_or_error(
+        client: WFWXClient,
+        raw_station: dict,
+        headers: dict,
+        start_time: datetime) -> Union[List[WeatherReading], WeatherStationHourlyReadingsError]:
+    """ Fetch ACTUAL hourly weather readings for a given station, returning an error record instead of
+    raising an exception if it fails. """
+    try:
+        return await fetch_hourly_actuals(client, raw_station, headers, start_time)
+    # We intentionally catch a broad exception, as one station failing shouldn't fail the rest.
+    except Exception as exception:  # pylint: disable=broad-except
+        LOGGER.error('failed fetching hourly actuals for %s(%s)', raw_station['displayLabel'],
+                     raw_station['stationCode'], exc_info=exception)
+    return WeatherStationHourlyReadingsError(station_code=raw_station['stationCode'],
+                                             detail='Failed to fetch hourly actuals')
+
+
+async def get_hourly_actuals_since(
+        start_times: Dict[int, datetime],
+        all_stations: bool = False
+) -> Dict[int, Union[List[WeatherReading], WeatherStationHourlyReadingsError]]:
+    """ Get the ACTUAL hourly readings for each of the station codes provided, newer than the start time
+    given for the station (or for the whole hourlies window, if the start time is None). Stations that
+    fail get an error record instead of their readings.
+
+    If all_stations is set, readings are fetched for every valid station, listed without a filter on
+    station code, and start_times only needs to hold the stations that have one.
+    """
+    client = get_wfwx_client()
+    # Get the authentication header
+    header = await _get_auth_header(client)
+    if all_stations:
+        raw_stations = [raw_station async for raw_station in _fetch_raw_stations(
+            client, header, BuildQueryAllStations()) if _is_station_valid(raw_station)]
+    else:
+        raw_stations = await _get_raw_stations_by_codes(client, header, list(start_times))
+    readings = await asyncio.gather(*[
+        _fetch_hourly_actuals_or_error(client, raw_station, header,
+                                       start_times.get(int(raw_station['stationCode'])))
+        for raw_station in raw_stations])
+    return {int(raw_station['stationCode']): station_readings
+            for raw_station, station_readings in zip(raw_stations, readings)}
 
-        # Iterate through "raw" station data.
-        iterator = _fetch_raw_stations(
-            session, header, BuildQueryByStationCode(station_codes))
-        async for raw_station in iterator:
-            task = asyncio.create_task(
-                fetch_hourlies(session, raw_station, header))
-            tasks.append(task)
-        # Run the tasks concurrently, waiting for them all to complete.
-        return await asyncio.gather(*tasks)
+
+async def _fetch_hourlies_or_error(
+        client: WFWXClient,
+        raw_station: dict,
+        headers: dict,
+        timeout: float) -> Union[WeatherStationHourlyReadings, WeatherStationHourlyReadingsError]:
+    """ Fetch hourly weather readings for a given station, returning an error record instead of raising
+    an exception if it fails or takes too long. """
+    try:
+        return await asyncio.wait_for(fetch_hourlies(client, raw_station, headers), timeout)
+    except asyncio.TimeoutError:
+        LOGGER.warning('timed out fetching hourlies for %s(%s)',
+                       raw_station['displayLabel'], raw_station['stationCode'])
+        detail = 'Timed out after {} seconds'.format(timeout)
+    # We intentionally catch a broad exception, as one station failing shouldn't fail the rest.
+    except Exception as exception:  # pylint: disable=broad-except
+        LOGGER.error('failed fetching hourlies for %s(%s)', raw_station['displayLabel'],
+                     raw_station['stationCode'], exc_info=exception)
+        detail = 'Failed to fetch hourlies'
+    return WeatherStationHourlyReadingsError(station_code=raw_station['stationCode'], detail=detail)
+
+
+async def stream_hourly_readings(
+        station_codes: List[int]
+) -> AsyncGenerator[Union[WeatherStationHourlyReadings, WeatherStationHourlyReadingsError], None]:
+    """ Asynchronous generator for the hourly readings of the station codes provided, yielding the
+    readings for each station as soon as they're available.
+
+    Each station has WFWX_HOURLIES_STATION_TIMEOUT seconds to complete, after which an error record is
+    yielded for it instead.
+    """
+    timeout = float(config.get('WFWX_HOURLIES_STATION_TIMEOUT', 30))
+    client = get_wfwx_client()
+    # Get the authentication header
+    header = await _get_auth_header(client)
+
+    tasks = []
+    try:
+        # Iterate through "raw" station data, starting on each station's hourlies.
+        for raw_station in await _get_raw_stations_by_codes(client, header, station_codes):
+            tasks.append(asyncio.ensure_future(
+                _fetch_hourlies_or_error(client, raw_station, header, timeout)))
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # If the client goes away, there's no point carrying on.
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,49 @@
+""" Compare extracting the grid around each station from a grib file one station at a time, against
+extracting them all from a single window.
+
+Usage:
+    python scripts/benchmark_grib_extraction.py [grib file] [repeat]
+"""
+import sys
+import timeit
+import app.models.process_grib as process_grib
+from app.wildfire_one import _get_stations_local
+
+# pylint: disable=import-error, invalid-name
+
+DEFAULT_FILENAME = 'app/tests/models/CMC_glb_RH_TGL_2_latlon.15x.15_2020071300_P000.grib2'
+
+
+def per_station(stations, raster_band, origin, pixel):
+    """ Read the grid around each station separately """
+    return [process_grib.get_surrounding_grid(raster_band, *process_grib.calculate_raster_coordinate(
+        float(station['long']), float(station['lat']), origin, pixel)) for station in stations]
+
+
+def single_window(stations, raster_band, origin, pixel):
+    """ Read the grid around all stations at once """
+    return list(process_grib.yield_data_for_stations(stations, raster_band, origin, pixel))
+
+
+def main():
+    """ Time both ways of extracting station data, and check that they agree """
+    filename = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FILENAME
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    dataset = process_grib.open_grib(filename)
+    origin, pixel = process_grib.get_dataset_geometry(dataset)
+    raster_band = dataset.GetRasterBand(1)
+    stations = _get_stations_local()
+    args = (stations, raster_band, origin, pixel)
+
+    if per_station(*args) != single_window(*args):
+        raise ValueError('per station and single window extraction disagree')
+    print('{} stations, best of {} runs:'.format(len(stations), repeat))
+    timings = {}
+    for function in (per_station, single_window):
+        timings[function.__name__] = min(timeit.repeat(lambda f=function: f(*args), number=1, repeat=repeat))
+        print('{:<15} {:>8.2f}ms'.format(function.__name__, timings[function.__name__] * 1000))
+    print('speed up: {:.1f}x'.format(timings['per_station'] / timings['single_window']))
+
+
+if __name__ == '__main__':
+    main()
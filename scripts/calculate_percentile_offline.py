@@ -1,6 +1,16 @@
-""" Pre 90th percentile calculator """
+""" Pre 90th percentile calculator
+
+Usage:
+    python scripts/calculate_percentile_offline.py              # calculate, then pack
+    python scripts/calculate_percentile_offline.py --pack-only  # pack the existing json files
+"""
 import os
+import sys
 import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 
 # pylint: disable=import-error, invalid-name
@@ -10,52 +20,191 @@ RANGES = [(1970, RECENT_YEAR), (RECENT_YEAR - 19, RECENT_YEAR),
           (RECENT_YEAR - 9, RECENT_YEAR)]
 PERCENTILE = 0.9
 NUMBER_OF_DECIMAL_POINT = 5  # for FWI values
+DATA_PATH = 'app/data'
+DAILY_WEATHER_FILENAME = 'csv/DailyWeather.csv'
+PACKED_FILENAME = 'app/data/percentiles.npz'
+SKETCHES_FILENAME = 'app/data/percentile_sketches.npz'
+FWI_VALUES = ('ffmc', 'isi', 'bui')
+# The only columns of the daily weather csv that we use.
+DAILY_WEATHER_DTYPES = {
+    'weather_date': np.int64,  # yyyymmdd
+    'station_code': np.int64,
+    'ffmc': np.float64,
+    'isi': np.float64,
+    'bui': np.float64,
+    'ffmc_valid': bool,
+    'isi_valid': bool,
+    'bui_valid': bool,
+}
 
 
 def main():
     """ The main entrypoint for pre-generating json daily summaries. """
+    timings = []
     # import the CSV into Pandas dataframe
     print('Open file...')
-    df = pd.read_csv('csv/DailyWeather.csv')
+    with timed('read csv', timings):
+        df = read_daily_weather()
     print('Split dates into multiple columns...')
-    split_dates_into_multiple_cols(df)
+    with timed('split dates', timings):
+        split_dates_into_multiple_cols(df)
 
     stations = get_stations()
 
-    for start_year, end_year in RANGES:
-        year_range = list(range(start_year, end_year + 1))
-        year_df = grab_data_in_particular_year_range(df, year_range)
+    print('Select core fire season values...')
+    with timed('select core fire season values', timings):
+        values = get_season_values(df, stations)
+        station_years = get_station_years(df)
+    del df
 
-        folder_name = getOutputFolderName(start_year, end_year)
+    print('Create percentile sketches...')
+    with timed('pack sketches', timings):
+        pack_sketches(values, station_years, stations)
 
-        for station in stations:
-            station_code = int(station['code'])
-            station_df = year_df[year_df['station_code'] == station_code]
+    with timed('calculate percentiles', timings):
+        timings.extend(calculate_ranges(values, station_years, stations))
+
+    with timed('pack summaries', timings):
+        pack_summaries()
+
+    print_timing_report(timings)
 
-            if station_df.empty:
-                print('Data not available for {} creating empty summary...'.format(
-                    station_code))
-                empty_summary = create_null_summary(station, year_range)
-                dump_summary_in_json(folder_name, station_code, empty_summary)
-                continue
 
-            season = get_core_fire_season(station)
-            remove_data_outside_fire_season(station_df, season)
-            percentiles = calculate_percentile(station_df, PERCENTILE)
+@contextmanager
+def timed(step: str, timings: list):
+    """ Record how long the step takes """
+    start = time.perf_counter()
+    yield
+    timings.append((step, time.perf_counter() - start))
 
-            years = get_years_for_valid_fwi_values(station_df)
 
-            summary = {
-                'ffmc': percentiles['ffmc'],
-                'isi': percentiles['isi'],
-                'bui': percentiles['bui'],
-                'years': years,
-                'station': station
-            }
+def print_timing_report(timings: list):
+    """ Print how long each step took """
+    print('--- Timings ---')
+    for step, seconds in timings:
+        print('{:<40} {:>8.2f}s'.format(step, seconds))
 
-            dump_summary_in_json(folder_name, station_code, summary)
 
-        print('--- Done creating data under {} folder ---'.format(folder_name))
+def read_daily_weather(filename: str = DAILY_WEATHER_FILENAME) -> pd.DataFrame:
+    """ Read the columns we need from the daily weather csv, with explicit types so that pandas
+    doesn't have to infer them. """
+    return pd.read_csv(filename, usecols=list(DAILY_WEATHER_DTYPES), dtype=DAILY_WEATHER_DTYPES)
+
+
+def get_core_fire_seasons(stations: list) -> pd.DataFrame:
+    """ Read the core fire season of each station into a dataframe, one row per station """
+    return pd.DataFrame([{
+        'station_code': int(station['code']),
+        'start_month': int(station['core_season']['start_month']),
+        'start_day': int(station['core_season']['start_day']),
+        'end_month': int(station['core_season']['end_month']),
+        'end_day': int(station['core_season']['end_day']),
+    } for station in stations], columns=['station_code', 'start_month', 'start_day', 'end_month',
+                                         'end_day'])
+
+
+def in_core_fire_season(df, stations: list) -> np.ndarray:
+    """ Return a mask that is True for data recorded within the core fire season of its station.
+    Data for stations that aren't in the list is never in season. """
+    season = df[['station_code']].merge(get_core_fire_seasons(stations), on='station_code', how='left')
+    month = df['month'].to_numpy()
+    day = df['day'].to_numpy()
+    start_month = season['start_month'].to_numpy()
+    end_month = season['end_month'].to_numpy()
+    after_start = (month > start_month) | ((month == start_month) & (day >= season['start_day'].to_numpy()))
+    before_end = (month < end_month) | ((month == end_month) & (day <= season['end_day'].to_numpy()))
+    return after_start & before_end
+
+
+def get_season_values(df, stations: list) -> pd.DataFrame:
+    """ Return the valid, core fire season values of ffmc, isi and bui in long format, with columns
+    station_code, year, index (ffmc, isi or bui) and value. """
+    season_df = df[in_core_fire_season(df, stations)]
+    frames = []
+    for key in FWI_VALUES:
+        valid_df = season_df[season_df['{}_valid'.format(key)]]
+        frames.append(pd.DataFrame({
+            'station_code': valid_df['station_code'].to_numpy(),
+            'year': valid_df['year'].to_numpy(),
+            'index': key,
+            'value': valid_df[key].to_numpy(dtype=np.float64)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_station_years(df) -> pd.DataFrame:
+    """ Return each station and year that has any data, in or out of the core fire season. """
+    return df[['station_code', 'year']].drop_duplicates().reset_index(drop=True)
+
+
+def summarize_range(values, station_years, stations: list, start_year: int, end_year: int) -> dict:
+    """ Calculate the summary of each station for a year range, keyed by station code. """
+    year_range = list(range(start_year, end_year + 1))
+    range_values = values[values['year'].between(start_year, end_year)]
+    codes_with_data = set(station_years[station_years['year'].between(start_year, end_year)]
+                          ['station_code'].tolist())
+    # NOTE: Series.quantile (as opposed to GroupBy.quantile) so that the results match those
+    # calculated one station at a time to the last bit.
+    percentiles = range_values.groupby(['station_code', 'index'])['value']\
+        .agg(lambda station_values: station_values.quantile(PERCENTILE)).to_dict()
+    years = range_values.groupby('station_code')['year'].unique().to_dict()
+
+    summaries = {}
+    for station in stations:
+        station_code = int(station['code'])
+        if station_code not in codes_with_data:
+            summaries[station_code] = create_null_summary(station, year_range)
+            continue
+        summary = {}
+        for key in FWI_VALUES:
+            value = percentiles.get((station_code, key), np.nan)
+            summary[key] = None if pd.isna(value) else round(
+                np.float64(value), NUMBER_OF_DECIMAL_POINT)
+        summary['years'] = sorted(years[station_code].tolist()) if station_code in years else []
+        summary['station'] = station
+        summaries[station_code] = summary
+    return summaries
+
+
+def write_range(values, station_years, stations: list, start_year: int, end_year: int,
+                data_path: str = DATA_PATH) -> float:
+    """ Write the summary of each station for a year range into a json file, returning how long it
+    took. """
+    start = time.perf_counter()
+    folder_name = getOutputFolderName(start_year, end_year, data_path)
+    summaries = summarize_range(values, station_years, stations, start_year, end_year)
+    for station_code, summary in summaries.items():
+        dump_summary_in_json(folder_name, station_code, summary)
+    print('--- Done creating data under {} folder ---'.format(folder_name))
+    return time.perf_counter() - start
+
+
+_WORKER_DATA = {}
+
+
+def _init_worker(values, station_years, stations: list, data_path: str):
+    """ Hold on to the data shared by every year range in the worker process """
+    _WORKER_DATA.update(values=values, station_years=station_years, stations=stations,
+                        data_path=data_path)
+
+
+def _write_range_in_worker(year_range: tuple) -> float:
+    """ Write the summaries for a year range, using the data held by the worker process """
+    start_year, end_year = year_range
+    return write_range(_WORKER_DATA['values'], _WORKER_DATA['station_years'], _WORKER_DATA['stations'],
+                       start_year, end_year, _WORKER_DATA['data_path'])
+
+
+def calculate_ranges(values, station_years, stations: list, ranges: list = None,
+                     data_path: str = DATA_PATH) -> list:
+    """ Write the summaries for each year range, one process per range. Returns how long each range
+    took. """
+    ranges = RANGES if ranges is None else ranges
+    with ProcessPoolExecutor(max_workers=min(len(ranges), os.cpu_count() or 1),
+                             initializer=_init_worker,
+                             initargs=(values, station_years, stations, data_path)) as executor:
+        durations = list(executor.map(_write_range_in_worker, ranges))
+    return [('range {}-{}'.format(start_year, end_year), duration)
+            for (start_year, end_year), duration in zip(ranges, durations)]
 
 
 def create_null_summary(station, year_range):
@@ -75,9 +224,9 @@ def dump_summary_in_json(folder_name: str, station_code: str, summary: dict):
         json.dump(summary, json_file, indent=4, allow_nan=False)
 
 
-def getOutputFolderName(start_year: int, end_year: int) -> str:
+def getOutputFolderName(start_year: int, end_year: int, data_path: str = DATA_PATH) -> str:
     """ Create an output folder and return its name """
-    folder_name = "app/data/{}-{}".format(start_year, end_year)
+    folder_name = "{}/{}-{}".format(data_path, start_year, end_year)
     if not os.path.exists(folder_name):
         os.mkdir(folder_name)
     return folder_name
@@ -89,69 +238,124 @@ def get_stations() -> list:
         return json.load(file_handle)['weather_stations']
 
 
-def get_core_fire_season(station) -> dict:
-    """ Read the core fire season and return them in dict """
-    return {
-        'start_month': int(station['core_season']['start_month']),
-        'start_day': int(station['core_season']['start_day']),
-        'end_month': int(station['core_season']['end_month']),
-        'end_day': int(station['core_season']['end_day']),
-    }
-
-
 def split_dates_into_multiple_cols(df):
-    """ Turn weather_date into datetime type then create 3 columns, year, month, and day """
-    df['weather_date'] = df['weather_date'].apply(str)
-    df['year'] = df['weather_date'].apply(lambda x: int(x[:4]))
-    df['month'] = df['weather_date'].apply(lambda x: int(x[4:6]))
-    df['day'] = df['weather_date'].apply(lambda x: int(x[6:]))
-
-
-def grab_data_in_particular_year_range(df, year_range: list) -> pd.DataFrame:
-    """ Grab data recorded between start_year and end_year. """
-    return df[df['year'].isin(year_range)]
-
-
-def remove_data_outside_fire_season(df, season: dict):
-    """ Remove data recorded outside of fire season. """
-    outside_month = (df['month'] < season['start_month']) | (
-        df['month'] > season['end_month'])
-    df.drop(df[outside_month].index, inplace=True)
-
-    before_start = ((df['month'] == season['start_month']) &
-                    (df['day'] < season['start_day']))
-    df.drop(df[before_start].index, inplace=True)
-
-    after_end = ((df['month'] == season['end_month']) &
-                 (df['day'] > season['end_day']))
-    df.drop(df[after_end].index, inplace=True)
-
-
-def calculate_percentile(df, percentile: float) -> dict:
-    """ Calculate percentile """
-    ffmc = df[df['ffmc_valid']].ffmc.quantile(percentile)
-    bui = df[df['bui_valid']].bui.quantile(percentile)
-    isi = df[df['isi_valid']].isi.quantile(percentile)
-
-    ffmc = round(ffmc, NUMBER_OF_DECIMAL_POINT) if not pd.isna(ffmc) else None
-    bui = round(bui, NUMBER_OF_DECIMAL_POINT) if not pd.isna(bui) else None
-    isi = round(isi, NUMBER_OF_DECIMAL_POINT) if not pd.isna(isi) else None
-
-    return {'ffmc': ffmc, 'bui': bui, 'isi': isi}
-
-
-def get_years_for_valid_fwi_values(df) -> list:
-    """ List each year that is sorted """
-    ffmc_data_years = df[df['ffmc_valid']].year.unique().tolist()
-    bui_data_years = df[df['bui_valid']].year.unique().tolist()
-    isi_data_years = df[df['isi_valid']].year.unique().tolist()
-    # Combine them and remove duplicates
-    data_years = list(set(ffmc_data_years) | set(
-        bui_data_years) | set(isi_data_years))
-    data_years.sort()
-
-    return data_years
+    """ Split weather_date (yyyymmdd) into 3 columns, year, month, and day """
+    dates = df['weather_date'].astype(np.int64)
+    df['year'] = dates // 10000
+    df['month'] = dates // 100 % 100
+    df['day'] = dates % 100
+
+
+def load_summaries(folder_name: str) -> dict:
+    """ Load the json summaries in a folder, keyed by station code """
+    summaries = {}
+    for filename in os.listdir(folder_name):
+        if filename.endswith('.json'):
+            with open(os.path.join(folder_name, filename)) as json_file:
+                summaries[filename[:-len('.json')]] = json.load(json_file)
+    return summaries
+
+
+def years_to_bitmask(years: list, base_year: int) -> int:
+    """ Turn a list of years into a bitmask, with bit n set if base_year + n is in the list """
+    bitmask = 0
+    for year in years:
+        bitmask |= 1 << (year - base_year)
+    return bitmask
+
+
+def pack_summaries(output_filename: str = PACKED_FILENAME):
+    """ Pack the json summaries of all year ranges into a single, uncompressed .npz file, so that
+    the API can memory map it rather than opening a file per station.
+
+    Arrays are laid out with one row per year range and one column per station:
+        ranges: (start year, end year) of each row.
+        codes: station code of each column.
+        stations: json encoded list of station records, one per column.
+        present: True if the range has a summary for the station.
+        ffmc, isi, bui: percentile values, NaN when there's no value.
+        years: bitmask of the years with data, bit n meaning base_year + n.
+        base_year: the year of bit 0.
+    """
+    summaries = [load_summaries(getOutputFolderName(start_year, end_year))
+                 for start_year, end_year in RANGES]
+    codes = sorted({code for range_summaries in summaries for code in range_summaries}, key=int)
+    years = {year for range_summaries in summaries
+             for summary in range_summaries.values() for year in summary['years']}
+    base_year = min(years) if years else RANGES[0][0]
+    if years and max(years) - base_year >= 64:
+        raise ValueError('years {}-{} do not fit in a 64 bit mask'.format(base_year, max(years)))
+
+    shape = (len(RANGES), len(codes))
+    present = np.zeros(shape, dtype=bool)
+    values = {key: np.full(shape, np.nan, dtype=np.float64) for key in ('ffmc', 'isi', 'bui')}
+    year_masks = np.zeros(shape, dtype=np.uint64)
+    stations = [None] * len(codes)
+    for row, range_summaries in enumerate(summaries):
+        for column, code in enumerate(codes):
+            summary = range_summaries.get(code)
+            if summary is None:
+                continue
+            present[row, column] = True
+            for key, value in values.items():
+                if summary[key] is not None:
+                    value[row, column] = summary[key]
+            year_masks[row, column] = years_to_bitmask(summary['years'], base_year)
+            if stations[column] is None:
+                stations[column] = summary['station']
+
+    station_json = json.dumps(stations, allow_nan=False).encode('utf-8')
+    # NOTE: savez (not savez_compressed), so that the arrays can be memory mapped.
+    np.savez(output_filename,
+             ranges=np.array(RANGES, dtype=np.int32).reshape(-1, 2),
+             codes=np.array(codes, dtype=np.int32),
+             stations=np.frombuffer(station_json, dtype=np.uint8),
+             present=present,
+             years=year_masks,
+             base_year=np.array([base_year], dtype=np.int32),
+             **values)
+    print('--- Packed {} stations for {} ranges into {} ---'.format(
+        len(codes), len(RANGES), output_filename))
+
+
+def pack_sketches(values, station_years, stations: list, output_filename: str = SKETCHES_FILENAME):
+    """ Write the sorted, valid, core fire season values of ffmc, isi and bui for each station and year
+    into a single uncompressed .npz file, from which the API can calculate any percentile over any
+    year range. See app.percentile.PercentileSketches for the layout.
+    """
+    positions = pd.Series(np.arange(len(stations)), index=[int(station['code']) for station in stations])
+    # Every year with data gets an entry, so that the API can tell a station without any data
+    # apart from a station without any data in the core fire season.
+    entries = station_years[station_years['station_code'].isin(positions.index)]
+    entries = entries.assign(position=positions.reindex(entries['station_code']).to_numpy())\
+        .sort_values(['position', 'year'])
+    entries['entry'] = np.arange(len(entries))
+    station_offsets = np.concatenate(
+        [[0], np.cumsum(np.bincount(entries['position'].to_numpy(), minlength=len(stations)))])
+
+    entry_values = values.merge(entries[['station_code', 'year', 'entry']], on=['station_code', 'year'])
+    arrays = {}
+    for key in FWI_VALUES:
+        key_values = entry_values[entry_values['index'] == key]
+        entry = key_values['entry'].to_numpy()
+        value = key_values['value'].to_numpy(dtype=np.float64)
+        # Sort by entry, then by value.
+        order = np.lexsort((value, entry))
+        counts = np.bincount(entry, minlength=len(entries))
+        arrays['{}_offsets'.format(key)] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        arrays['{}_values'.format(key)] = value[order]
+    station_json = json.dumps(stations, allow_nan=False).encode('utf-8')
+    # NOTE: savez (not savez_compressed), so that the arrays can be memory mapped.
+    np.savez(output_filename,
+             stations=np.frombuffer(station_json, dtype=np.uint8),
+             station_offsets=station_offsets.astype(np.int64),
+             entry_years=entries['year'].to_numpy(dtype=np.int32),
+             **arrays)
+    print('--- Packed sketches for {} stations into {} ---'.format(len(stations), output_filename))
 
 
 if __name__ == '__main__':
-    main()
+    if '--pack-only' in sys.argv[1:]:
+        pack_summaries()
+    else:
+        main()